@@ -1,5 +1,5 @@
 # ruff: noqa: F401
-from ._shared import MixedData, TransformDataset
+from ._shared import MixedData, TransformDataset, dataset_inputs
 from .adversarial import AdversarialExampleDataset, make_adversarial_examples
 from .backdoors import (
     Backdoor,
@@ -8,8 +8,9 @@ from .backdoors import (
     NoiseBackdoor,
     WanetBackdoor,
 )
-from .huggingface import HuggingfaceDataset, IMDBDataset
+from .huggingface import HuggingfaceDataset, IMDBDataset, TokenizedText
 from .pytorch import CIFAR10, GTSRB, MNIST, PytorchDataset
+from .sampling import LengthGroupedBatchSampler, make_dataloader
 from .toy_ambiguous_features import ToyDataset
 from .transforms import (
     GaussianNoise,
@@ -1,6 +1,7 @@
 from typing import Optional
 
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, Subset, TensorDataset
 
 from cupbearer.data.transforms import Transform
 
@@ -63,3 +64,62 @@ class MixedData(Dataset):
             if self.return_anomaly_labels:
                 return self.anomalous_data[index - self.normal_len], 1
             return self.anomalous_data[index - self.normal_len]
+
+
+def _has_fast_inputs(dataset: Dataset) -> bool:
+    if isinstance(dataset, Subset):
+        return _has_fast_inputs(dataset.dataset)
+    if isinstance(dataset, MixedData):
+        return _has_fast_inputs(dataset.normal_data) and _has_fast_inputs(
+            dataset.anomalous_data
+        )
+    return hasattr(dataset, "inputs") or isinstance(dataset, TensorDataset)
+
+
+def _select(inputs, indices):
+    if isinstance(inputs, torch.Tensor):
+        return inputs[list(indices)]
+    return [inputs[i] for i in indices]
+
+
+def _concat(a, b):
+    if isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor):
+        return torch.cat([a, b])
+    return list(a) + list(b)
+
+
+def dataset_inputs(dataset: Dataset) -> list | torch.Tensor:
+    """Get the inputs (i.e. samples without labels) of all elements of a dataset.
+
+    Where possible, this avoids loading entire samples. Datasets can support that by
+    implementing an `inputs()` method that returns all their inputs (e.g. a column
+    of a HF dataset). `MixedData`, `Subset` and `TensorDataset` are handled
+    automatically. Other datasets are iterated over.
+
+    Returns:
+        Either a list of inputs or a tensor with all inputs stacked.
+    """
+    if isinstance(dataset, MixedData):
+        return _concat(
+            dataset_inputs(Subset(dataset.normal_data, range(dataset.normal_len))),
+            dataset_inputs(
+                Subset(dataset.anomalous_data, range(dataset.anomalous_len))
+            ),
+        )
+    if isinstance(dataset, Subset) and _has_fast_inputs(dataset.dataset):
+        return _select(dataset_inputs(dataset.dataset), dataset.indices)
+    if hasattr(dataset, "inputs"):
+        return dataset.inputs()
+    if isinstance(dataset, TensorDataset):
+        return dataset.tensors[0]
+
+    inputs = []
+    for i in range(len(dataset)):  # type: ignore
+        sample = dataset[i]
+        # Strip labels, and anomaly labels in case of nested MixedData
+        if isinstance(sample, (tuple, list)):
+            sample = sample[0]
+        if isinstance(sample, (tuple, list)) and len(sample) == 2:
+            sample = sample[0]
+        inputs.append(sample)
+    return inputs
@@ -45,6 +45,9 @@ class AdversarialExampleDataset(Dataset):
         # it should use the model-generated labels, not ground truth ones.
         return self.advexes[idx], int(self.labels[idx])
 
+    def inputs(self) -> torch.Tensor:
+        return self.advexes
+
 
 def make_adversarial_examples(
     model: torch.nn.Module,
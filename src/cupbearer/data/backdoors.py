@@ -37,6 +37,30 @@ class Backdoor(Transform, ABC):
         img = img.clone()
         return self.inject_backdoor(img), self.target_class
 
+    def inject_batch(
+        self, batch: Tuple[torch.Tensor, torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Apply the backdoor to an entire collated batch.
+
+        Unlike `__call__`, this can run on whatever device the batch is on (e.g. after
+        moving it to the GPU), instead of once per sample in the dataloader. Each
+        sample is still backdoored independently with probability `p_backdoor`.
+
+        Args:
+            batch: Images of shape (batch, channels, height, width) and labels.
+
+        Returns:
+            The backdoored images and labels. The inputs aren't modified.
+        """
+        imgs, labels = batch
+        mask = torch.rand(len(imgs), device=imgs.device) < self.p_backdoor
+        if mask.all():
+            imgs = self.inject_backdoor(imgs.clone())
+        else:
+            imgs = imgs.clone()
+            imgs[mask] = self.inject_backdoor(imgs[mask])
+        return imgs, labels.masked_fill(mask, self.target_class)
+
 
 class BackdoorDataset(TransformDataset):
     """Just a wrapper around TransformDataset with aliases and more specific types."""
@@ -68,15 +92,16 @@ class CornerPixelBackdoor(Backdoor):
         ], "Invalid corner specified"
 
     def inject_backdoor(self, img: torch.Tensor):
-        assert img.ndim == 3
+        # Either a single image or a batch of them
+        assert img.ndim in {3, 4}
         if self.corner == "top-left":
-            img[:, 0, 0] = 1
+            img[..., 0, 0] = 1
         elif self.corner == "top-right":
-            img[:, -1, 0] = 1
+            img[..., -1, 0] = 1
         elif self.corner == "bottom-left":
-            img[:, 0, -1] = 1
+            img[..., 0, -1] = 1
         elif self.corner == "bottom-right":
-            img[:, -1, -1] = 1
+            img[..., -1, -1] = 1
 
         return img
 
@@ -87,8 +112,7 @@ class NoiseBackdoor(Backdoor):
 
     def inject_backdoor(self, img: torch.Tensor):
         assert torch.all(img <= 1), "Image not in range [0, 1]"
-        noise = torch.normal(0, self.std, img.shape)
-        img += noise
+        img += self.std * torch.randn_like(img)
         img.clip_(0, 1)
 
         return img
@@ -119,6 +143,11 @@ class WanetBackdoor(Backdoor):
     def __post_init__(self):
         super().__post_init__()
         self._warping_field = None
+        # Warping fields for each image size (py, px)
+        self._warping_fields: dict[tuple[int, int], torch.Tensor] = {}
+        # Clipped and rescaled warping fields and noise scales, see
+        # `_scaled_warping_field`
+        self._scaled_warping_fields: dict[tuple, tuple[torch.Tensor, torch.Tensor]] = {}
         self._control_grid = None
 
         # Load or generate control grid; important to do this now before we might
@@ -166,6 +195,10 @@ class WanetBackdoor(Backdoor):
             raise ValueError("Control grid shape is incompatible.")
 
         self._control_grid = control_grid
+        # Warping fields depend on the control grid
+        self._warping_field = None
+        self._warping_fields = {}
+        self._scaled_warping_fields = {}
 
     def clone(
         self,
@@ -203,6 +236,10 @@ class WanetBackdoor(Backdoor):
 
     @property
     def warping_field(self) -> torch.Tensor:
+        """The warping field for the first image size that was initialized.
+
+        Fields for other image sizes are created as needed, see `_warping_fields`.
+        """
         if self._warping_field is None:
             raise AttributeError(
                 "Warping field not initialized, run init_warping_field first"
@@ -225,8 +262,30 @@ class WanetBackdoor(Backdoor):
         identity_grid = torch.stack((yy, xx), 2)
         field = identity_grid + field / torch.tensor([py, px]).reshape(1, 1, 2)
 
-        self._warping_field = field
-        assert self._warping_field.shape == (py, px, 2)
+        if self._warping_field is None:
+            self._warping_field = field
+        self._warping_fields[(py, px)] = field
+        assert field.shape == (py, px, 2)
+
+    def _scaled_warping_field(
+        self, py: int, px: int, device: torch.device, dtype: torch.dtype
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Get the clipped and rescaled warping field and the scale of noise.
+
+        Both are cached for each image size, device and dtype, so they're only
+        computed once instead of for every image.
+        """
+        key = (py, px, device, dtype, self.grid_rescale)
+        if key not in self._scaled_warping_fields:
+            if (py, px) not in self._warping_fields:
+                self.init_warping_field(px, py)
+            field = self._warping_fields[(py, px)].to(device=device, dtype=dtype)
+            field = torch.clip(field * self.grid_rescale, -1, 1)
+            noise_scale = self.grid_rescale / torch.tensor(
+                [py, px], device=device, dtype=dtype
+            ).reshape(1, 1, 2)
+            self._scaled_warping_fields[key] = (field, noise_scale)
+        return self._scaled_warping_fields[key]
 
     @staticmethod
     def _get_savefile_fullpath(basepath):
@@ -246,21 +305,19 @@ class WanetBackdoor(Backdoor):
                 "Images are expected to have two spatial dimensions and channels first."
             )
 
-        # Init warping field
-        try:
-            self.warping_field
-        except AttributeError:
+        # Init warping field, even if it isn't used for this sample
+        if (py, px) not in self._warping_fields:
             self.init_warping_field(px, py)
 
         rand_sample = torch.rand(1)
         if rand_sample <= self.p_noise + self.p_backdoor:
-            warping_field = torch.clip(self.warping_field * self.grid_rescale, -1, 1)
+            warping_field, noise_scale = self._scaled_warping_field(
+                py, px, img.device, img.dtype
+            )
             if rand_sample < self.p_noise:
                 # If noise mode
-                noise = 2 * torch.rand(*warping_field.shape) - 1
-                noise = (
-                    self.grid_rescale * noise / torch.tensor([py, px]).reshape(1, 1, 2)
-                )
+                noise = 2 * torch.rand_like(warping_field) - 1
+                noise = noise * noise_scale
 
                 warping_field = warping_field + noise
                 warping_field = torch.clip(warping_field, -1, 1)
@@ -276,3 +333,44 @@ class WanetBackdoor(Backdoor):
         assert img.shape == (cs, py, px)
 
         return img, target
+
+    def inject_batch(
+        self, batch: Tuple[torch.Tensor, torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Batched version of `__call__`, see `Backdoor.inject_batch`."""
+        imgs, labels = batch
+
+        if imgs.ndim == 4:
+            n, cs, py, px = imgs.shape
+        else:
+            raise ValueError(
+                "Images are expected to have a batch dimension, two spatial "
+                "dimensions and channels first."
+            )
+
+        if (py, px) not in self._warping_fields:
+            self.init_warping_field(px, py)
+
+        # Same sampling as in `__call__`, but independently for each sample
+        rand_sample = torch.rand(n, device=imgs.device)
+        warp = rand_sample <= self.p_noise + self.p_backdoor
+        noise_mode = rand_sample < self.p_noise
+
+        warping_field, noise_scale = self._scaled_warping_field(
+            py, px, imgs.device, imgs.dtype
+        )
+        warping_field = warping_field.expand(n, py, px, 2)
+        if noise_mode.any():
+            noise = (2 * torch.rand_like(warping_field) - 1) * noise_scale
+            warping_field = torch.where(
+                noise_mode[:, None, None, None],
+                torch.clip(warping_field + noise, -1, 1),
+                warping_field,
+            )
+
+        # Warp all images at once and keep the original ones where needed
+        warped = F.grid_sample(imgs, warping_field, align_corners=True)
+        imgs = torch.where(warp[:, None, None, None], warped, imgs)
+        labels = labels.masked_fill(warp & ~noise_mode, self.target_class)
+
+        return imgs, labels
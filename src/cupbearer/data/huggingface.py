@@ -1,19 +1,119 @@
+from typing import Any
+
 import datasets
 import torch
 
 
+class TokenizedText(str):
+    """A string that carries its token ids, see `HuggingfaceDataset.pretokenize`.
+
+    Behaves exactly like the original string, but `HuggingfaceLM` only needs to pad
+    the token ids instead of tokenizing. `tokenize_kwargs` are the arguments the
+    tokenizer was called with (e.g. for truncation), activation caches include them
+    in the cache key since they can change the activations.
+    """
+
+    input_ids: list[int]
+    tokenize_kwargs: dict[str, Any]
+
+    def __new__(
+        cls,
+        text: str,
+        input_ids: list[int],
+        tokenize_kwargs: dict[str, Any] | None = None,
+    ):
+        obj = super().__new__(cls, text)
+        obj.input_ids = input_ids
+        obj.tokenize_kwargs = tokenize_kwargs or {}
+        return obj
+
+    def __getnewargs__(self):
+        # Needed for pickling (e.g. in dataloader workers), since __new__ has
+        # required arguments besides the string itself.
+        return str(self), self.input_ids, self.tokenize_kwargs
+
+
 class HuggingfaceDataset(torch.utils.data.Dataset):
-    def __init__(self, hf_dataset, text_key="text", label_key="label"):
+    def __init__(
+        self,
+        hf_dataset,
+        text_key="text",
+        label_key="label",
+        input_ids_key: str | None = None,
+        tokenize_kwargs: dict[str, Any] | None = None,
+    ):
         self.hf_dataset = hf_dataset
         self.text_key = text_key
         self.label_key = label_key
+        # Column with token ids if the dataset has been pretokenized
+        self.input_ids_key = input_ids_key
+        # The arguments used for pretokenizing, see `TokenizedText`
+        self.tokenize_kwargs = tokenize_kwargs
 
     def __len__(self):
         return len(self.hf_dataset)
 
     def __getitem__(self, idx):
         sample = self.hf_dataset[idx]
-        return sample[self.text_key], sample[self.label_key]
+        text = sample[self.text_key]
+        if self.input_ids_key is not None:
+            text = TokenizedText(text, sample[self.input_ids_key], self.tokenize_kwargs)
+        return text, sample[self.label_key]
+
+    def inputs(self) -> list[str]:
+        # Reading a single column is much faster than loading all samples
+        texts = self.hf_dataset[self.text_key]
+        if self.input_ids_key is None:
+            return list(texts)
+        return [
+            TokenizedText(text, input_ids, self.tokenize_kwargs)
+            for text, input_ids in zip(texts, self.hf_dataset[self.input_ids_key])
+        ]
+
+    def pretokenize(
+        self,
+        tokenizer,
+        num_proc: int | None = None,
+        batch_size: int = 1000,
+        **tokenize_kwargs,
+    ) -> "HuggingfaceDataset":
+        """Tokenize all texts ahead of time and store the token ids in a new column.
+
+        This uses `datasets.Dataset.map`, so results are cached on disk like other
+        transformations of HF datasets, and repeated runs skip tokenization
+        entirely. Inputs of the new dataset are `TokenizedText`s, which
+        `HuggingfaceLM` only needs to pad. Padding should therefore not be part of
+        `tokenize_kwargs`, it happens per batch.
+
+        Args:
+            tokenizer: The tokenizer of the model the data will be used with.
+            num_proc: Number of processes to tokenize in.
+            batch_size: Number of texts to tokenize at once.
+            **tokenize_kwargs: Passed on to the tokenizer, e.g. for truncation.
+
+        Returns:
+            A new `HuggingfaceDataset` with the same samples.
+        """
+        text_key = self.text_key
+
+        def tokenize(batch):
+            tokens = tokenizer(batch[text_key], **tokenize_kwargs)
+            return {"input_ids": tokens["input_ids"]}
+
+        hf_dataset = self.hf_dataset.map(
+            tokenize,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            desc="Tokenizing",
+        )
+        return HuggingfaceDataset(
+            hf_dataset,
+            text_key=self.text_key,
+            label_key=self.label_key,
+            input_ids_key="input_ids",
+            tokenize_kwargs=tokenize_kwargs,
+        )
 
 
 class IMDBDataset(torch.utils.data.Dataset):
@@ -1,12 +1,20 @@
+import hashlib
+import os
 from dataclasses import dataclass, field
+from pathlib import Path
 
+import numpy as np
+import torch
 from loguru import logger
+from PIL.Image import Image as PILImage
 from torch.utils.data import Dataset
+from tqdm.auto import tqdm
 
 from cupbearer.utils import get_object
 
 from .transforms import (
     Normalize,
+    ProbabilisticTransform,
     RandomCrop,
     RandomHorizontalFlip,
     RandomRotation,
@@ -23,6 +31,17 @@ class PytorchDataset(Dataset):
     transforms: list[Transform] = field(default_factory=lambda: [ToTensor()])
     default_augmentations: bool = True
     normalize: bool = False  # N.B. may give unexpected results on some tasks
+    # If True, random augmentations aren't applied to individual samples. Instead,
+    # `augment_batch` needs to be applied to collated batches (e.g. by passing it
+    # as one of the `batch_transforms` of a `Classifier`).
+    batch_augmentations: bool = False
+    # If set, the deterministic transforms at the start of `transforms` up to the
+    # first `ToTensor` (i.e. `ToTensor`, optionally after `Resize`) are applied once
+    # and the results are stored in this directory as memory-mapped uint8 arrays.
+    # Later runs only apply the remaining transforms. Only supported for 8-bit
+    # images (PIL images or uint8 arrays), since anything else can't be stored
+    # losslessly.
+    preprocessed_dir: str | Path | None = None
 
     @property
     def raw_mean(self):
@@ -43,17 +62,146 @@ class PytorchDataset(Dataset):
             self.transforms.append(RandomCrop(p=0.8, padding=5))
             self.transforms.append(RandomRotation(p=0.5, degrees=10))
 
-        self._dataset = self._build()
+        # Memory-mapped preprocessed images and labels, opened lazily so that
+        # dataloader workers open their own maps instead of copying the arrays.
+        self._preprocessed: tuple[np.ndarray, np.ndarray] | None = None
+        self._num_preprocessed = 0
+        if self.preprocessed_dir is None:
+            self._dataset = self._build()
+            return
+
+        for transform in self.transforms:
+            if not isinstance(transform, (ToTensor, Resize)):
+                break
+            self._num_preprocessed += 1
+            # Transforms after this one (e.g. Resize) produce images that aren't
+            # 8-bit anymore, so we can't store their outputs losslessly.
+            if isinstance(transform, ToTensor):
+                break
+        if not self._num_preprocessed or not isinstance(
+            self.transforms[self._num_preprocessed - 1], ToTensor
+        ):
+            raise ValueError(
+                "preprocessed_dir requires transforms that start with ToTensor "
+                "(optionally after Resize), so that images are 8-bit."
+            )
+        # Don't even build (i.e. load or download) the dataset if we don't need it
+        self._dataset = None
+        if not self._preprocessed_paths()[0].exists():
+            self._preprocess(self._build())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_preprocessed"] = None
+        return state
+
+    def _preprocessed_paths(self) -> tuple[Path, Path]:
+        assert self.preprocessed_dir is not None
+        # Identifies the raw data and the transforms that were applied to it
+        description = f"{self.name}:{self._dataset_kws}:" + ",".join(
+            f"{type(t).__name__}{vars(t)}"
+            for t in self.transforms[: self._num_preprocessed]
+        )
+        digest = hashlib.blake2b(description.encode(), digest_size=8).hexdigest()
+        stem = Path(self.preprocessed_dir) / f"{self.name.split('.')[-1]}_{digest}"
+        return (
+            stem.with_name(stem.name + ".images.npy"),
+            stem.with_name(stem.name + ".labels.npy"),
+        )
+
+    def _preprocess(self, dataset: Dataset):
+        images_path, labels_path = self._preprocessed_paths()
+        images_path.parent.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Preprocessing {self.name} into {images_path}")
+
+        images = None
+        labels = np.empty(len(dataset), dtype=np.int64)  # type: ignore
+        # Write to temporary files first, so an interrupted run doesn't leave a
+        # partial cache behind.
+        tmp_images_path = images_path.with_name(images_path.name + ".tmp")
+        for i in tqdm(range(len(dataset)), desc="Preprocessing"):  # type: ignore
+            img, label = dataset[i]
+            if not isinstance(img, PILImage) and not (
+                isinstance(img, np.ndarray) and img.dtype == np.uint8
+            ):
+                # ToTensor only scales these to [0, 1], other images would be
+                # silently corrupted when storing them as uint8.
+                raise ValueError(
+                    f"Only 8-bit images can be preprocessed, got {type(img)}."
+                )
+            for transform in self.transforms[: self._num_preprocessed]:
+                img = transform(img)
+            if not isinstance(img, torch.Tensor):
+                raise ValueError(
+                    "Preprocessed images need to be tensors, include ToTensor."
+                )
+            if images is None:
+                images = np.lib.format.open_memmap(
+                    tmp_images_path,
+                    mode="w+",
+                    dtype=np.uint8,
+                    shape=(len(dataset), *img.shape),  # type: ignore
+                )
+            if img.shape != images.shape[1:]:
+                raise ValueError(
+                    f"All images need to have the same shape to be preprocessed, "
+                    f"got {tuple(img.shape)} and {images.shape[1:]}. Add a Resize."
+                )
+            # ToTensor scales 8-bit images to [0, 1], so this is lossless for them
+            images[i] = (img * 255).round().clamp(0, 255).to(torch.uint8).numpy()
+            labels[i] = label
+
+        assert images is not None, "Can't preprocess an empty dataset"
+        images.flush()
+        del images
+        np.save(labels_path, labels)
+        # Images are written last, their existence means the cache is complete.
+        os.replace(tmp_images_path, images_path)
+
+    def _preprocessed_arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._preprocessed is None:
+            images_path, labels_path = self._preprocessed_paths()
+            self._preprocessed = (
+                np.load(images_path, mmap_mode="r"),
+                np.load(labels_path),
+            )
+        return self._preprocessed
 
     def __len__(self):
+        if self.preprocessed_dir is not None:
+            return len(self._preprocessed_arrays()[1])
         return len(self._dataset)
 
     def __getitem__(self, index):
-        sample = self._dataset[index]
-        for transform in self.transforms:
+        if self.preprocessed_dir is None:
+            sample = self._dataset[index]
+        else:
+            images, labels = self._preprocessed_arrays()
+            img = torch.from_numpy(np.array(images[index])).float() / 255
+            sample = (img, int(labels[index]))
+
+        for transform in self.transforms[self._num_preprocessed :]:
+            if self.batch_augmentations and isinstance(
+                transform, ProbabilisticTransform
+            ):
+                continue
             sample = transform(sample)
         return sample
 
+    def augment_batch(self, batch: tuple[torch.Tensor, ...] | list[torch.Tensor]):
+        """Apply the random augmentations to a collated batch.
+
+        Only does something if `batch_augmentations` is True, in which case
+        `__getitem__` skips these augmentations. Augmentations are always applied
+        after all other transforms.
+        """
+        if not self.batch_augmentations:
+            return batch
+        for transform in self.transforms:
+            if isinstance(transform, ProbabilisticTransform):
+                batch = transform.__batch_call__(batch)
+        return batch
+
     @property
     def _dataset_kws(self):
         """The keyword arguments passed to the dataset constructor."""
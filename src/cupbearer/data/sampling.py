@@ -0,0 +1,116 @@
+import math
+from typing import Iterator, Sequence
+
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+from ._shared import _has_fast_inputs, dataset_inputs
+
+
+class LengthGroupedBatchSampler(Sampler[list[int]]):
+    """Batch sampler that puts samples of similar length into the same batch.
+
+    Samples are split into chunks of `mega_batch_size` consecutive samples (after
+    shuffling if `shuffle` is True). Within each chunk, samples are sorted by length
+    and then split into batches. With dynamic padding, this means batches are only
+    padded to about the length of their own samples. If `shuffle` is True, the
+    order of batches is randomized too. If not, batches roughly follow the order
+    of the dataset, so e.g. the first few batches only contain samples from the
+    start of the dataset.
+
+    Args:
+        lengths: The length of each sample (e.g. number of characters or tokens).
+        batch_size: Maximum number of samples per batch.
+        shuffle: Whether to shuffle samples and batches.
+        mega_batch_mult: Chunks contain `mega_batch_mult * batch_size` samples.
+            Larger chunks give more uniform lengths within batches.
+        generator: Random number generator for shuffling.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = False,
+        mega_batch_mult: int = 50,
+        generator: torch.Generator | None = None,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.mega_batch_mult = mega_batch_mult
+        self.generator = generator
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self) -> Iterator[list[int]]:
+        n = len(self.lengths)
+        if self.shuffle:
+            order = torch.randperm(n, generator=self.generator).tolist()
+        else:
+            order = list(range(n))
+
+        mega_batch_size = self.mega_batch_mult * self.batch_size
+        batches = []
+        for start in range(0, n, mega_batch_size):
+            # Longest samples first, so we run out of memory early if at all
+            chunk = sorted(
+                order[start : start + mega_batch_size],
+                key=lambda i: self.lengths[i],
+                reverse=True,
+            )
+            batches.extend(
+                chunk[i : i + self.batch_size]
+                for i in range(0, len(chunk), self.batch_size)
+            )
+
+        if self.shuffle:
+            permutation = torch.randperm(len(batches), generator=self.generator)
+            batches = [batches[i] for i in permutation.tolist()]
+        yield from batches
+
+
+def text_lengths(dataset: Dataset) -> list[int] | None:
+    """Get the length of each input if the inputs are strings.
+
+    This is the number of tokens for pretokenized inputs (see `TokenizedText`),
+    and the number of characters otherwise.
+
+    Returns None if the dataset doesn't contain text, or if getting its inputs
+    would require loading all samples (see `dataset_inputs`).
+    """
+    if not _has_fast_inputs(dataset):
+        return None
+    inputs = dataset_inputs(dataset)
+    if isinstance(inputs, torch.Tensor) or not all(isinstance(x, str) for x in inputs):
+        return None
+    return [len(getattr(x, "input_ids", x)) for x in inputs]
+
+
+def make_dataloader(
+    dataset: Dataset,
+    batch_size: int,
+    shuffle: bool = False,
+    group_by_length: bool | None = None,
+    **kwargs,
+) -> DataLoader:
+    """Create a dataloader, grouping text inputs of similar length into batches.
+
+    Args:
+        dataset: The dataset to load.
+        batch_size: The batch size.
+        shuffle: Whether to shuffle the data.
+        group_by_length: Whether to use a `LengthGroupedBatchSampler`. By default,
+            this is done for datasets with text inputs, see `text_lengths`. This
+            changes which samples end up in the same batch, so pass `False` when
+            batch composition matters (e.g. for batch-dependent anomaly scores).
+        **kwargs: Passed on to the `DataLoader`.
+    """
+    lengths = text_lengths(dataset) if group_by_length is not False else None
+    if group_by_length and lengths is None:
+        raise ValueError("Grouping by length is only supported for text datasets.")
+    if lengths is None:
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+    sampler = LengthGroupedBatchSampler(lengths, batch_size, shuffle=shuffle)
+    return DataLoader(dataset, batch_sampler=sampler, **kwargs)
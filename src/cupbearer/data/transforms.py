@@ -1,8 +1,10 @@
+import math
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Any, Optional
 
 import torch
+import torch.nn.functional as nnF
 import torchvision.transforms.functional as F
 from numpy import ndarray
 from PIL.Image import Image as PILImage
@@ -15,6 +17,17 @@ class Transform(ABC):
     def __call__(self, sample):
         pass
 
+    def __batch_call__(self, batch):
+        """Apply the transform to a collated batch of samples.
+
+        This lets transforms run once per batch (e.g. on the GPU) instead of once
+        per sample in dataloader workers. Random transforms still make independent
+        random choices for each sample.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} doesn't support batched application."
+        )
+
 
 class AdaptedTransform(Transform, ABC):
     """Adapt a transform designed to work on inputs to work on img, label pairs."""
@@ -44,6 +57,24 @@ class AdaptedTransform(Transform, ABC):
 
         return (img, *rest)
 
+    def __img_batch_call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        # Many transforms work on batches of images as is
+        return self.__img_call__(imgs)
+
+    def __batch_call__(self, batch: torch.Tensor | tuple | list):
+        # Collated batches are lists, but tuples are handled the same way
+        if isinstance(batch, (tuple, list)):
+            imgs, *rest = batch
+        else:
+            imgs = batch
+            rest = None
+
+        imgs = self.__img_batch_call__(imgs)
+
+        if rest is None:
+            return imgs
+        return (imgs, *self.__rest_call__(*rest))
+
 
 class ToTensor(AdaptedTransform):
     def __img_call__(self, img: PILImage | ndarray) -> torch.Tensor:
@@ -53,6 +84,9 @@ class ToTensor(AdaptedTransform):
             out = out.unsqueeze(0)
         return out
 
+    def __img_batch_call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError("ToTensor needs to be applied to individual images.")
+
 
 @dataclass
 class Normalize(AdaptedTransform):
@@ -99,6 +133,20 @@ class ProbabilisticTransform(AdaptedTransform, ABC):
             return super().__call__(sample)
         return sample
 
+    def __img_batch_call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        # Only transform the images for which the transform is active
+        apply = torch.rand(len(imgs), device=imgs.device) <= self.p
+        if apply.all():
+            return self._transform_batch(imgs)
+        imgs = imgs.clone()
+        if apply.any():
+            imgs[apply] = self._transform_batch(imgs[apply])
+        return imgs
+
+    def _transform_batch(self, imgs: torch.Tensor) -> torch.Tensor:
+        """Transform every image of a batch, with independent randomness."""
+        return torch.stack([self.__img_call__(img) for img in imgs])
+
 
 @dataclass(kw_only=True)
 class RandomCrop(ProbabilisticTransform):
@@ -125,6 +173,28 @@ class RandomCrop(ProbabilisticTransform):
         )
         return img
 
+    def _transform_batch(self, imgs: torch.Tensor) -> torch.Tensor:
+        n, _, height, width = imgs.shape
+        imgs = F.pad(
+            imgs,
+            padding=[self.padding],
+            fill=self.fill,
+            padding_mode=self.padding_mode,
+        )
+        # Same offsets as in `__img_call__`, but for each image separately
+        tops = torch.randint(0, self.padding, (n,), device=imgs.device)
+        lefts = torch.randint(0, self.padding, (n,), device=imgs.device)
+        rows = tops[:, None] + torch.arange(height, device=imgs.device)
+        cols = lefts[:, None] + torch.arange(width, device=imgs.device)
+        # Advanced indexing puts the (n, height, width) dimensions first
+        crops = imgs[
+            torch.arange(n, device=imgs.device)[:, None, None],
+            :,
+            rows[:, :, None],
+            cols[:, None, :],
+        ]
+        return crops.permute(0, 3, 1, 2)
+
 
 @dataclass(kw_only=True)
 class RandomRotation(ProbabilisticTransform):
@@ -145,6 +215,23 @@ class RandomRotation(ProbabilisticTransform):
             fill=self.fill,
         )
 
+    def _transform_batch(self, imgs: torch.Tensor) -> torch.Tensor:
+        if self.expand:
+            raise NotImplementedError(
+                "Rotations with expand=True change the image size, so they can't be "
+                "applied to batches."
+            )
+        if self.center is not None:
+            # Not vectorized, fall back to rotating each image separately
+            return super()._transform_batch(imgs)
+        angles = 2 * self.degrees * torch.rand(len(imgs), device=imgs.device)
+        return rotate_batch(
+            imgs,
+            angles - self.degrees,
+            interpolation=self.interpolation,
+            fill=self.fill,
+        )
+
 
 @dataclass(kw_only=True)
 class RandomHorizontalFlip(ProbabilisticTransform):
@@ -153,6 +240,9 @@ class RandomHorizontalFlip(ProbabilisticTransform):
     def __img_call__(self, img: torch.Tensor) -> torch.Tensor:
         return F.hflip(img)
 
+    def _transform_batch(self, imgs: torch.Tensor) -> torch.Tensor:
+        return imgs.flip(-1)
+
 
 @dataclass
 class GaussianNoise(AdaptedTransform):
@@ -168,3 +258,52 @@ class GaussianNoise(AdaptedTransform):
 
     def __img_call__(self, img: torch.Tensor) -> torch.Tensor:
         return img + self.std * torch.randn_like(img)
+
+
+def rotate_batch(
+    imgs: torch.Tensor,
+    angles: torch.Tensor,
+    interpolation: F.InterpolationMode = F.InterpolationMode.NEAREST,
+    fill: float | tuple[float, float, float] = 0,
+) -> torch.Tensor:
+    """Rotate each image of a batch around its center by its own angle.
+
+    Like `torchvision.transforms.functional.rotate`, but with a single
+    `affine_grid`/`grid_sample` call for the entire batch.
+
+    Args:
+        imgs: Images of shape (batch, channels, height, width).
+        angles: Counter-clockwise rotation angles in degrees, shape (batch, ).
+        interpolation: Either nearest or bilinear interpolation.
+        fill: Value for pixels outside the rotated image, either a single value or
+            one for each channel.
+    """
+    n, c, height, width = imgs.shape
+    radians = angles.to(imgs.dtype) * (math.pi / 180)
+    cos, sin = torch.cos(radians), torch.sin(radians)
+    # Maps output to input coordinates. affine_grid uses normalized coordinates,
+    # so the off-diagonal entries need to account for the aspect ratio.
+    theta = torch.zeros(n, 2, 3, device=imgs.device, dtype=imgs.dtype)
+    theta[:, 0, 0] = cos
+    theta[:, 0, 1] = -sin * height / width
+    theta[:, 1, 0] = sin * width / height
+    theta[:, 1, 1] = cos
+    grid = nnF.affine_grid(theta, [n, c, height, width], align_corners=False)
+
+    # Like torchvision, we sample an additional channel of ones to find out which
+    # pixels come from outside the input, and blend in the fill value there. For
+    # bilinear interpolation, this also darkens pixels at the border (even if
+    # `fill` is zero), so we need to do it to get the same results.
+    mask = torch.ones_like(imgs[:, :1])
+    out = nnF.grid_sample(
+        torch.cat([imgs, mask], dim=1),
+        grid,
+        mode=interpolation.value,
+        align_corners=False,
+    )
+    out, mask = out[:, :-1], out[:, -1:]
+    fill_tensor = torch.as_tensor(fill, device=imgs.device, dtype=imgs.dtype)
+    fill_tensor = fill_tensor.reshape(1, -1, 1, 1)
+    if interpolation == F.InterpolationMode.NEAREST:
+        return torch.where(mask < 0.5, fill_tensor, out)
+    return out * mask + (1 - mask) * fill_tensor
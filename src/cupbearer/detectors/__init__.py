@@ -1,8 +1,10 @@
 # ruff: noqa: F401
 from .abstraction import AbstractionDetector
-from .activation_based import ActivationBasedDetector, ActivationCache, CacheBuilder
+from .activation_based import ActivationBasedDetector, CacheBuilder
+from .activation_cache import ActivationCache, MemmapActivationCache
 from .anomaly_detector import AnomalyDetector
 from .finetuning import FinetuningAnomalyDetector
+from .multi_detector import MultiDetector
 from .statistical import (
     MahalanobisDetector,
     QuantumEntropyDetector,
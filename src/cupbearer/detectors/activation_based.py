@@ -1,143 +1,28 @@
-from collections import defaultdict
+import copy
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from queue import Full, Queue
 from typing import Any, Callable
 
 import torch
 import tqdm
-from torch.utils.data import Dataset
+from loguru import logger
+from torch.utils.data import Dataset, Subset
 
 from cupbearer import utils
-from cupbearer.data import MixedData
-
+from cupbearer.data import MixedData, make_dataloader
+
+from .activation_cache import (  # noqa: F401
+    ActivationCache,
+    CachedActivations,
+    MemmapActivationCache,
+    activation_fingerprint,
+)
 from .anomaly_detector import AnomalyDetector
 
-
-class ActivationCache:
-    """Cache for activations to speed up using multiple anomaly detectors.
-
-    The main use case for this is if the model is expensive to run and we want to try
-    many different detectors that require similar activations.
-
-    The cache stores a dict from (input, activation_name) to the activations.
-
-    WARNING: This cache is not safe to use across different models or activation
-    preprocessing functions! It does not attempt to track those, and using the same
-    cache with different model/preprocessors will likely result in incorrect results.
-    """
-
-    def __init__(self):
-        """Create an empty cache."""
-        self.cache: dict[tuple[Any, str], torch.Tensor] = {}
-        # Just for debugging purposes:
-        self.hits = 0
-        self.misses = 0
-
-    def __len__(self):
-        return len(self.cache)
-
-    def __contains__(self, key):
-        return key in self.cache
-
-    def count_missing(self, dataset: Dataset, activation_names: list[str]):
-        """Count how many inputs from `dataset` are missing from the cache.
-
-        `activation_names` is a list of the names of the activations we need to be
-        in the cache. An input counts as missing if *some* of the activations are
-        missing for that input.
-        """
-        count = 0
-        for sample in dataset:
-            if isinstance(dataset, MixedData) and dataset.return_anomaly_labels:
-                sample = sample[0]
-            if isinstance(sample, (tuple, list)) and len(sample) == 2:
-                sample = sample[0]
-            if not all((sample, name) in self.cache for name in activation_names):
-                count += 1
-        return count
-
-    def store(self, path: str | Path):
-        utils.save(self.cache, path)
-
-    @classmethod
-    def load(cls, path: str | Path):
-        cache = cls()
-        cache.cache = utils.load(path)
-        return cache
-
-    def get_activations(
-        self,
-        inputs,
-        activation_names: list[str],
-        activation_func: Callable[[Any], dict[str, torch.Tensor]],
-    ) -> dict[str, torch.Tensor]:
-        """Get activations for a batch of inputs, using the cache if possible.
-
-        If any activations are missing from the cache, they are computed and added
-        to the cache.
-
-        Args:
-            inputs: The inputs to get activations for.
-            activation_names: The names of the activations to get.
-            activation_func: Takes in `inputs` and returns a dictionary of activations.
-
-        Returns:
-            A dict from activation name to the activations.
-        """
-        # We want to handle cases where some but not all elements are in the cache.
-        missing_indices = []
-        results: dict[str, list[torch.Tensor | None]] = defaultdict(
-            lambda: [None] * len(inputs)
-        )
-
-        for i, input in enumerate(inputs):
-            # The keys into the cache contain the input and the name of the activation.
-            keys = [(input, name) for name in activation_names]
-            # In principle we could support the case where some but not all activations
-            # for a given input are already in the cache. If the missing activations
-            # are early in the model, this might save some time since we wouldn't
-            # have to do the full forward pass. But that seems like a niche use case
-            # and not worth the added complexity. So for now, we recompute all
-            # activations on inputs where some activations are missing.
-            if all(key in self.cache for key in keys):
-                self.hits += 1
-                for name in activation_names:
-                    results[name][i] = self.cache[(input, name)]
-            else:
-                missing_indices.append(i)
-
-        if not missing_indices:
-            return {name: torch.stack(results[name]) for name in activation_names}
-
-        # Select the missing input elements, but make sure to keep the type.
-        # Input could be a list/tuple of strings (for language models)
-        # or tensors for images. (Unclear whether supporting tensors is important,
-        # language models are the main case where having a cache is useful.)
-        if isinstance(inputs, torch.Tensor):
-            inputs = inputs[missing_indices]
-        elif isinstance(inputs, list):
-            inputs = [inputs[i] for i in missing_indices]
-        elif isinstance(inputs, tuple):
-            inputs = tuple(inputs[i] for i in missing_indices)
-        else:
-            raise NotImplementedError(
-                f"Unsupported input type: {type(inputs)} of {inputs}"
-            )
-
-        new_acts = activation_func(inputs)
-        self.misses += len(inputs)
-
-        # Fill in the missing activations
-        for name, act in new_acts.items():
-            for i, idx in enumerate(missing_indices):
-                results[name][idx] = act[i]
-                self.cache[(inputs[i], name)] = act[i]
-
-        assert all(
-            all(result is not None for result in results[name])
-            for name in activation_names
-        )
-
-        return {name: torch.stack(results[name]) for name in activation_names}
+# Marks the end of the batches in the prefetching queue
+_DONE = object()
 
 
 class ActivationBasedDetector(AnomalyDetector):
@@ -151,9 +36,17 @@ class ActivationBasedDetector(AnomalyDetector):
             the processed activations.
         cache: An ActivationCache to use for caching activations. If None (default),
             activations aren't cached. The cache is meant to be shared between multiple
-            detectors on the same model.
+            detectors. Cached activations are tagged with a fingerprint of the model
+            and `activation_processing_func`, so the cache can also be shared between
+            different models. Use a `MemmapActivationCache` if the activations don't
+            fit in memory.
         layer_aggregation: How to aggregate anomaly scores over layers to get a single
             global anomaly score. Options are "mean" (default) or "max".
+        prefetch: Number of upcoming batches to prepare in a background thread while
+            the current one is processed during training and evaluation. This loads
+            the batches as well as their cached activations (into pinned memory when
+            using a GPU), so it mainly helps with disk-backed caches. Only used if
+            `cache` is set.
     """
 
     def __init__(
@@ -163,16 +56,66 @@ class ActivationBasedDetector(AnomalyDetector):
         | None = None,
         cache: ActivationCache | None = None,
         layer_aggregation: str = "mean",
+        prefetch: int = 0,
     ):
         super().__init__(layer_aggregation=layer_aggregation)
         self.activation_names = activation_names
         self.activation_processing_func = activation_processing_func
         self.cache = cache
+        self.prefetch = prefetch
+        self._cache_fingerprint = None
+        # Hooks for getting activations, created once per model
+        self._capture: utils.ActivationCapture | None = None
+        # Model inputs of the current batch and their prefetched activations
+        self._prefetched: tuple[Any, CachedActivations] | None = None
+        # Model inputs of the current batch and activations that were already
+        # computed for them elsewhere, see `MultiDetector`
+        self._precomputed: tuple[Any, dict[str, torch.Tensor]] | None = None
+
+    def set_model(self, model: torch.nn.Module):
+        super().set_model(model)
+        self._cache_fingerprint = None
+        if self._capture is not None:
+            self._capture.remove()
+            self._capture = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Hooks can't be pickled, a new capture is created when needed
+        state["_capture"] = None
+        return state
+
+    @property
+    def cache_fingerprint(self) -> str:
+        """Fingerprint of the model and processing function used for the cache.
+
+        This is computed once per model, so if you modify the model weights in place
+        after calling `set_model`, you need to call `set_model` again.
+        """
+        if self._cache_fingerprint is None:
+            self._cache_fingerprint = activation_fingerprint(
+                self.model, self.activation_processing_func
+            )
+        return self._cache_fingerprint
 
-    def _get_activations_no_cache(self, inputs) -> dict[str, torch.Tensor]:
+    def _get_activations_no_cache(
+        self, inputs, activation_names: list[str] | None = None
+    ) -> dict[str, torch.Tensor]:
+        if activation_names is None:
+            activation_names = self.activation_names
         device = next(self.model.parameters()).device
         inputs = utils.inputs_to_device(inputs, device)
-        acts = utils.get_activations(self.model, self.activation_names, inputs)
+        capture = self._capture
+        if (
+            capture is None
+            or capture.model is not self.model
+            or not set(activation_names).issubset(capture.names)
+        ):
+            if capture is not None:
+                capture.remove()
+            names = list(dict.fromkeys(self.activation_names + activation_names))
+            self._capture = utils.ActivationCapture(self.model, names)
+        acts = self._capture.get_activations(activation_names, inputs)
 
         # Can be used to for example select activations at specific token positions
         if self.activation_processing_func is not None:
@@ -186,12 +129,98 @@ class ActivationBasedDetector(AnomalyDetector):
     def get_activations(self, batch) -> dict[str, torch.Tensor]:
         inputs = utils.inputs_from_batch(batch)
 
+        if self._precomputed is not None and self._precomputed[0] is inputs:
+            acts = self._precomputed[1]
+            self._precomputed = None
+            return acts
+
         if self.cache is None:
             return self._get_activations_no_cache(inputs)
 
-        return self.cache.get_activations(
-            inputs, self.activation_names, self._get_activations_no_cache
+        cached = None
+        if self._prefetched is not None and self._prefetched[0] is inputs:
+            cached = self._prefetched[1]
+            self._prefetched = None
+
+        acts = self.cache.get_activations(
+            inputs,
+            self.activation_names,
+            self._get_activations_no_cache,
+            fingerprint=self.cache_fingerprint,
+            cached=cached,
         )
+        # Disk-backed caches return activations on the CPU. If they were prefetched
+        # into pinned memory, this copy is asynchronous.
+        device = next(self.model.parameters()).device
+        return {k: v.to(device, non_blocking=True) for k, v in acts.items()}
+
+    def _iter_batches(self, batches, inputs_func=utils.inputs_from_batch):
+        if self.cache is None or self.prefetch <= 0:
+            yield from batches
+            return
+
+        cache = self.cache
+        fingerprint = self.cache_fingerprint
+        queue: Queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # Don't block forever if the consumer stopped early
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        def load():
+            try:
+                for batch in batches:
+                    if stop.is_set():
+                        return
+                    inputs = inputs_func(batch)
+                    cached = cache.lookup(
+                        inputs, self.activation_names, fingerprint, pin_memory=True
+                    )
+                    put((batch, inputs, cached))
+                put(_DONE)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, inputs, cached = item
+                # Picked up by `get_activations` if it's called with these inputs
+                self._prefetched = (inputs, cached)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            self._prefetched = None
+
+
+def _build_shard(
+    builder: "CacheBuilder",
+    datasets: list[tuple[Dataset, list[int], bool]],
+    path: Path,
+    batch_size: int,
+    device: str | None = None,
+):
+    # Runs in a worker process (or the main process if there's only one process).
+    # `builder` is a copy of the original builder with an empty cache.
+    if device is not None:
+        builder.model.to(device)
+    for data, indices, anomaly_labels in datasets:
+        builder._fill_cache(Subset(data, indices), batch_size, anomaly_labels)
+    assert builder.cache is not None
+    builder.cache.store(path)
 
 
 class CacheBuilder(ActivationBasedDetector):
@@ -201,6 +230,27 @@ class CacheBuilder(ActivationBasedDetector):
     get_activations() on it, the only advantage of this is that it implements the
     detector interface, so you can use it with the exact same dataloading setup as
     the real detector.
+
+    Building the cache can be split into shards. Each shard covers a contiguous
+    range of every dataset and is stored as a separate file in `shard_dir`, so a
+    crash only loses the unfinished shards: shards that already exist are skipped
+    when building again. Shards can be built in several worker processes, or in
+    separate jobs (e.g. a job array) using `shard_index`.
+
+    Args:
+        cache_path: Where to store the final cache.
+        activation_names: The names of the activations to cache.
+        activation_processing_func: See `ActivationBasedDetector`.
+        cache: The cache to fill, by default a new in-memory `ActivationCache`.
+        num_shards: Number of shards to split the data into. The default of 1 builds
+            the cache directly without any shard files.
+        shard_index: If given, only this shard is built (and stored in `shard_dir`),
+            without merging. Once all shards are done, call `merge_shards(split)`
+            with the split ("train" or "eval") that was built.
+        num_processes: Number of worker processes to build shards in. Only used
+            if `shard_index` is None.
+        devices: Devices to move the model to in the worker processes, assigned to
+            shards round-robin. By default, workers keep the model's device.
     """
 
     def __init__(
@@ -210,27 +260,132 @@ class CacheBuilder(ActivationBasedDetector):
         activation_processing_func: Callable[[torch.Tensor, Any, str], torch.Tensor]
         | None = None,
         cache: ActivationCache | None = None,
+        num_shards: int = 1,
+        shard_index: int | None = None,
+        num_processes: int = 1,
+        devices: list[str] | None = None,
     ):
         if cache is None:
             cache = ActivationCache()
         super().__init__(activation_names, activation_processing_func, cache=cache)
+        if shard_index is not None and not 0 <= shard_index < num_shards:
+            raise ValueError(
+                f"shard_index must be between 0 and {num_shards - 1}, "
+                f"got {shard_index}"
+            )
         self.cache_path = cache_path
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.num_processes = num_processes
+        self.devices = devices
+
+    @property
+    def shard_dir(self) -> Path:
+        path = Path(self.cache_path)
+        return path.parent / f"{path.stem}_shards"
+
+    def shard_path(self, split: str, index: int) -> Path:
+        return self.shard_dir / f"{split}_{index:05d}-of-{self.num_shards:05d}.pt"
 
     def store_cache(self):
         assert self.cache is not None
         self.cache.store(self.cache_path)
 
-    def train(self, trusted_data, untrusted_data, save_path, *, batch_size: int = 64):
-        for data in [trusted_data, untrusted_data]:
-            if data is None:
-                continue
-            dataloader = torch.utils.data.DataLoader(
-                data, batch_size=batch_size, shuffle=False
-            )
-            for batch in tqdm.tqdm(dataloader):
-                self.get_activations(batch)
+    def merge_shards(self, split: str):
+        """Merge the finished shards of a split into the cache and store it.
+
+        Only shards of `split` with the current number of shards are used, so e.g.
+        merging eval shards doesn't load the train shards again.
+        """
+        assert self.cache is not None
+        pattern = f"{split}_*-of-{self.num_shards:05d}.pt"
+        for path in sorted(self.shard_dir.glob(pattern)):
+            self.cache.update(ActivationCache.load(path))
         self.store_cache()
 
+    def _missing_indices(self, data: Dataset) -> list[int]:
+        # Only load samples whose activations aren't already cached
+        assert self.cache is not None
+        return self.cache.missing_indices(
+            data, self.activation_names, fingerprint=self.cache_fingerprint
+        )
+
+    def _fill_cache(self, data: Dataset, batch_size: int, anomaly_labels: bool):
+        dataloader = make_dataloader(data, batch_size=batch_size, shuffle=False)
+        for batch in tqdm.tqdm(dataloader):
+            if anomaly_labels:
+                # Remove anomaly labels
+                batch = batch[0]
+            self.get_activations(batch)
+
+    def _build(
+        self,
+        split: str,
+        datasets: list[tuple[Dataset, bool]],
+        batch_size: int,
+    ):
+        missing = [
+            (data, self._missing_indices(data), anomaly_labels)
+            for data, anomaly_labels in datasets
+        ]
+
+        if self.num_shards == 1:
+            for data, indices, anomaly_labels in missing:
+                self._fill_cache(Subset(data, indices), batch_size, anomaly_labels)
+            self.store_cache()
+            return
+
+        if self.shard_index is None:
+            shard_indices = list(range(self.num_shards))
+        else:
+            shard_indices = [self.shard_index]
+
+        jobs = []
+        for shard_index in shard_indices:
+            path = self.shard_path(split, shard_index)
+            if path.exists():
+                logger.info(f"Skipping shard {path}, it already exists")
+                continue
+            shard_datasets = []
+            for data, indices, anomaly_labels in missing:
+                # Shards are contiguous ranges of the entire dataset rather than of
+                # the missing indices, so they stay the same if the cache changes.
+                start = shard_index * len(data) // self.num_shards
+                end = (shard_index + 1) * len(data) // self.num_shards
+                shard = [i for i in indices if start <= i < end]
+                shard_datasets.append((data, shard, anomaly_labels))
+            device = None
+            if self.devices:
+                device = self.devices[shard_index % len(self.devices)]
+            jobs.append((shard_datasets, path, batch_size, device))
+
+        # Workers get their own empty caches, the shards are merged in the end.
+        # The fingerprint has already been computed above, so workers reuse it.
+        worker = copy.copy(self)
+        worker.cache = ActivationCache()
+
+        if self.num_processes == 1 or len(jobs) <= 1:
+            for shard_datasets, path, batch_size, _ in jobs:
+                # Use a new cache for every shard, but keep the model where it is
+                worker.cache = ActivationCache()
+                _build_shard(worker, shard_datasets, path, batch_size)
+        else:
+            context = torch.multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(self.num_processes, mp_context=context) as pool:
+                futures = [pool.submit(_build_shard, worker, *job) for job in jobs]
+                for future in futures:
+                    # Raise errors from the workers
+                    future.result()
+
+        if self.shard_index is None:
+            self.merge_shards(split)
+
+    def train(self, trusted_data, untrusted_data, save_path, *, batch_size: int = 64):
+        datasets = [
+            (data, False) for data in [trusted_data, untrusted_data] if data is not None
+        ]
+        self._build("train", datasets, batch_size)
+
     def eval(
         self,
         dataset: MixedData,
@@ -241,17 +396,7 @@ class CacheBuilder(ActivationBasedDetector):
         # when we assume that anomaly labels are included.
         assert isinstance(dataset, MixedData), type(dataset)
 
-        dataloader = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=batch_size,
-            shuffle=False,
-        )
-        for batch in tqdm.tqdm(dataloader):
-            # Remove anomaly labels
-            batch = batch[0]
-            self.get_activations(batch)
-
-        self.store_cache()
+        self._build("eval", [(dataset, True)], batch_size)
 
         return {}
 
@@ -0,0 +1,923 @@
+import functools
+import hashlib
+import itertools
+import math
+import os
+import shutil
+import threading
+import types
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+import torch
+from torch.utils.data import Dataset
+
+from cupbearer import utils
+from cupbearer.data import TokenizedText, dataset_inputs
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def input_key(input) -> str:
+    """Compute a stable, content-based cache key for a single input.
+
+    Strings are hashed via their UTF-8 encoding, tensors via their raw bytes together
+    with their shape and dtype. For `TokenizedText`, the tokenizer arguments (e.g.
+    truncation) are part of the key, unless there are none. Unlike the inputs
+    themselves, keys are cheap to hash and compare, and they are the same across
+    processes.
+    """
+    if isinstance(input, TokenizedText) and input.tokenize_kwargs:
+        kwargs = repr(sorted(input.tokenize_kwargs.items()))
+        return _digest(
+            b"str:" + input.encode("utf-8") + b"\0tokenize:" + kwargs.encode("utf-8")
+        )
+    if isinstance(input, str):
+        return _digest(b"str:" + input.encode("utf-8"))
+    if isinstance(input, torch.Tensor):
+        return input_keys(input.unsqueeze(0))[0]
+    raise TypeError(f"Can't compute cache key for input of type {type(input)}")
+
+
+def input_keys(inputs) -> list[str]:
+    """Compute cache keys for a batch of inputs, see `input_key`.
+
+    `inputs` can be a batched tensor or a list/tuple of strings or tensors.
+    For a batched tensor, the keys are the same as for each of its elements.
+    """
+    if not isinstance(inputs, torch.Tensor):
+        return [input_key(input) for input in inputs]
+
+    # Move the entire batch to the CPU at once instead of one sample at a time
+    inputs = inputs.detach().cpu().contiguous()
+    header = f"tensor:{inputs.dtype}:{tuple(inputs.shape[1:])}:".encode()
+    # Go through uint8 since numpy doesn't support all torch dtypes (bf16)
+    rows = inputs.reshape(len(inputs), -1).view(torch.uint8).numpy()
+    return [_digest(header + row.tobytes()) for row in rows]
+
+
+def model_fingerprint(model: torch.nn.Module, num_samples: int = 16) -> str:
+    """Compute a cheap fingerprint of a model's weights.
+
+    Hashes the name, shape and dtype of every parameter and buffer, together with
+    `num_samples` evenly spaced entries of each of them. This avoids transferring and
+    hashing all weights, but any realistic change to the model (different checkpoint,
+    finetuning, ...) will still change the fingerprint.
+
+    Models can override this by setting a `fingerprint` attribute to a string, e.g.
+    if the weights aren't actually loaded (see `HuggingfaceLM`).
+    """
+    fingerprint = getattr(model, "fingerprint", None)
+    if isinstance(fingerprint, str):
+        return fingerprint
+
+    h = hashlib.blake2b(digest_size=16)
+    tensors = itertools.chain(model.named_parameters(), model.named_buffers())
+    for name, tensor in tensors:
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}:".encode())
+        flat = tensor.detach().reshape(-1)
+        if flat.numel() == 0:
+            continue
+        indices = torch.linspace(
+            0, flat.numel() - 1, min(num_samples, flat.numel()), device=flat.device
+        ).long()
+        h.update(flat[indices].float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def function_fingerprint(func: Callable | None) -> str:
+    """Identify a (processing) function by its qualified name and its code.
+
+    For Python functions, this includes a digest of the bytecode, constants, default
+    arguments and the values captured by closures, so that e.g. two different
+    lambdas or two closures with different captured values get different
+    fingerprints. For `functools.partial` objects, the bound arguments are included
+    as well. Other functions that are called by `func` aren't included.
+    """
+    if func is None:
+        return "None"
+    if isinstance(func, functools.partial):
+        inner = function_fingerprint(func.func)
+        return f"partial({inner}, {func.args!r}, {func.keywords!r})"
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", type(func).__qualname__)
+    name = f"{module}.{qualname}"
+    code = getattr(func, "__code__", None)
+    if code is None:
+        # E.g. builtins, which can't change
+        return name
+    closure = getattr(func, "__closure__", None) or ()
+    parts = [
+        _code_fingerprint(code),
+        _value_fingerprint(getattr(func, "__defaults__", None)),
+        _value_fingerprint(getattr(func, "__kwdefaults__", None)),
+        *(_value_fingerprint(cell.cell_contents) for cell in closure),
+    ]
+    return f"{name}:{_digest(chr(0).join(parts).encode())}"
+
+
+def _code_fingerprint(code: types.CodeType) -> str:
+    consts = [
+        _code_fingerprint(c) if isinstance(c, types.CodeType) else repr(c)
+        for c in code.co_consts
+    ]
+    return _digest(code.co_code + repr((consts, code.co_names)).encode())
+
+
+def _value_fingerprint(value: Any) -> str:
+    # Values captured by processing functions, e.g. the index of a token
+    if isinstance(value, torch.Tensor):
+        return input_key(value)
+    if callable(value):
+        return function_fingerprint(value)
+    if isinstance(value, (tuple, list)):
+        return repr([_value_fingerprint(v) for v in value])
+    if isinstance(value, dict):
+        return repr({k: _value_fingerprint(v) for k, v in value.items()})
+    return repr(value)
+
+
+def _parse_storage_dtype(storage_dtype: torch.dtype | str | None):
+    if isinstance(storage_dtype, str):
+        storage_dtype = getattr(torch, storage_dtype, None)
+    if storage_dtype is None:
+        return None
+    if not isinstance(storage_dtype, torch.dtype) or not (
+        storage_dtype.is_floating_point or storage_dtype == torch.int8
+    ):
+        raise ValueError(
+            f"storage_dtype must be a floating point dtype or int8, got {storage_dtype}"
+        )
+    return storage_dtype
+
+
+def _storage_dtype_for(dtype: torch.dtype, storage_dtype: torch.dtype | None):
+    # Only floating point activations are stored with reduced precision
+    if storage_dtype is None or not dtype.is_floating_point:
+        return dtype
+    return storage_dtype
+
+
+def _scale_shape(shape: tuple[int, ...]) -> tuple[int, ...]:
+    # Shape of the int8 scales for a single entry, see `ActivationCache`
+    return (shape[-1],) if len(shape) >= 2 else (1,)
+
+
+def _expand_scales(scales: torch.Tensor, ndim: int) -> torch.Tensor:
+    # Make a batch of scales broadcastable to a batch of activations with `ndim` dims
+    if ndim == 1:
+        return scales.view(-1)
+    return scales.view(len(scales), *([1] * (ndim - 2)), -1)
+
+
+def _encode(
+    activations: torch.Tensor, storage_dtype: torch.dtype
+) -> tuple[torch.Tensor, torch.Tensor | None]:
+    """Convert a batch of activations to `storage_dtype`.
+
+    Returns the converted activations and, for int8, the scales.
+    """
+    if storage_dtype != torch.int8:
+        return activations.to(storage_dtype), None
+
+    x = activations.float()
+    if x.ndim > 2:
+        # One scale per channel, shared by all other dimensions of an entry
+        absmax = x.abs().flatten(1, -2).amax(dim=1)
+    else:
+        absmax = x.abs().reshape(len(x), -1).amax(dim=1, keepdim=True)
+    # Avoid dividing by zero for all-zero entries
+    scales = (absmax / 127).clamp_min(torch.finfo(torch.float32).tiny)
+    data = (x / _expand_scales(scales, x.ndim)).round().clamp(-127, 127)
+    return data.to(torch.int8), scales
+
+
+def _decode(
+    data: torch.Tensor, scales: torch.Tensor | None, dtype: torch.dtype
+) -> torch.Tensor:
+    """Inverse of `_encode`, converts back to the original `dtype`."""
+    if scales is None:
+        return data.to(dtype)
+    return (data.float() * _expand_scales(scales, data.ndim)).to(dtype)
+
+
+class _EncodedActivation(NamedTuple):
+    # An in-memory cache entry stored with reduced precision
+    data: torch.Tensor
+    scales: torch.Tensor | None
+    dtype: torch.dtype
+
+    def decode(self) -> torch.Tensor:
+        scales = None if self.scales is None else self.scales[None]
+        return _decode(self.data[None], scales, self.dtype)[0]
+
+    def clone(self) -> "_EncodedActivation":
+        scales = None if self.scales is None else self.scales.clone()
+        return _EncodedActivation(self.data.clone(), scales, self.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.data.numel() * self.data.element_size()
+        if self.scales is not None:
+            nbytes += self.scales.numel() * self.scales.element_size()
+        return nbytes
+
+
+def _nbytes(entry: torch.Tensor | _EncodedActivation) -> int:
+    if isinstance(entry, _EncodedActivation):
+        return entry.nbytes
+    return entry.numel() * entry.element_size()
+
+
+def _decode_entry(entry: torch.Tensor | _EncodedActivation) -> torch.Tensor:
+    if isinstance(entry, _EncodedActivation):
+        return entry.decode()
+    return entry
+
+
+@dataclass
+class CachedActivations:
+    """Activations read from a cache for a batch of inputs, see `lookup`.
+
+    Attributes:
+        keys: The input keys of the batch (see `input_keys`).
+        results: For each activation name, the cached activation for every input,
+            or None if it's missing.
+        stacked: Stacked activations for the names that are cached for all inputs.
+    """
+
+    keys: list[str]
+    results: dict[str, list[torch.Tensor | None]]
+    stacked: dict[str, torch.Tensor]
+
+
+def activation_fingerprint(
+    model: torch.nn.Module, activation_processing_func: Callable | None = None
+) -> str:
+    """Fingerprint for everything that activations in a cache depend on (except inputs).
+
+    Combines the fingerprint of the model weights and the identity of the activation
+    processing function. Activation names are tracked separately by the cache.
+    """
+    parts = [model_fingerprint(model), function_fingerprint(activation_processing_func)]
+    return _digest("\n".join(parts).encode())
+
+
+def _stack(
+    name: str,
+    activations: list[torch.Tensor],
+    device: torch.device | None = None,
+    out: torch.Tensor | None = None,
+) -> torch.Tensor:
+    shapes = {a.shape for a in activations}
+    if len(shapes) > 1:
+        raise ValueError(
+            f"Activations for {name} have different shapes {sorted(shapes)} for "
+            "different inputs, so they can't be batched. This can happen with "
+            "dynamic padding, see `HuggingfaceLM`."
+        )
+    if out is not None:
+        return torch.stack(activations, out=out)
+    return torch.stack([a.to(device) for a in activations])
+
+
+class ActivationCache:
+    """Cache for activations to speed up using multiple anomaly detectors.
+
+    The main use case for this is if the model is expensive to run and we want to try
+    many different detectors that require similar activations.
+
+    The cache stores a dict from (input_key, activation_name) to the activations,
+    where input_key is a digest of the input's content (see `input_key`). So cached
+    activations can be found again for equal inputs, even if they are different
+    objects or were created in a different process.
+
+    Entries can additionally be namespaced by a fingerprint of the model and
+    activation processing function (see `activation_fingerprint`), which
+    `ActivationBasedDetector` does automatically. Entries with a different fingerprint
+    are never returned, so a single cache can be shared between experiments with
+    different models or processing functions. Processing functions are identified by
+    their own code and captured values (see `function_fingerprint`), but not by the
+    code of other functions they call.
+
+    WARNING: If you call `get_activations` without a fingerprint, the cache can't tell
+    models or activation preprocessing functions apart. Using the same cache with
+    different model/preprocessors will then likely result in incorrect results.
+
+    Activations with the same name need to have the same shape for every input, since
+    they are stacked into batches. In particular, sequence activations of language
+    models with dynamic padding (padded to the longest input of each batch) can't be
+    cached as is, see `HuggingfaceLM`.
+
+    Args:
+        max_bytes: If not None, the total size of the cached activations is limited
+            to this many bytes. When the limit is exceeded, the least recently used
+            entries are evicted. Entries are copied when they are added in that case,
+            so that evicting them actually frees the memory.
+        spill: If given, evicted entries are moved to this (disk-backed) cache
+            instead of being dropped, and are still used for lookups.
+        storage_dtype: If given, floating point activations are stored with this
+            dtype to save memory (and disk space), and converted back to their
+            original dtype when they are read. Can be a lower precision float type
+            such as `torch.float16` or `"bfloat16"`, or `torch.int8`. Int8
+            activations are quantized symmetrically with one scale per channel (the
+            last dimension) for multi-dimensional activations, or one scale per
+            entry for vectors.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int | None = None,
+        spill: "MemmapActivationCache | None" = None,
+        storage_dtype: torch.dtype | str | None = None,
+    ):
+        """Create an empty cache."""
+        self.cache: OrderedDict[
+            tuple[str, str], torch.Tensor | _EncodedActivation
+        ] = OrderedDict()
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.storage_dtype = _parse_storage_dtype(storage_dtype)
+        self._num_bytes = 0
+        # Statistics, see `stats`
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+        # Lookups can happen in a background thread, see `lookup`
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.cache)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters for monitoring how well the cache works.
+
+        `hits` and `misses` count inputs for which all activations were cached or
+        at least one had to be computed, respectively. `evictions` counts entries
+        (i.e. single activations) evicted because of the memory limit, and
+        `spill_hits` entries that were read back from the spill cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "spill_hits": self.spill_hits,
+            "entries": len(self),
+            "bytes": self._num_bytes,
+        }
+
+    def __contains__(self, item):
+        input, name = item
+        return self._has(input_key(input), name)
+
+    # The following methods are the storage backend. Subclasses that store
+    # activations somewhere other than an in-memory dict only need to override these.
+    # They all take keys computed by `input_key(s)` rather than raw inputs.
+
+    def _has(self, key: str, name: str) -> bool:
+        if (key, name) in self.cache:
+            return True
+        return self.spill is not None and self.spill._has(key, name)
+
+    def _get(self, key: str, name: str) -> torch.Tensor:
+        if (key, name) in self.cache:
+            if self.max_bytes is not None:
+                # Mark as most recently used
+                self.cache.move_to_end((key, name))
+            return _decode_entry(self.cache[(key, name)])
+        assert self.spill is not None
+        self.spill_hits += 1
+        return self.spill._get(key, name)
+
+    def _put_batch(self, keys: list[str], name: str, activations: torch.Tensor):
+        storage_dtype = _storage_dtype_for(activations.dtype, self.storage_dtype)
+        if storage_dtype == activations.dtype:
+            entries = list(activations)
+        else:
+            data, scales = _encode(activations, storage_dtype)
+            entries = [
+                _EncodedActivation(
+                    data[i], None if scales is None else scales[i], activations.dtype
+                )
+                for i in range(len(data))
+            ]
+        for key, entry in zip(keys, entries):
+            if self.max_bytes is not None:
+                # Otherwise, the entry would keep the entire batch alive
+                entry = entry.clone()
+            self._insert(key, name, entry)
+        self._evict()
+
+    def _insert(
+        self, key: str, name: str, activation: torch.Tensor | _EncodedActivation
+    ):
+        old = self.cache.pop((key, name), None)
+        if old is not None:
+            self._num_bytes -= _nbytes(old)
+        self.cache[(key, name)] = activation
+        self._num_bytes += _nbytes(activation)
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        evicted: dict[str, list[tuple[str, torch.Tensor]]] = defaultdict(list)
+        while self._num_bytes > self.max_bytes and self.cache:
+            (key, name), entry = self.cache.popitem(last=False)
+            self._num_bytes -= _nbytes(entry)
+            self.evictions += 1
+            evicted[name].append((key, _decode_entry(entry)))
+
+        if self.spill is None:
+            return
+        # Write evicted entries in one batch per name, that's much faster
+        # for disk-backed caches than writing them one by one.
+        for name, entries in evicted.items():
+            keys = [key for key, _ in entries]
+            self.spill._put_batch(keys, name, torch.stack([a for _, a in entries]))
+
+    def _batches(self):
+        """Iterate over all entries as (name, keys, stacked activations) per name."""
+        entries: dict[str, list[tuple[str, torch.Tensor]]] = defaultdict(list)
+        for (key, name), entry in self.cache.items():
+            entries[name].append((key, _decode_entry(entry)))
+        for name, name_entries in entries.items():
+            keys = [key for key, _ in name_entries]
+            yield name, keys, torch.stack([a for _, a in name_entries])
+        if self.spill is not None:
+            yield from self.spill._batches()
+
+    def update(self, other: "ActivationCache"):
+        """Add all entries from `other` to this cache, e.g. to merge cache shards.
+
+        Fingerprints are part of the stored activation names, so they are preserved.
+        Entries that are in both caches should be identical, so it doesn't matter
+        which of them is kept.
+        """
+        for name, keys, activations in other._batches():
+            self._put_batch(keys, name, activations)
+
+    @staticmethod
+    def _stored_name(name: str, fingerprint: str | None) -> str:
+        if fingerprint is None:
+            return name
+        return f"{name}@{fingerprint}"
+
+    def missing_key_indices(
+        self,
+        keys: list[str],
+        activation_names: list[str],
+        fingerprint: str | None = None,
+    ) -> list[int]:
+        """Find which of the given input keys (see `input_key`) are missing.
+
+        An input counts as missing if *some* of the activations are missing for it.
+        `fingerprint` should be the same as the one passed to `get_activations`.
+
+        Returns:
+            The indices into `keys` of the missing inputs.
+        """
+        stored_names = [
+            self._stored_name(name, fingerprint) for name in activation_names
+        ]
+        return [
+            i
+            for i, key in enumerate(keys)
+            if not all(self._has(key, name) for name in stored_names)
+        ]
+
+    def missing_indices(
+        self,
+        dataset: Dataset,
+        activation_names: list[str],
+        fingerprint: str | None = None,
+    ) -> list[int]:
+        """Find the inputs from `dataset` that are missing from the cache.
+
+        This only looks at the inputs, skipping labels and (for datasets that support
+        it, see `data.dataset_inputs`) without loading entire samples. Use
+        `torch.utils.data.Subset(dataset, missing_indices)` to compute activations
+        only for the missing inputs.
+
+        See `missing_key_indices` for details.
+        """
+        keys = input_keys(dataset_inputs(dataset))
+        return self.missing_key_indices(keys, activation_names, fingerprint)
+
+    def count_missing(
+        self,
+        dataset: Dataset,
+        activation_names: list[str],
+        fingerprint: str | None = None,
+    ):
+        """Count how many inputs from `dataset` are missing from the cache.
+
+        See `missing_indices` for details.
+        """
+        return len(self.missing_indices(dataset, activation_names, fingerprint))
+
+    def store(self, path: str | Path):
+        """Store the in-memory entries. Spilled entries stay in the spill cache."""
+        utils.save(dict(self.cache), path)
+        if self.spill is not None:
+            self.spill.flush()
+
+    @classmethod
+    def load(cls, path: str | Path, **kwargs):
+        """Load a stored cache, `kwargs` are passed to the constructor."""
+        cache = cls(**kwargs)
+        for (key, name), activation in utils.load(path).items():
+            if not isinstance(key, str) or not cls._is_key(key):
+                # Caches stored by older versions used the raw inputs as keys
+                key = input_key(key)
+            if isinstance(activation, tuple):
+                # Stored with reduced precision (named tuples are saved as tuples)
+                activation = _EncodedActivation(*activation)
+            cache._insert(key, name, activation)
+        cache._evict()
+        return cache
+
+    @staticmethod
+    def _is_key(key: str) -> bool:
+        return len(key) == 32 and all(c in "0123456789abcdef" for c in key)
+
+    def lookup(
+        self,
+        inputs,
+        activation_names: list[str],
+        fingerprint: str | None = None,
+        pin_memory: bool = False,
+    ) -> CachedActivations:
+        """Read the cached activations for a batch of inputs, without computing any.
+
+        This is thread-safe, so it can be used to load activations for upcoming
+        batches in a background thread (see `ActivationBasedDetector`). The result
+        can be passed to `get_activations` to avoid reading the activations again.
+
+        Args:
+            inputs: The inputs to get activations for.
+            activation_names: The names of the activations to get.
+            fingerprint: See `get_activations`.
+            pin_memory: If True (and CUDA is available), activations that are cached
+                on the CPU for the entire batch are read into pinned memory, so they
+                can be copied to the GPU asynchronously.
+        """
+        keys = input_keys(inputs)
+        results: dict[str, list[torch.Tensor | None]] = {}
+        with self._lock:
+            for name in activation_names:
+                stored_name = self._stored_name(name, fingerprint)
+                results[name] = [
+                    self._get(key, stored_name) if self._has(key, stored_name) else None
+                    for key in keys
+                ]
+
+        # Stacking also reads the activations from disk for disk-backed caches,
+        # so this doesn't need to happen later when they are used.
+        stacked = {}
+        for name, result in results.items():
+            if any(r is None for r in result):
+                continue
+            if (
+                pin_memory
+                and torch.cuda.is_available()
+                and all(r.device.type == "cpu" for r in result)
+            ):
+                out = torch.empty(
+                    (len(result), *result[0].shape),
+                    dtype=result[0].dtype,
+                    pin_memory=True,
+                )
+                stacked[name] = _stack(name, result, out=out)
+            else:
+                stacked[name] = _stack(name, result, result[0].device)
+        return CachedActivations(keys, results, stacked)
+
+    def get_activations(
+        self,
+        inputs,
+        activation_names: list[str],
+        activation_func: Callable[[Any, list[str]], dict[str, torch.Tensor]],
+        fingerprint: str | None = None,
+        cached: CachedActivations | None = None,
+    ) -> dict[str, torch.Tensor]:
+        """Get activations for a batch of inputs, using the cache if possible.
+
+        If any activations are missing from the cache, they are computed and added
+        to the cache. Only the missing activations are computed, on only the inputs
+        for which they are missing.
+
+        Args:
+            inputs: The inputs to get activations for.
+            activation_names: The names of the activations to get.
+            activation_func: Takes in a subset of `inputs` and a list of activation
+                names and returns a dictionary containing those activations.
+            fingerprint: Identifies the model and activation processing that
+                `activation_func` uses (see `activation_fingerprint`). Only entries
+                stored with the same fingerprint are used. If None, only entries
+                stored without a fingerprint are used.
+            cached: The result of `lookup` for the same arguments, if it has
+                already been called (e.g. to prefetch activations).
+
+        Returns:
+            A dict from activation name to the activations.
+        """
+        if cached is None:
+            cached = self.lookup(inputs, activation_names, fingerprint)
+        assert set(cached.results) == set(activation_names)
+        keys = cached.keys
+        # We want to handle cases where some but not all elements are in the cache,
+        # and where only some activations are cached for an input.
+        results = cached.results
+        # Inputs grouped by which activations are missing for them. Usually there's
+        # just a single group (e.g. a newly added layer is missing for all inputs).
+        missing_groups: dict[tuple[str, ...], list[int]] = defaultdict(list)
+
+        hits = 0
+        for i in range(len(keys)):
+            missing_names = tuple(
+                name for name in activation_names if results[name][i] is None
+            )
+            if missing_names:
+                missing_groups[missing_names].append(i)
+            else:
+                hits += 1
+        # Statistics are shared with prefetching threads, like the entries
+        with self._lock:
+            self.hits += hits
+
+        if not missing_groups:
+            return {name: cached.stacked[name] for name in activation_names}
+
+        device = None
+        for missing_names, missing_indices in missing_groups.items():
+            # We only compute the missing activations. Since the forward pass stops
+            # once all requested activations have been computed, this means we only
+            # need to run the model up to the deepest missing activation.
+            new_acts = activation_func(
+                self._select(inputs, missing_indices), list(missing_names)
+            )
+            with self._lock:
+                self.misses += len(missing_indices)
+
+            # Fill in the missing activations
+            missing_keys = [keys[i] for i in missing_indices]
+            for name in missing_names:
+                act = new_acts[name]
+                device = act.device
+                with self._lock:
+                    self._put_batch(
+                        missing_keys, self._stored_name(name, fingerprint), act
+                    )
+                for i, idx in enumerate(missing_indices):
+                    results[name][idx] = act[i]
+
+        assert all(
+            all(result is not None for result in results[name])
+            for name in activation_names
+        )
+
+        # Cached activations might live on a different device than the newly computed
+        # ones (e.g. for disk-backed caches), so we move everything to the latter.
+        return {
+            name: cached.stacked[name].to(device)
+            if name in cached.stacked
+            else _stack(name, results[name], device)
+            for name in activation_names
+        }
+
+    @staticmethod
+    def _select(inputs, indices: list[int]):
+        # Select some of the input elements, but make sure to keep the type.
+        # Input could be a list/tuple of strings (for language models)
+        # or tensors for images.
+        if isinstance(inputs, torch.Tensor):
+            return inputs[indices]
+        elif isinstance(inputs, list):
+            return [inputs[i] for i in indices]
+        elif isinstance(inputs, tuple):
+            return tuple(inputs[i] for i in indices)
+        raise NotImplementedError(f"Unsupported input type: {type(inputs)} of {inputs}")
+
+
+class MemmapActivationCache(ActivationCache):
+    """Disk-backed activation cache for datasets whose activations don't fit in RAM.
+
+    Activations for each activation name are stored as rows of a single contiguous
+    binary file inside the cache directory, and a small index maps input keys
+    (see `input_key`) to rows.
+    Opening a cache only loads that index; the activation files are memory-mapped,
+    so a batch only pages in the rows it actually uses.
+
+    New activations are appended to the files immediately, but the index is only
+    written by `store()` (or `flush()`). Rows that were written after the last flush
+    are discarded when the cache is opened again.
+
+    All activations for a given name must have the same shape and dtype (excluding
+    the batch dimension). Cached activations are returned on the CPU.
+
+    The same caveats about models and preprocessing functions as for
+    `ActivationCache` apply.
+
+    Args:
+        path: Directory in which the cache is stored. If it already contains a cache,
+            that cache is opened, otherwise a new empty one is created.
+        storage_dtype: See `ActivationCache`. This only applies to activation names
+            that aren't in the cache yet, existing ones keep their storage dtype.
+            Int8 scales are stored in a separate file.
+    """
+
+    INDEX_FILE = "index.pt"
+    # Rows per batch when iterating over all entries, see `_batches`
+    BATCH_ROWS = 4096
+
+    def __init__(
+        self, path: str | Path, storage_dtype: torch.dtype | str | None = None
+    ):
+        super().__init__(storage_dtype=storage_dtype)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Shape (excluding batch dimension), dtype and storage dtype of each
+        # activation name
+        self._specs: dict[str, tuple[tuple[int, ...], torch.dtype, torch.dtype]] = {}
+        # For each activation name, a dict from input key to row in the activation file
+        self._rows: dict[str, dict[str, int]] = {}
+        # Memory-mapped views of the activation (and scale) files, created lazily
+        self._maps: dict[Path, torch.Tensor] = {}
+
+        if (self.path / self.INDEX_FILE).exists():
+            self._read_index()
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows.values())
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # Memory maps get recreated lazily after unpickling
+        state["_maps"] = {}
+        return state
+
+    def _files(self, name: str) -> list[tuple[Path, tuple[int, ...], torch.dtype]]:
+        # Path, row shape and dtype of the activation file, and the scale file if the
+        # activations are quantized to int8
+        shape, dtype, storage_dtype = self._specs[name]
+        files = [(self.path / f"{name}.bin", shape, storage_dtype)]
+        if storage_dtype == torch.int8 and dtype != torch.int8:
+            files.append(
+                (self.path / f"{name}.scales.bin", _scale_shape(shape), torch.float32)
+            )
+        return files
+
+    def _read_index(self):
+        index = utils.load(self.path / self.INDEX_FILE)
+        for name, spec in index["specs"].items():
+            shape = tuple(spec["shape"])
+            dtype = getattr(torch, spec["dtype"])
+            # Caches written by older versions don't have a storage dtype
+            storage_dtype = getattr(torch, spec.get("storage_dtype", spec["dtype"]))
+            keys = index["keys"][name]
+            self._specs[name] = (shape, dtype, storage_dtype)
+            self._rows[name] = {key: row for row, key in enumerate(keys)}
+            # Throw away rows that were appended after the index was last written,
+            # otherwise new rows would end up at the wrong offsets.
+            for path, row_shape, file_dtype in self._files(name):
+                if not keys and not path.exists():
+                    # Nothing was ever written for this activation
+                    continue
+                element_size = torch.empty((), dtype=file_dtype).element_size()
+                row_bytes = math.prod(row_shape) * element_size
+                os.truncate(path, len(keys) * row_bytes)
+
+    def flush(self):
+        """Write the index to disk, making all activations added so far persistent."""
+        index = {
+            "specs": {
+                name: {
+                    "shape": list(shape),
+                    "dtype": str(dtype).split(".")[-1],
+                    "storage_dtype": str(storage_dtype).split(".")[-1],
+                }
+                for name, (shape, dtype, storage_dtype) in self._specs.items()
+            },
+            # Row order is the insertion order of the dicts
+            "keys": {name: list(rows.keys()) for name, rows in self._rows.items()},
+        }
+        utils.save(index, self.path / self.INDEX_FILE, overwrite=True)
+
+    def _mapped(self, name: str) -> list[torch.Tensor]:
+        """Memory-mapped activations (and scales if quantized) for `name`."""
+        num_rows = len(self._rows[name])
+        maps = []
+        for path, shape, dtype in self._files(name):
+            mapped = self._maps.get(path)
+            if mapped is None or len(mapped) < num_rows:
+                # The file has grown since we last mapped it (or was never mapped)
+                mapped = torch.from_file(
+                    str(path),
+                    shared=False,
+                    size=num_rows * math.prod(shape),
+                    dtype=dtype,
+                ).view(num_rows, *shape)
+                self._maps[path] = mapped
+            maps.append(mapped)
+        return maps
+
+    def _decode_rows(self, name: str, rows) -> torch.Tensor:
+        _, dtype, storage_dtype = self._specs[name]
+        maps = self._mapped(name)
+        if storage_dtype == dtype:
+            # Indexing a single row is a view into the memory map, so no copy happens
+            return maps[0][rows]
+        scales = maps[1][rows] if len(maps) > 1 else None
+        return _decode(maps[0][rows], scales, dtype)
+
+    def _has(self, key: str, name: str) -> bool:
+        return name in self._rows and key in self._rows[name]
+
+    def _get(self, key: str, name: str) -> torch.Tensor:
+        row = self._rows[name][key]
+        # Decode a batch of one row, so that scales broadcast correctly
+        return self._decode_rows(name, slice(row, row + 1))[0]
+
+    def _put_batch(self, keys: list[str], name: str, activations: torch.Tensor):
+        activations = activations.detach().cpu().contiguous()
+        shape, dtype = tuple(activations.shape[1:]), activations.dtype
+        if name not in self._specs:
+            storage_dtype = _storage_dtype_for(dtype, self.storage_dtype)
+            self._specs[name] = (shape, dtype, storage_dtype)
+            self._rows[name] = {}
+        elif self._specs[name][:2] != (shape, dtype):
+            raise ValueError(
+                f"Activations for {name} have shape {shape} and dtype {dtype}, "
+                f"but the cache stores shape {self._specs[name][0]} "
+                f"and dtype {self._specs[name][1]}."
+            )
+        storage_dtype = self._specs[name][2]
+
+        rows = self._rows[name]
+        new_indices = {}
+        for i, key in enumerate(keys):
+            if key not in rows and key not in new_indices:
+                new_indices[key] = i
+        if not new_indices:
+            return
+
+        new_activations = activations[list(new_indices.values())]
+        if storage_dtype == dtype:
+            tensors = [new_activations]
+        else:
+            data, scales = _encode(new_activations, storage_dtype)
+            tensors = [data] if scales is None else [data, scales]
+        for (path, _, _), tensor in zip(self._files(name), tensors):
+            with open(path, "ab") as f:
+                # Go through uint8 since numpy doesn't support all torch dtypes (bf16)
+                tensor = tensor.contiguous().view(-1).view(torch.uint8)
+                f.write(tensor.numpy().tobytes())
+        for key in new_indices:
+            rows[key] = len(rows)
+
+    def _batches(self):
+        for name, rows in self._rows.items():
+            # Rows are stored in insertion order of the keys
+            keys = list(rows)
+            # Decode in chunks rather than the entire (possibly huge) file at once
+            for start in range(0, len(keys), self.BATCH_ROWS):
+                end = start + self.BATCH_ROWS
+                yield name, keys[start:end], self._decode_rows(name, slice(start, end))
+
+    def store(self, path: str | Path | None = None):
+        """Make the cache persistent, optionally copying it to a different directory.
+
+        If `path` already exists, it's replaced by the copy.
+        """
+        self.flush()
+        if path is None or Path(path).resolve() == self.path.resolve():
+            return
+        path = Path(path)
+        # Copy to a temporary directory first, so an existing cache at `path` is
+        # only replaced once the copy is complete.
+        tmp_path = path.with_name(path.name + ".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.copytree(self.path, tmp_path)
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | Path, **kwargs):
+        """Open a stored cache, `kwargs` are passed to the constructor."""
+        return cls(path, **kwargs)
@@ -3,17 +3,18 @@ from abc import ABC, abstractmethod
 from collections import defaultdict
 from contextlib import contextmanager
 from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
 
 import numpy as np
 import sklearn.metrics
 import torch
 from loguru import logger
 from matplotlib import pyplot as plt
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 
 from cupbearer import utils
-from cupbearer.data import MixedData
+from cupbearer.data import MixedData, make_dataloader
 
 
 class AnomalyDetector(ABC):
@@ -102,16 +103,16 @@ class AnomalyDetector(ABC):
         # when we assume that anomaly labels are included.
         assert isinstance(dataset, MixedData), type(dataset)
 
-        test_loader = DataLoader(
+        test_loader = make_dataloader(
             dataset,
             batch_size=batch_size,
             # For some methods, such as adversarial abstractions, it might matter how
             # normal/anomalous data is distributed into batches. In that case, we want
-            # to mix them by default.
+            # to mix them by default. Grouping by length would undo that mixing.
             shuffle=True,
+            group_by_length=False,
         )
 
-        metrics = defaultdict(dict)
         assert 0 < histogram_percentile <= 100
 
         if pbar:
@@ -123,7 +124,12 @@ class AnomalyDetector(ABC):
         # It's important we don't use torch.inference_mode() here, since we want
         # to be able to override this in certain detectors using torch.enable_grad().
         with torch.no_grad():
-            for batch in test_loader:
+            # Batches are (samples, anomaly labels), the model inputs are part of the
+            # samples.
+            batches = self._iter_batches(
+                test_loader, lambda batch: utils.inputs_from_batch(batch[0])
+            )
+            for batch in batches:
                 inputs, new_labels = batch
                 if layerwise:
                     new_scores = self.layerwise_scores(inputs)
@@ -138,6 +144,26 @@ class AnomalyDetector(ABC):
         scores = {layer: np.concatenate(scores[layer]) for layer in scores}
         labels = {layer: np.concatenate(labels[layer]) for layer in labels}
 
+        return self._compute_eval_metrics(
+            scores,
+            labels,
+            histogram_percentile=histogram_percentile,
+            save_path=save_path,
+            num_bins=num_bins,
+            log_yaxis=log_yaxis,
+        )
+
+    def _compute_eval_metrics(
+        self,
+        scores: dict[str, np.ndarray],
+        labels: dict[str, np.ndarray],
+        histogram_percentile: float = 95,
+        save_path: Path | str | None = None,
+        num_bins: int = 100,
+        log_yaxis: bool = True,
+    ):
+        """Compute metrics and histograms from the anomaly scores of `eval`."""
+        metrics = defaultdict(dict)
         figs = {}
 
         for layer in scores:
@@ -207,6 +233,22 @@ class AnomalyDetector(ABC):
 
         return metrics, figs
 
+    def _iter_batches(
+        self,
+        batches: Iterable,
+        inputs_func: Callable[[Any], Any] = utils.inputs_from_batch,
+    ) -> Iterator:
+        """Iterate over the batches of a dataloader during training or evaluation.
+
+        Subclasses can override this to prepare upcoming batches in the background,
+        e.g. by loading cached activations.
+
+        Args:
+            batches: The batches to iterate over.
+            inputs_func: Extracts the model inputs from a batch.
+        """
+        yield from batches
+
     @abstractmethod
     def layerwise_scores(self, batch) -> dict[str, torch.Tensor]:
         """Compute anomaly scores for the given inputs for each layer.
@@ -0,0 +1,243 @@
+import functools
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+from cupbearer import utils
+from cupbearer.data import MixedData, make_dataloader
+
+from .activation_based import ActivationBasedDetector
+from .activation_cache import ActivationCache, input_keys
+from .statistical import StatisticalDetector
+
+
+class MultiDetector:
+    """Train and evaluate several activation-based detectors at once.
+
+    Every batch is passed through the model only once, collecting the union of the
+    activations that the detectors need. Each detector then gets the activations it
+    asked for, processed with its own `activation_processing_func`. This makes
+    comparing many detectors on the same task about as expensive as running a
+    single one.
+
+    The detectors' own caches aren't used, pass a `cache` to the `MultiDetector`
+    instead. It stores each detector's processed activations under that detector's
+    `cache_fingerprint`, so entries are shared with detectors that use the same
+    cache on their own.
+
+    Args:
+        detectors: The detectors to run, by name. Names are used for the results of
+            `eval` and to save results in separate directories.
+        cache: An optional cache for the (processed) activations.
+    """
+
+    def __init__(
+        self,
+        detectors: dict[str, ActivationBasedDetector],
+        cache: ActivationCache | None = None,
+    ):
+        self.detectors = detectors
+        self.cache = cache
+        self._capture: utils.ActivationCapture | None = None
+
+    def set_model(self, model: torch.nn.Module):
+        self.model = model
+        if self._capture is not None:
+            self._capture.remove()
+        # Hooks for all activations any of the detectors need
+        names = [name for d in self.detectors.values() for name in d.activation_names]
+        self._capture = utils.ActivationCapture(model, list(dict.fromkeys(names)))
+        for detector in self.detectors.values():
+            detector.set_model(model)
+
+    def get_activations(
+        self, batch, detectors: list[ActivationBasedDetector] | None = None
+    ) -> list[dict[str, torch.Tensor]]:
+        """Get the activations for each of `detectors` using a single forward pass.
+
+        Args:
+            batch: A batch of inputs, potentially including labels.
+            detectors: The detectors to get activations for, by default all of them.
+
+        Returns:
+            The activations for each detector, in the same order as `detectors`.
+        """
+        if detectors is None:
+            detectors = list(self.detectors.values())
+        # Union of all names, in a deterministic order
+        names = list(
+            dict.fromkeys(name for d in detectors for name in d.activation_names)
+        )
+
+        device = next(self.model.parameters()).device
+        inputs = utils.inputs_to_device(utils.inputs_from_batch(batch), device)
+        assert self._capture is not None, "Call set_model first"
+        if self.cache is None:
+            acts = self._capture.get_activations(names, inputs)
+            return [
+                self._process(detector, acts, inputs, detector.activation_names)
+                for detector in detectors
+            ]
+
+        # Raw activations for the entire batch, computed on the first cache miss of
+        # any detector. Unprocessed activations aren't cached since their shape can
+        # depend on the batch (e.g. padded sequences). For the same reason, we process
+        # the entire batch and only then select the missing inputs.
+        acts = {}
+        keys = {}
+
+        def activation_func(detector, missing_inputs, missing_names):
+            if not acts:
+                acts.update(self._capture.get_activations(names, inputs))
+                keys.update((key, i) for i, key in enumerate(input_keys(inputs)))
+            processed = self._process(detector, acts, inputs, missing_names)
+            indices = [keys[key] for key in input_keys(missing_inputs)]
+            return {name: processed[name][indices] for name in missing_names}
+
+        return [
+            utils.inputs_to_device(
+                self.cache.get_activations(
+                    inputs,
+                    detector.activation_names,
+                    functools.partial(activation_func, detector),
+                    fingerprint=detector.cache_fingerprint,
+                ),
+                device,
+            )
+            for detector in detectors
+        ]
+
+    @staticmethod
+    def _process(
+        detector: ActivationBasedDetector,
+        acts: dict[str, torch.Tensor],
+        inputs,
+        names: list[str],
+    ) -> dict[str, torch.Tensor]:
+        func = detector.activation_processing_func
+        return {
+            name: acts[name] if func is None else func(acts[name], inputs, name)
+            for name in names
+        }
+
+    def _set_activations(self, batch, detectors: list[ActivationBasedDetector]):
+        # Detectors pick these up in `get_activations` when they're called with
+        # this batch, so we can use their own scoring methods.
+        inputs = utils.inputs_from_batch(batch)
+        for detector, acts in zip(detectors, self.get_activations(batch, detectors)):
+            detector._precomputed = (inputs, acts)
+
+    def train(
+        self,
+        trusted_data,
+        untrusted_data,
+        *,
+        batch_size: int = 1024,
+        pbar: bool = True,
+        max_steps: int | None = None,
+        **kwargs,
+    ):
+        """Train all detectors, see `StatisticalDetector.train`.
+
+        Only statistical detectors are supported, since they are trained with a
+        single pass over the data. Detectors that train on the same data share
+        forward passes (e.g. all of them if `trusted_data` and `untrusted_data` are
+        the same). `kwargs` are passed on to each detector.
+        """
+        # Detectors grouped by the dataset they're trained on
+        groups: dict[int, tuple[Any, list[StatisticalDetector]]] = {}
+        for name, detector in self.detectors.items():
+            if not isinstance(detector, StatisticalDetector):
+                raise TypeError(
+                    f"Can only train statistical detectors, but {name} is a "
+                    f"{type(detector).__name__}."
+                )
+            data = detector._training_data(trusted_data, untrusted_data)
+            groups.setdefault(id(data), (data, []))[1].append(detector)
+
+        for data, detectors in groups.values():
+            with torch.inference_mode():
+                data_loader = make_dataloader(
+                    data, batch_size=batch_size, shuffle=False
+                )
+                example_batch = next(iter(data_loader))
+                example_acts = self.get_activations(example_batch, detectors)
+                for detector, acts in zip(detectors, example_acts):
+                    detector._init_from_example(acts)
+
+                if pbar:
+                    data_loader = tqdm(data_loader, total=max_steps or len(data_loader))
+
+                for i, batch in enumerate(data_loader):
+                    if max_steps and i >= max_steps:
+                        break
+                    all_acts = self.get_activations(batch, detectors)
+                    for detector, acts in zip(detectors, all_acts):
+                        detector.batch_update(acts)
+
+            for detector in detectors:
+                detector._finish_training(**kwargs)
+
+    def eval(
+        self,
+        dataset: MixedData,
+        batch_size: int = 1024,
+        histogram_percentile: float = 95,
+        save_path: Path | str | None = None,
+        num_bins: int = 100,
+        pbar: bool = False,
+        layerwise: bool = False,
+        log_yaxis: bool = True,
+    ):
+        """Evaluate all detectors, see `AnomalyDetector.eval`.
+
+        All detectors are evaluated on the same batches. If `save_path` is given,
+        results for each detector are stored in a subdirectory named after it.
+
+        Returns:
+            A dict from detector name to the metrics and figures of that detector.
+        """
+        assert isinstance(dataset, MixedData), type(dataset)
+        assert 0 < histogram_percentile <= 100
+
+        # Mix normal and anomalous data in batches, like `AnomalyDetector.eval`
+        test_loader = make_dataloader(
+            dataset, batch_size=batch_size, shuffle=True, group_by_length=False
+        )
+        if pbar:
+            test_loader = tqdm(test_loader, desc="Evaluating", leave=False)
+
+        detectors = list(self.detectors.values())
+        scores = {name: defaultdict(list) for name in self.detectors}
+        labels = {name: defaultdict(list) for name in self.detectors}
+
+        with torch.no_grad():
+            for inputs, new_labels in test_loader:
+                self._set_activations(inputs, detectors)
+                for name, detector in self.detectors.items():
+                    if layerwise:
+                        new_scores = detector.layerwise_scores(inputs)
+                    else:
+                        new_scores = {"all": detector.scores(inputs)}
+                    for layer, score in new_scores.items():
+                        if isinstance(score, torch.Tensor):
+                            score = score.cpu().numpy()
+                        assert score.shape == new_labels.shape
+                        scores[name][layer].append(score)
+                        labels[name][layer].append(new_labels)
+
+        results = {}
+        for name, detector in self.detectors.items():
+            results[name] = detector._compute_eval_metrics(
+                {layer: np.concatenate(s) for layer, s in scores[name].items()},
+                {layer: np.concatenate(s) for layer, s in labels[name].items()},
+                histogram_percentile=histogram_percentile,
+                save_path=Path(save_path) / name if save_path else None,
+                num_bins=num_bins,
+                log_yaxis=log_yaxis,
+            )
+        return results
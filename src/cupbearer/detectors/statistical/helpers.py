@@ -1,21 +1,20 @@
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import torch
 
 
-def update_covariance(curr_mean, curr_C, curr_n, new_data):
-    # Should be (batch, dim)
-    assert new_data.ndim == 2
+def merge_covariance(curr_mean, curr_C, curr_n, new_mean, new_C, new_n):
+    """Combine the statistics of two disjoint sets of samples.
 
-    new_n = len(new_data)
+    This is the parallel algorithm by Chan et al., `C` is the sum of outer products
+    of the centered samples (i.e. the covariance matrix without normalization).
+    """
     total_n = curr_n + new_n
+    if total_n == 0:
+        return curr_mean, curr_C, total_n
 
-    new_mean = new_data.mean(dim=0)
     delta_mean = new_mean - curr_mean
     updated_mean = (curr_n * curr_mean + new_n * new_mean) / total_n
-
-    delta_data = new_data - new_mean
-    new_C = torch.einsum("bi,bj->ij", delta_data, delta_data)
     updated_C = (
         curr_C
         + new_C
@@ -25,6 +24,219 @@ def update_covariance(curr_mean, curr_C, curr_n, new_data):
     return updated_mean, updated_C, total_n
 
 
+def update_covariance(curr_mean, curr_C, curr_n, new_data):
+    # Should be (batch, dim)
+    assert new_data.ndim == 2
+
+    new_mean = new_data.mean(dim=0)
+    delta_data = new_data - new_mean
+    new_C = torch.einsum("bi,bj->ij", delta_data, delta_data)
+
+    return merge_covariance(curr_mean, curr_C, curr_n, new_mean, new_C, len(new_data))
+
+
+class RunningCovariance:
+    """Mean and covariance of all the samples seen so far.
+
+    Statistics of disjoint sets of samples can be combined exactly with `merge`, so
+    they can be computed independently (e.g. for different shards of a dataset in
+    separate processes) and merged in the end.
+
+    Statistics of each batch are computed in (at least) single precision and then
+    added to accumulators of type `dtype`. Since batches are centered with their
+    own mean first, float64 accumulators are enough to avoid a loss of precision
+    over millions of samples, without computing in float64 for every batch.
+
+    Args:
+        dim: Dimension of the samples.
+        device: Device to store the statistics on.
+        dtype: Data type of the accumulated statistics.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        device: torch.device | str | None = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.mean = torch.zeros(dim, device=device, dtype=dtype)
+        # Covariance matrix times the number of samples minus one
+        self.C = torch.zeros((dim, dim), device=device, dtype=dtype)
+        self.n = 0
+
+    def update(self, data: torch.Tensor):
+        """Add a batch of samples of shape (batch, dim)."""
+        assert data.ndim == 2
+        # E.g. bfloat16 activations would lose a lot of precision in the outer
+        # products, so compute those in float32 at least.
+        data = data.to(torch.promote_types(data.dtype, torch.float32))
+        new_mean = data.mean(dim=0)
+        delta_data = data - new_mean
+        new_C = torch.einsum("bi,bj->ij", delta_data, delta_data)
+        self.mean, self.C, self.n = merge_covariance(
+            self.mean,
+            self.C,
+            self.n,
+            new_mean.to(self.mean.dtype),
+            new_C.to(self.C.dtype),
+            len(data),
+        )
+
+    def merge(self, other: "RunningCovariance"):
+        """Add the statistics of another set of samples, in place."""
+        self.mean, self.C, self.n = merge_covariance(
+            self.mean,
+            self.C,
+            self.n,
+            other.mean.to(self.mean),
+            other.C.to(self.C),
+            other.n,
+        )
+        return self
+
+    def to(self, device: torch.device | str) -> "RunningCovariance":
+        other = RunningCovariance.__new__(RunningCovariance)
+        other.mean = self.mean.to(device)
+        other.C = self.C.to(device)
+        other.n = self.n
+        return other
+
+    @property
+    def covariance(self) -> torch.Tensor:
+        # Bessel's correction for the sample covariance
+        return self.C / (self.n - 1)
+
+
+class LowRankCovariance(NamedTuple):
+    """A covariance matrix U @ diag(eigenvalues) @ U.T + diag(diagonal).
+
+    Stores dim * rank numbers instead of dim**2. Like `torch.linalg.eigh`,
+    eigenvalues are in ascending order.
+
+    Attributes:
+        eigenvectors: Orthonormal columns U, shape (dim, rank).
+        eigenvalues: Shape (rank,).
+        diagonal: Remaining variance of each dimension not explained by the
+            low-rank part, shape (dim,).
+    """
+
+    eigenvectors: torch.Tensor
+    eigenvalues: torch.Tensor
+    diagonal: torch.Tensor
+
+    def variances(self) -> torch.Tensor:
+        """The diagonal of the full covariance matrix."""
+        explained = (self.eigenvectors.square() * self.eigenvalues).sum(dim=1)
+        return explained + self.diagonal
+
+
+class RunningLowRankCovariance:
+    """Low-rank plus diagonal approximation of the covariance of all samples so far.
+
+    Uses a Frequent Directions sketch (https://arxiv.org/abs/1501.01711) of the
+    centered samples, with `2 * rank` rows. The sketch underestimates the
+    covariance by at most (roughly) the sum of the eigenvalues beyond `rank` divided
+    by `rank`, in every direction. The exact variance of each dimension is tracked
+    separately, so the variance missed by the top `rank` directions is kept as a
+    diagonal. Memory is O(dim * rank) instead of O(dim**2) for `RunningCovariance`,
+    and the interface is the same, except that `covariance` is a `LowRankCovariance`.
+
+    Args:
+        dim: Dimension of the samples.
+        rank: Number of directions to keep.
+        device: Device to store the statistics on.
+        dtype: Data type of the accumulated statistics.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        rank: int,
+        device: torch.device | str | None = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.rank = rank
+        self.mean = torch.zeros(dim, device=device, dtype=dtype)
+        # Rows B such that B.T @ B approximates the unnormalized covariance matrix
+        self.sketch = torch.zeros((0, dim), device=device, dtype=dtype)
+        # Diagonal of the unnormalized covariance matrix
+        self.sum_squares = torch.zeros(dim, device=device, dtype=dtype)
+        self.n = 0
+
+    def _merge(self, mean, sketch, sum_squares, n):
+        total_n = self.n + n
+        if total_n == 0:
+            return
+        delta_mean = mean - self.mean
+        # Same as `merge_covariance`, the correction term is an additional row
+        correction = self.n * n / total_n
+        rows = torch.cat(
+            [self.sketch, sketch, (correction**0.5 * delta_mean).unsqueeze(0)]
+        )
+        self.sum_squares = self.sum_squares + sum_squares + correction * delta_mean**2
+        self.mean = (self.n * self.mean + n * mean) / total_n
+        self.n = total_n
+        self._shrink(rows)
+
+    def _shrink(self, rows: torch.Tensor):
+        sketch_size = 2 * self.rank
+        if len(rows) <= sketch_size:
+            self.sketch = rows
+            return
+        _, S, Vh = torch.linalg.svd(rows, full_matrices=False)
+        if len(S) <= sketch_size:
+            # At most `sketch_size` dimensions, so the rotated rows are exact
+            self.sketch = S.unsqueeze(1) * Vh
+            return
+        # Subtracting the largest dropped squared singular value from all others
+        # is what makes the sketch mergeable with bounded error.
+        S = (S[:sketch_size].square() - S[sketch_size].square()).clamp(min=0).sqrt()
+        self.sketch = S.unsqueeze(1) * Vh[:sketch_size]
+
+    def update(self, data: torch.Tensor):
+        """Add a batch of samples of shape (batch, dim)."""
+        assert data.ndim == 2
+        data = data.to(torch.promote_types(data.dtype, torch.float32))
+        new_mean = data.mean(dim=0)
+        delta_data = data - new_mean
+        self._merge(
+            new_mean.to(self.mean.dtype),
+            delta_data.to(self.mean.dtype),
+            delta_data.square().sum(dim=0).to(self.mean.dtype),
+            len(data),
+        )
+
+    def merge(self, other: "RunningLowRankCovariance"):
+        """Add the statistics of another set of samples, in place."""
+        self._merge(
+            other.mean.to(self.mean),
+            other.sketch.to(self.mean),
+            other.sum_squares.to(self.mean),
+            other.n,
+        )
+        return self
+
+    def to(self, device: torch.device | str) -> "RunningLowRankCovariance":
+        other = RunningLowRankCovariance.__new__(RunningLowRankCovariance)
+        other.rank = self.rank
+        other.mean = self.mean.to(device)
+        other.sketch = self.sketch.to(device)
+        other.sum_squares = self.sum_squares.to(device)
+        other.n = self.n
+        return other
+
+    @property
+    def covariance(self) -> LowRankCovariance:
+        _, S, Vh = torch.linalg.svd(self.sketch, full_matrices=False)
+        # Top directions, in ascending order
+        S, Vh = S[: self.rank].flip(0), Vh[: self.rank].flip(0)
+        eigenvalues = S.square() / (self.n - 1)
+        eigenvectors = Vh.mT
+        explained = (eigenvectors.square() * eigenvalues).sum(dim=1)
+        diagonal = (self.sum_squares / (self.n - 1) - explained).clamp(min=0)
+        return LowRankCovariance(eigenvectors, eigenvalues, diagonal)
+
+
 def batch_covariance(batches):
     dim = batches[0].shape[1]
     mean = torch.zeros(dim)
@@ -70,20 +282,184 @@ def mahalanobis(
     return distance
 
 
+def mahalanobis_from_factor(
+    activation: torch.Tensor,
+    mean: torch.Tensor,
+    factor: torch.Tensor,
+    triangular: bool = False,
+    inv_diag_covariance: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Compute Mahalanobis distances using a factorization of the covariance matrix.
+
+    Equivalent to `mahalanobis`, but cheaper: with a whitening matrix of shape
+    (dim, rank), this costs dim * rank operations per sample instead of dim**2, and
+    with a Cholesky factor it's a triangular solve (dim**2 / 2 operations).
+
+    Args:
+        activation: values to compute distance for, with shape (batch, dim)
+        mean: mean of shape (dim,)
+        factor: If `triangular` is False, a whitening matrix W of shape
+            (dim, rank) such that W @ W.T is the (pseudo-)inverse covariance matrix
+            (see `pca_whitening`). Otherwise, the lower triangular Cholesky factor L
+            of the covariance matrix (C = L @ L.T).
+        triangular: Whether `factor` is a Cholesky factor.
+        inv_diag_covariance: See `mahalanobis`.
+
+    Returns:
+        Tensor of shape (batch,) with the Mahalanobis distances.
+    """
+    batch_size = activation.shape[0]
+    activation = activation.view(batch_size, -1)
+    delta = activation - mean
+    assert delta.ndim == 2 and delta.shape[0] == batch_size
+    if triangular:
+        # Solves L @ X = delta.T, the squared norm of X is the distance
+        whitened = torch.linalg.solve_triangular(factor, delta.mT, upper=False).mT
+    else:
+        whitened = delta @ factor
+    distance = whitened.square().sum(dim=1)
+    if inv_diag_covariance is not None:
+        distance -= torch.einsum("bi,i->b", delta**2, inv_diag_covariance)
+    return distance
+
+
+def pca_whitening(
+    covariance: torch.Tensor | LowRankCovariance,
+    rcond: float = 1e-5,
+    rank: Optional[int] = None,
+) -> torch.Tensor:
+    """Compute a PCA whitening matrix for a covariance matrix.
+
+    Follows https://doi.org/10.1080/00031305.2016.1277159
+    and https://stats.stackexchange.com/a/594218/319192
+    but transposed (sphering with x@W instead of W@x).
+
+    Args:
+        covariance: Covariance matrix of shape (dim, dim). For a `LowRankCovariance`,
+            only its low-rank part is whitened and the diagonal is ignored.
+        rcond: Directions with eigenvalues smaller than `rcond` times the largest
+            eigenvalue are zeroed out, like in a pseudo-inverse.
+        rank: If given, only keep the directions with the `rank` largest
+            eigenvalues.
+
+    Returns:
+        Whitening matrix of shape (dim, dim), or (dim, rank) if `rank` is given
+        (or the rank of the low-rank part of a `LowRankCovariance`).
+    """
+    if isinstance(covariance, LowRankCovariance):
+        eigenvalues, eigenvectors = covariance.eigenvalues, covariance.eigenvectors
+    else:
+        eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+
+    # Zero entries corresponding to eigenvalues smaller than rcond
+    vals_rsqrt = eigenvalues.rsqrt()
+    vals_rsqrt[eigenvalues < rcond * eigenvalues.max()] = 0
+
+    whitening_matrix = eigenvectors * vals_rsqrt.unsqueeze(0)
+    if rank is not None:
+        # Eigenvalues are in ascending order
+        whitening_matrix = whitening_matrix[:, -rank:]
+    return whitening_matrix
+
+
+def woodbury_factors(
+    covariance: LowRankCovariance, rcond: float = 1e-5
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Factorize the inverse of a low-rank plus diagonal covariance matrix.
+
+    With C = U @ diag(s) @ U.T + D, write C = D^(1/2) (I + Q R R^T Q^T) D^(1/2) with
+    Q R the QR decomposition of D^(-1/2) U diag(s)^(1/2). Then for y = D^(-1/2) x,
+    x^T C^(-1) x = |y - Q Q^T y|^2 + |L^(-1) Q^T y|^2 with L the Cholesky factor of
+    I + R R^T. This costs dim * rank operations per sample and avoids the
+    cancellations of the naive Woodbury identity.
+
+    Args:
+        covariance: The covariance matrix.
+        rcond: Entries of the diagonal smaller than `rcond` times the largest
+            eigenvalue are increased to that value, so the matrix is invertible.
+
+    Returns:
+        Tuple of D^(-1/2) of shape (dim,), Q of shape (dim, rank) and L of shape
+        (rank, rank), see `mahalanobis_low_rank`.
+    """
+    eigenvectors, eigenvalues, diagonal = covariance
+    floor = rcond * torch.maximum(eigenvalues.max(), diagonal.max())
+    diag_rsqrt = diagonal.clamp(min=floor).rsqrt()
+    Q, R = torch.linalg.qr(
+        diag_rsqrt.unsqueeze(1) * eigenvectors * eigenvalues.clamp(min=0).sqrt()
+    )
+    eye = torch.eye(R.shape[0], device=R.device, dtype=R.dtype)
+    L = torch.linalg.cholesky(eye + R @ R.mT)
+    return diag_rsqrt, Q, L
+
+
+def mahalanobis_low_rank(
+    activation: torch.Tensor,
+    mean: torch.Tensor,
+    factors: tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+    inv_diag_covariance: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Compute Mahalanobis distances for a low-rank plus diagonal covariance matrix.
+
+    Args:
+        activation: values to compute distance for, with shape (batch, dim)
+        mean: mean of shape (dim,)
+        factors: The output of `woodbury_factors`.
+        inv_diag_covariance: See `mahalanobis`.
+
+    Returns:
+        Tensor of shape (batch,) with the Mahalanobis distances.
+    """
+    diag_rsqrt, Q, L = factors
+    batch_size = activation.shape[0]
+    activation = activation.view(batch_size, -1)
+    delta = activation - mean
+    assert delta.ndim == 2 and delta.shape[0] == batch_size
+    y = delta * diag_rsqrt
+    projected = y @ Q
+    # Orthogonal to the low-rank directions, only the diagonal matters
+    residual = y - projected @ Q.mT
+    whitened = torch.linalg.solve_triangular(L, projected.mT, upper=False).mT
+    distance = residual.square().sum(dim=1) + whitened.square().sum(dim=1)
+    if inv_diag_covariance is not None:
+        distance -= torch.einsum("bi,i->b", delta**2, inv_diag_covariance)
+    return distance
+
+
 def quantum_entropy(
     whitened_activations: torch.Tensor,
     alpha: float = 4,
+    method: str = "auto",
 ) -> torch.Tensor:
     """Quantum Entropy score.
 
+    The score of each sample x is x^T exp(alpha * C / |C|) x, with C the (unnormalized)
+    covariance matrix of the batch and |C| its largest eigenvalue.
+
     Args:
         whitened_activations: whitened activations, with shape (batch, dim)
         alpha: QUE hyperparameter
+        method: How to compute the matrix exponential:
+            - "dense": Explicitly, as a (dim, dim) matrix. Costs O(dim**3).
+            - "gram": C has rank at most batch, and the exponential is the identity
+              outside of its range. So it suffices to diagonalize the (batch, batch)
+              Gram matrix of the centered batch, which has the same non-zero
+              eigenvalues. Costs O(batch**2 * dim + batch**3).
+            - "auto": "gram" if batch < dim, else "dense".
     """
+    if method == "auto":
+        batch, dim = whitened_activations.shape
+        method = "gram" if batch < dim else "dense"
+    if method not in {"dense", "gram"}:
+        raise ValueError(f"Unknown method {method}")
+
     # Compute QUE-score
     centered_batch = whitened_activations - whitened_activations.mean(
         dim=0, keepdim=True
     )
+    if method == "gram":
+        return _quantum_entropy_gram(whitened_activations, centered_batch, alpha)
+
     batch_cov = centered_batch.mT @ centered_batch
 
     batch_cov_norm = torch.linalg.eigvalsh(batch_cov).max()
@@ -95,3 +471,28 @@ def quantum_entropy(
         exp_factor,
         whitened_activations.mT,
     )
+
+
+def _quantum_entropy_gram(
+    whitened_activations: torch.Tensor, centered_batch: torch.Tensor, alpha: float
+) -> torch.Tensor:
+    # With X the centered batch and X @ X.T = U diag(s) U.T, the covariance matrix is
+    # X.T @ X = V diag(s) V.T with V = X.T U diag(s)^(-1/2). So
+    # exp(c X.T @ X) = I + V diag(exp(c s) - 1) V.T, and for a sample x,
+    # x^T exp(c X.T @ X) x = |x|^2 + sum_k (x X.T U)_k^2 (exp(c s_k) - 1) / s_k.
+    gram = centered_batch @ centered_batch.mT
+    eigenvalues, eigenvectors = torch.linalg.eigh(gram)
+    eigenvalues = eigenvalues.clamp(min=0)
+    scale = alpha / eigenvalues.max()
+    # (exp(c s) - 1) / s tends to c for s -> 0, those directions contribute ~0
+    # anyway since the corresponding projections vanish too.
+    nonzero = eigenvalues > eigenvalues.max() * torch.finfo(eigenvalues.dtype).eps
+    weights = torch.where(
+        nonzero,
+        torch.expm1(scale * eigenvalues) / torch.where(nonzero, eigenvalues, 1),
+        scale,
+    )
+    projections = whitened_activations @ centered_batch.mT @ eigenvectors
+    return whitened_activations.square().sum(dim=1) + (
+        projections.square() * weights
+    ).sum(dim=1)
@@ -1,7 +1,14 @@
 import numpy as np
 import torch
 
-from cupbearer.detectors.statistical.helpers import mahalanobis
+from cupbearer.detectors.statistical.helpers import (
+    LowRankCovariance,
+    mahalanobis,
+    mahalanobis_from_factor,
+    mahalanobis_low_rank,
+    pca_whitening,
+    woodbury_factors,
+)
 from cupbearer.detectors.statistical.statistical import (
     ActivationCovarianceBasedDetector,
 )
@@ -14,6 +21,19 @@ def _pinv(C, rcond):
     return torch.linalg.pinv(C, rcond=rcond, hermitian=True)
 
 
+def _cholesky(C, rcond):
+    # Regularize so that rank deficient covariance matrices can be factorized too
+    jitter = rcond * torch.diagonal(C).max()
+    L, info = torch.linalg.cholesky_ex(
+        C + jitter * torch.eye(C.shape[0], device=C.device, dtype=C.dtype)
+    )
+    if info.item() > 0:
+        raise RuntimeError(
+            "Cholesky decomposition of covariance matrix failed, try a larger rcond."
+        )
+    return L
+
+
 # From https://gist.github.com/chausies/011df759f167b17b5278264454fff379
 def norm_cdf(x):
     return (1 + torch.erf(x / np.sqrt(2))) / 2
@@ -52,38 +72,131 @@ def log_chi_squared_percentiles(distances, dim):
 
 class MahalanobisDetector(ActivationCovarianceBasedDetector):
     def post_covariance_training(
-        self, rcond: float = 1e-5, relative: bool = False, **kwargs
+        self,
+        rcond: float = 1e-5,
+        relative: bool = False,
+        method: str | None = None,
+        rank: int | None = None,
+        **kwargs,
     ):
-        self.inv_covariances = {k: _pinv(C, rcond) for k, C in self.covariances.items()}
+        """Compute what's needed for scoring from the covariance matrices.
+
+        Args:
+            rcond: Relative cutoff for small eigenvalues (for "pinv" and "eigh") or
+                relative regularization (for "cholesky").
+            relative: Whether to compute the (simplified) relative Mahalanobis
+                distance.
+            method: How to represent the inverse covariance matrix:
+                - "pinv": The explicit pseudo-inverse (default).
+                - "eigh": A PCA whitening matrix, optionally truncated to `rank`
+                  directions. Scores cost dim * rank operations per sample.
+                - "cholesky": The Cholesky factor of the (regularized) covariance
+                  matrix, scores are computed with a triangular solve.
+                - "woodbury": Only for low-rank covariances (see `covariance_rank`)
+                  and their default. Inverts the low-rank plus diagonal matrix with
+                  the Woodbury identity, see `woodbury_factors`.
+                Low-rank covariances also support "eigh", which ignores their
+                diagonal part.
+            rank: Only use the `rank` directions with the largest variance, requires
+                `method="eigh"`.
+        """
+        low_rank = self.covariance_rank is not None
+        if method is None:
+            method = "woodbury" if low_rank else "pinv"
+        supported = {"woodbury", "eigh"} if low_rank else {"pinv", "eigh", "cholesky"}
+        if method not in supported:
+            raise ValueError(
+                f"Unknown method {method}, expected one of {sorted(supported)}"
+            )
+        if rank is not None and method != "eigh":
+            raise ValueError("Truncating to a rank requires method='eigh'.")
+
+        self.inv_covariances = None
+        self.whitening_matrices = None
+        self.cholesky_factors = None
+        self.woodbury_factors = None
+        if method == "woodbury":
+            self.woodbury_factors = {
+                k: woodbury_factors(C, rcond) for k, C in self.covariances.items()
+            }
+        elif method == "pinv":
+            self.inv_covariances = {
+                k: _pinv(C, rcond) for k, C in self.covariances.items()
+            }
+        elif method == "eigh":
+            self.whitening_matrices = {
+                k: pca_whitening(C, rcond, rank) for k, C in self.covariances.items()
+            }
+        else:
+            self.cholesky_factors = {
+                k: _cholesky(C, rcond) for k, C in self.covariances.items()
+            }
         self.inv_diag_covariances = None
         if relative:
-            self.inv_diag_covariances = {
-                k: torch.where(torch.diag(C) > rcond, 1 / torch.diag(C), 0)
+            variances = {
+                k: C.variances() if isinstance(C, LowRankCovariance) else torch.diag(C)
                 for k, C in self.covariances.items()
             }
+            self.inv_diag_covariances = {
+                k: torch.where(v > rcond, 1 / v, 0) for k, v in variances.items()
+            }
 
     def _individual_layerwise_score(self, name: str, activation: torch.Tensor):
         inv_diag_covariance = None
         if self.inv_diag_covariances is not None:
             inv_diag_covariance = self.inv_diag_covariances[name]
 
-        distance = mahalanobis(
-            activation,
-            self.means[name],
-            self.inv_covariances[name],
-            inv_diag_covariance=inv_diag_covariance,
-        )
-
-        return log_chi_squared_percentiles(distance, self.means[name].shape[0])
+        dim = self.means[name].shape[0]
+        if self.whitening_matrices is not None:
+            whitening_matrix = self.whitening_matrices[name]
+            distance = mahalanobis_from_factor(
+                activation,
+                self.means[name],
+                whitening_matrix,
+                inv_diag_covariance=inv_diag_covariance,
+            )
+            # Truncated whitening matrices only use some of the directions
+            dim = whitening_matrix.shape[1]
+        elif self.woodbury_factors is not None:
+            distance = mahalanobis_low_rank(
+                activation,
+                self.means[name],
+                self.woodbury_factors[name],
+                inv_diag_covariance=inv_diag_covariance,
+            )
+        elif self.cholesky_factors is not None:
+            distance = mahalanobis_from_factor(
+                activation,
+                self.means[name],
+                self.cholesky_factors[name],
+                triangular=True,
+                inv_diag_covariance=inv_diag_covariance,
+            )
+        else:
+            distance = mahalanobis(
+                activation,
+                self.means[name],
+                self.inv_covariances[name],
+                inv_diag_covariance=inv_diag_covariance,
+            )
+
+        return log_chi_squared_percentiles(distance, dim)
 
     def _get_trained_variables(self, saving: bool = False):
         return {
             "means": self.means,
             "inv_covariances": self.inv_covariances,
+            "whitening_matrices": self.whitening_matrices,
+            "cholesky_factors": self.cholesky_factors,
+            "woodbury_factors": self.woodbury_factors,
             "inv_diag_covariances": self.inv_diag_covariances,
         }
 
     def _set_trained_variables(self, variables):
         self.means = variables["means"]
         self.inv_covariances = variables["inv_covariances"]
+        # Not present in detectors saved before these methods were added
+        self.whitening_matrices = variables.get("whitening_matrices")
+        self.cholesky_factors = variables.get("cholesky_factors")
+        self.woodbury_factors = variables.get("woodbury_factors")
         self.inv_diag_covariances = variables["inv_diag_covariances"]
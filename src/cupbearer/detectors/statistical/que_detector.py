@@ -1,6 +1,6 @@
 import torch
 
-from cupbearer.detectors.statistical.helpers import quantum_entropy
+from cupbearer.detectors.statistical.helpers import pca_whitening, quantum_entropy
 from cupbearer.detectors.statistical.statistical import (
     ActivationCovarianceBasedDetector,
 )
@@ -8,24 +8,11 @@ from cupbearer.detectors.statistical.statistical import (
 
 class QuantumEntropyDetector(ActivationCovarianceBasedDetector):
     def post_covariance_training(self, rcond: float = 1e-5, **kwargs):
-        whitening_matrices = {}
-        for k, cov in self.covariances.items():
-            # Compute decomposition
-            eigs = torch.linalg.eigh(cov)
-
-            # Zero entries corresponding to eigenvalues smaller than rcond
-            vals_rsqrt = eigs.eigenvalues.rsqrt()
-            vals_rsqrt[eigs.eigenvalues < rcond * eigs.eigenvalues.max()] = 0
-
-            # PCA whitening
-            # following https://doi.org/10.1080/00031305.2016.1277159
-            # and https://stats.stackexchange.com/a/594218/319192
-            # but transposed (sphering with x@W instead of W@x)
-            whitening_matrices[k] = eigs.eigenvectors * vals_rsqrt.unsqueeze(0)
-            assert torch.allclose(
-                whitening_matrices[k], eigs.eigenvectors @ vals_rsqrt.diag()
-            )
-        self.whitening_matrices = whitening_matrices
+        # For low-rank covariances, activations are whitened within the top
+        # `covariance_rank` directions only
+        self.whitening_matrices = {
+            k: pca_whitening(cov, rcond) for k, cov in self.covariances.items()
+        }
 
     def _individual_layerwise_score(self, name, activation):
         whitened_activations = torch.einsum(
@@ -1,5 +1,6 @@
 import torch
 
+from cupbearer.detectors.statistical.helpers import LowRankCovariance
 from cupbearer.detectors.statistical.statistical import (
     ActivationCovarianceBasedDetector,
 )
@@ -17,7 +18,11 @@ class SpectralSignatureDetector(ActivationCovarianceBasedDetector):
     def post_covariance_training(self, **kwargs):
         # Calculate top right singular vectors from covariance matrices
         self.top_singular_vectors = {
-            k: torch.linalg.eigh(cov).eigenvectors[:, -1]
+            k: (
+                cov.eigenvectors
+                if isinstance(cov, LowRankCovariance)
+                else torch.linalg.eigh(cov).eigenvectors
+            )[:, -1]
             for k, cov in self.covariances.items()
         }
 
@@ -1,13 +1,42 @@
+import copy
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
 
 import torch
 from einops import rearrange
 from loguru import logger
-from torch.utils.data import DataLoader
+from torch.utils.data import Dataset, Subset
 from tqdm import tqdm
 
+from cupbearer import utils
+from cupbearer.data import make_dataloader
 from cupbearer.detectors.activation_based import ActivationBasedDetector
-from cupbearer.detectors.statistical.helpers import update_covariance
+from cupbearer.detectors.activation_cache import ActivationCache
+from cupbearer.detectors.statistical.helpers import (
+    LowRankCovariance,
+    RunningCovariance,
+    RunningLowRankCovariance,
+)
+
+
+def _train_shard(
+    detector: "StatisticalDetector",
+    data: Dataset,
+    batch_size: int,
+    device: str | None = None,
+):
+    # Runs in a worker process, `detector` is a copy of the original detector.
+    if device is not None:
+        detector.model.to(device)
+    with torch.inference_mode():
+        data_loader = make_dataloader(data, batch_size=batch_size, shuffle=False)
+        # Start from scratch, on the right device
+        example_batch = next(iter(data_loader))
+        detector._init_from_example(detector.get_activations(example_batch))
+        for batch in detector._iter_batches(data_loader):
+            detector.batch_update(detector.get_activations(batch))
+    return detector._get_statistics()
 
 
 class StatisticalDetector(ActivationBasedDetector, ABC):
@@ -21,6 +50,45 @@ class StatisticalDetector(ActivationBasedDetector, ABC):
     def batch_update(self, activations: dict[str, torch.Tensor]):
         pass
 
+    def _training_data(self, trusted_data, untrusted_data):
+        if self.use_trusted:
+            if trusted_data is None:
+                raise ValueError(
+                    f"{self.__class__.__name__} requires trusted training data."
+                )
+            return trusted_data
+        if untrusted_data is None:
+            raise ValueError(
+                f"{self.__class__.__name__} requires untrusted training data."
+            )
+        return untrusted_data
+
+    def _init_from_example(self, example_activations: dict[str, torch.Tensor]):
+        # v is an entire batch, v[0] are activations for a single input
+        activation_sizes = {k: v[0].size() for k, v in example_activations.items()}
+        self.init_variables(
+            activation_sizes, device=next(iter(example_activations.values())).device
+        )
+
+    def _finish_training(self, **kwargs):
+        """Called after all batches have been processed, with the training kwargs."""
+
+    def _get_statistics(self) -> Any:
+        """Get the statistics accumulated by `batch_update`, for merging.
+
+        Needed to train in several processes. Should return a picklable object
+        with all tensors on the CPU.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} doesn't support training in several processes."
+        )
+
+    def _merge_statistics(self, statistics: Any):
+        """Merge statistics from `_get_statistics` of other data into this detector."""
+        raise NotImplementedError(
+            f"{self.__class__.__name__} doesn't support training in several processes."
+        )
+
     def train(
         self,
         trusted_data,
@@ -29,48 +97,125 @@ class StatisticalDetector(ActivationBasedDetector, ABC):
         batch_size: int = 1024,
         pbar: bool = True,
         max_steps: int | None = None,
+        num_processes: int = 1,
+        devices: list[str] | None = None,
         **kwargs,
     ):
+        """Train the detector by computing statistics in a single pass over the data.
+
+        Args:
+            batch_size: Batch size for computing activations.
+            pbar: Whether to show a progress bar.
+            max_steps: Only use this many batches.
+            num_processes: If larger than one, the data is split into this many
+                contiguous shards, statistics for each shard are computed in a
+                separate process and then merged. Only supported by detectors that
+                implement `_get_statistics` and `_merge_statistics`.
+            devices: Devices to move the model to in the worker processes, assigned
+                round-robin. By default, workers keep the model's device.
+            **kwargs: Passed on to `_finish_training`.
+        """
         # Common for statistical methods is that the training does not require
         # gradients, but instead computes summary statistics or similar
         with torch.inference_mode():
-            if self.use_trusted:
-                if trusted_data is None:
-                    raise ValueError(
-                        f"{self.__class__.__name__} requires trusted training data."
-                    )
-                data = trusted_data
-            else:
-                if untrusted_data is None:
-                    raise ValueError(
-                        f"{self.__class__.__name__} requires untrusted training data."
-                    )
-                data = untrusted_data
+            data = self._training_data(trusted_data, untrusted_data)
 
             # No reason to shuffle, we're just computing statistics
-            data_loader = DataLoader(data, batch_size=batch_size, shuffle=False)
+            data_loader = make_dataloader(data, batch_size=batch_size, shuffle=False)
             example_batch = next(iter(data_loader))
-            example_activations = self.get_activations(example_batch)
+            self._init_from_example(self.get_activations(example_batch))
 
-            # v is an entire batch, v[0] are activations for a single input
-            activation_sizes = {k: v[0].size() for k, v in example_activations.items()}
-            self.init_variables(
-                activation_sizes, device=next(iter(example_activations.values())).device
-            )
+            if num_processes > 1:
+                if max_steps:
+                    data = Subset(data, range(min(len(data), max_steps * batch_size)))
+                self._train_parallel(data, batch_size, num_processes, devices)
+            else:
+                if pbar:
+                    data_loader = tqdm(data_loader, total=max_steps or len(data_loader))
 
-            if pbar:
-                data_loader = tqdm(data_loader, total=max_steps or len(data_loader))
+                for i, batch in enumerate(self._iter_batches(data_loader)):
+                    if max_steps and i >= max_steps:
+                        break
+                    activations = self.get_activations(batch)
+                    self.batch_update(activations)
 
-            for i, batch in enumerate(data_loader):
-                if max_steps and i >= max_steps:
-                    break
-                activations = self.get_activations(batch)
-                self.batch_update(activations)
+        self._finish_training(**kwargs)
+
+    def _train_parallel(
+        self,
+        data: Dataset,
+        batch_size: int,
+        num_processes: int,
+        devices: list[str] | None,
+    ):
+        # Contiguous shards, so every worker can still group inputs by length
+        bounds = [i * len(data) // num_processes for i in range(num_processes + 1)]
+        shards = [
+            Subset(data, range(start, end)) for start, end in zip(bounds, bounds[1:])
+        ]
+        # The model still has the hooks of our capture. They don't do anything in
+        # the pickled copies the workers get (see `ActivationCapture`), and workers
+        # create their own capture.
+        worker = copy.copy(self)
+        worker._capture = None
+
+        context = torch.multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(num_processes, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    _train_shard,
+                    worker,
+                    shard,
+                    batch_size,
+                    devices[i % len(devices)] if devices else None,
+                )
+                for i, shard in enumerate(shards)
+                if len(shard) > 0
+            ]
+            for future in tqdm(futures, desc="Shards"):
+                # Raises errors from the workers
+                self._merge_statistics(future.result())
 
 
 class ActivationCovarianceBasedDetector(StatisticalDetector):
     """Generic abstract detector that learns means and covariance matrices
-    during training."""
+    during training.
+
+    Args:
+        accumulation_dtype: Data type for accumulating means and covariances, and
+            for computing derived quantities (e.g. inverse covariance matrices) after
+            training. Trained variables are converted to the default dtype in the
+            end. torch.float64 is much more robust when training on many samples
+            and high-dimensional activations.
+        covariance_rank: If given, covariance matrices are approximated as a
+            `LowRankCovariance` with this rank, see `RunningLowRankCovariance`.
+            This needs O(dim * rank) instead of O(dim**2) memory, which makes it
+            possible to use entire flattened layers (see `utils.flatten_last`).
+            `self.covariances` then contains `LowRankCovariance`s instead of
+            tensors.
+        See `ActivationBasedDetector` for the other arguments.
+    """
+
+    def __init__(
+        self,
+        activation_names: list[str],
+        activation_processing_func: Callable[[torch.Tensor, Any, str], torch.Tensor]
+        | None = None,
+        cache: ActivationCache | None = None,
+        layer_aggregation: str = "mean",
+        prefetch: int = 0,
+        accumulation_dtype: torch.dtype = torch.float32,
+        covariance_rank: int | None = None,
+    ):
+        super().__init__(
+            activation_names=activation_names,
+            activation_processing_func=activation_processing_func,
+            cache=cache,
+            layer_aggregation=layer_aggregation,
+            prefetch=prefetch,
+        )
+        self.accumulation_dtype = accumulation_dtype
+        self.covariance_rank = covariance_rank
 
     def init_variables(self, activation_sizes: dict[str, torch.Size], device):
         if any(len(size) != 1 for size in activation_sizes.values()):
@@ -80,24 +225,42 @@ class ActivationCovarianceBasedDetector(StatisticalDetector):
                 "If this is unintentional, pass "
                 "`activation_preprocessing_func=utils.flatten_last`."
             )
-        self._means = {
-            k: torch.zeros(size[-1], device=device)
-            for k, size in activation_sizes.items()
-        }
-        self._Cs = {
-            k: torch.zeros((size[-1], size[-1]), device=device)
-            for k, size in activation_sizes.items()
-        }
-        self._ns = {k: 0 for k in activation_sizes.keys()}
+        if self.covariance_rank is None:
+            self._stats = {
+                k: RunningCovariance(
+                    size[-1], device=device, dtype=self.accumulation_dtype
+                )
+                for k, size in activation_sizes.items()
+            }
+        else:
+            self._stats = {
+                k: RunningLowRankCovariance(
+                    size[-1],
+                    self.covariance_rank,
+                    device=device,
+                    dtype=self.accumulation_dtype,
+                )
+                for k, size in activation_sizes.items()
+            }
 
     def batch_update(self, activations: dict[str, torch.Tensor]):
         for k, activation in activations.items():
             # Flatten the activations to (batch, dim)
             activation = rearrange(activation, "batch ... dim -> (batch ...) dim")
             assert activation.ndim == 2, activation.shape
-            self._means[k], self._Cs[k], self._ns[k] = update_covariance(
-                self._means[k], self._Cs[k], self._ns[k], activation
-            )
+            self._stats[k].update(activation)
+
+    def _get_statistics(
+        self,
+    ) -> dict[str, RunningCovariance] | dict[str, RunningLowRankCovariance]:
+        return {k: stats.to("cpu") for k, stats in self._stats.items()}
+
+    def _merge_statistics(
+        self,
+        statistics: dict[str, RunningCovariance] | dict[str, RunningLowRankCovariance],
+    ):
+        for k, stats in statistics.items():
+            self._stats[k].merge(stats)
 
     @abstractmethod
     def post_covariance_training(self, **kwargs):
@@ -139,16 +302,30 @@ class ActivationCovarianceBasedDetector(StatisticalDetector):
         }
         return scores
 
-    def train(self, trusted_data, untrusted_data, **kwargs):
-        super().train(
-            trusted_data=trusted_data, untrusted_data=untrusted_data, **kwargs
-        )
-
+    def _finish_training(self, **kwargs):
         # Post process
         with torch.inference_mode():
-            self.means = self._means
-            self.covariances = {k: C / (self._ns[k] - 1) for k, C in self._Cs.items()}
-            if any(torch.count_nonzero(C) == 0 for C in self.covariances.values()):
+            self.means = {k: stats.mean for k, stats in self._stats.items()}
+            self.covariances = {k: stats.covariance for k, stats in self._stats.items()}
+            if any(
+                torch.count_nonzero(
+                    C.variances() if isinstance(C, LowRankCovariance) else C
+                )
+                == 0
+                for C in self.covariances.values()
+            ):
                 raise RuntimeError("All zero covariance matrix detected.")
 
             self.post_covariance_training(**kwargs)
+
+            dtype = torch.get_default_dtype()
+            if self.accumulation_dtype != dtype:
+                # Scores are computed in the usual precision
+                self._set_trained_variables(
+                    utils.tree_map(
+                        lambda x: x.to(dtype)
+                        if isinstance(x, torch.Tensor) and x.is_floating_point()
+                        else x,
+                        self._get_trained_variables(),
+                    )
+                )
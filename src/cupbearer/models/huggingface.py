@@ -1,5 +1,8 @@
 import torch
 
+# Tokenizer arguments that are also supported when padding pretokenized inputs
+_PAD_KWARGS = {"padding", "max_length", "pad_to_multiple_of"}
+
 
 class HuggingfaceLM(torch.nn.Module):
     def __init__(
@@ -8,6 +11,8 @@ class HuggingfaceLM(torch.nn.Module):
         model=None,
         tokenize_kwargs = {"padding": True},
         device="cuda",
+        fingerprint: str | None = None,
+        padded_length: int | None = None,
     ):
         """A wrapper around a HF model that handles tokenization and device placement.
 
@@ -19,12 +24,31 @@ class HuggingfaceLM(torch.nn.Module):
                 is None.
             tokenizer_kwargs: kwargs to pass to tokenizer on forward
             device: The device to place the model on.
+            fingerprint: Identifies the model for activation caches. If None, a
+                fingerprint is computed from the weights. Setting this (e.g. to the
+                name of the HF checkpoint) is necessary to use cached activations
+                with `model=None`.
+            padded_length: If the tokenizer pads on the left, position ids are
+                chosen as if every input had been padded to this length. This lets
+                models that were trained with `padding="max_length"` use dynamic
+                padding (which is much cheaper for short inputs) with identical
+                results. Batches longer than `padded_length` aren't truncated and
+                get position ids starting at zero, like with `padding="max_length"`.
+                Note that with dynamic padding, activations along the sequence
+                dimension have a different length in each batch, so they can't be
+                stored in an `ActivationCache`. Reduce them to a fixed shape first
+                (e.g. with `last_token_indices`).
         """
         super().__init__()
         self.hf_model = model
         self.tokenizer = tokenizer
         self.device = device
         self.tokenize_kwargs = tokenize_kwargs
+        self.fingerprint = fingerprint
+        self.padded_length = padded_length
+        # Inputs and attention mask of the last forward pass, so activation
+        # processing functions don't need to tokenize the inputs again.
+        self._last_tokens: tuple[list[str] | str, torch.Tensor] | None = None
 
         # HACK: We often use next(model.parameters()).device to figure out which
         # device a model is on. We'd like that to still work even if there's no model.
@@ -34,13 +58,58 @@ class HuggingfaceLM(torch.nn.Module):
     def tokenize(self, inputs: list[str] | str, **kwargs):
         if self.tokenizer is None:
             raise ValueError("No tokenizer is set, so inputs can't be tokenized.")
-        return self.tokenizer(inputs, return_tensors="pt", **kwargs).to(self.device)
+        # Imported here since cupbearer.data indirectly imports this module
+        from cupbearer.data import TokenizedText
+
+        if (
+            isinstance(inputs, list)
+            and inputs
+            and all(isinstance(x, TokenizedText) for x in inputs)
+        ):
+            # Pretokenized inputs, see `HuggingfaceDataset.pretokenize`
+            tokens = self.tokenizer.pad(
+                {"input_ids": [x.input_ids for x in inputs]},
+                return_tensors="pt",
+                **{k: v for k, v in kwargs.items() if k in _PAD_KWARGS},
+            )
+        else:
+            tokens = self.tokenizer(inputs, return_tensors="pt", **kwargs)
+        return tokens.to(self.device)
+
+    def model_inputs(self, inputs: list[str] | str) -> dict[str, torch.Tensor]:
+        """Tokenize inputs and compute any other arguments for the HF model."""
+        tokens = dict(self.tokenize(inputs, **self.tokenize_kwargs))
+        if self.padded_length is not None and self.tokenizer.padding_side == "left":
+            # Real tokens are at the end, so they'd be at the same positions if we
+            # padded further on the left. Padding tokens are masked out anyway.
+            seq_len = tokens["input_ids"].shape[-1]
+            offset = max(self.padded_length - seq_len, 0)
+            position_ids = torch.arange(seq_len, device=self.device) + offset
+            tokens["position_ids"] = position_ids.expand_as(tokens["input_ids"])
+        self._last_tokens = (inputs, tokens["attention_mask"])
+        return tokens
+
+    def attention_mask(self, inputs: list[str] | str) -> torch.Tensor:
+        """Get the attention mask for `inputs`, as used in the forward pass.
+
+        If these inputs (the same object, not just equal strings) were just passed
+        through the model, this reuses the mask from that forward pass instead of
+        tokenizing again.
+        """
+        if self._last_tokens is not None and self._last_tokens[0] is inputs:
+            return self._last_tokens[1]
+        return self.tokenize(inputs, **self.tokenize_kwargs)["attention_mask"]
+
+    def last_token_indices(self, inputs: list[str] | str) -> torch.Tensor:
+        """Get the position of the last non-padding token of each input."""
+        mask = self.attention_mask(inputs)
+        # Works for both left and right padding
+        return mask.shape[-1] - 1 - mask.flip(-1).argmax(dim=-1)
 
     def forward(self, inputs: list[str] | str):
         if self.hf_model is None:
             raise ValueError("No model is set, so forward pass can't be run.")
-        tokens = self.tokenize(inputs, **self.tokenize_kwargs)
-        return self.hf_model(**tokens)
+        return self.hf_model(**self.model_inputs(inputs))
 
     def make_last_token_hook(self):
         """Make a hook that retrieves the activation at the last token position.
@@ -57,11 +126,9 @@ class HuggingfaceLM(torch.nn.Module):
             assert activation.shape[-1] == 4096, activation.shape
             batch_size = len(inputs)
 
-            # Tokenize the inputs to know how many tokens there are.
-            # It's a bit unfortunate that we're doing this twice (once here,
-            # once in the model forward pass), but not a huge deal.
-            tokens = self.tokenize(inputs)
-            last_non_padding_index = tokens["attention_mask"].sum(dim=1) - 1
+            # Usually this is just a lookup, since the model was just called
+            # with these inputs.
+            last_non_padding_index = self.last_token_indices(inputs)
 
             return activation[range(batch_size), last_non_padding_index, :]
 
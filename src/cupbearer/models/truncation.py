@@ -0,0 +1,168 @@
+import copy
+import sys
+from typing import Any, Callable
+
+import torch
+from torch import nn
+
+from .huggingface import HuggingfaceLM
+from .models import CNN, MLP, PreActResNet
+
+# A stage of a model is a module name (or None for steps that aren't modules, like
+# reshaping) and a function that computes the output of the stage from its input.
+# Running all stages of a model in order is the same as running the model.
+Stage = tuple[str | None, Callable[[Any], Any]]
+
+
+def _flatten(x):
+    return x.view(x.shape[0], -1)
+
+
+def _mlp_stages(model: MLP, prefix: str = "") -> list[Stage]:
+    stages: list[Stage] = [(None, _flatten)]
+    for name, layer in model.layers.items():
+        stages.append((f"{prefix}layers.{name}", layer))
+    return stages
+
+
+def _cnn_stages(model: CNN) -> list[Stage]:
+    stages: list[Stage] = [
+        (f"conv_layers.{name}", layer) for name, layer in model.conv_layers.items()
+    ]
+    stages.append(("global_pool", model.global_pool))
+    return stages + _mlp_stages(model.mlp, prefix="mlp.")
+
+
+def _resnet_head(x):
+    out = torch.nn.functional.avg_pool2d(x, 4)
+    return out.view(out.size(0), -1)
+
+
+def _resnet_stages(model: PreActResNet) -> list[Stage]:
+    names = ["conv1", "layer1", "layer2", "layer3", "layer4"]
+    stages: list[Stage] = [(name, getattr(model, name)) for name in names]
+    return stages + [(None, _resnet_head), ("linear", model.linear)]
+
+
+def _stage_index(stages: list[Stage], module_name: str) -> int | None:
+    for i, (prefix, _) in enumerate(stages):
+        if prefix is not None and (
+            module_name == prefix or module_name.startswith(prefix + ".")
+        ):
+            return i
+    return None
+
+
+def _run_stages(stages: list[Stage]):
+    def run(x):
+        for _, stage in stages:
+            x = stage(x)
+        return x
+
+    return run
+
+
+def _is_hooked_transformer(model: nn.Module) -> bool:
+    # If transformer_lens hasn't been imported, this can't be a HookedTransformer,
+    # and we don't want to import it just to check.
+    transformer_lens = sys.modules.get("transformer_lens")
+    if transformer_lens is None:
+        return False
+    return isinstance(model, transformer_lens.HookedTransformer)
+
+
+def _truncate_hooked_transformer(model, module_names: set[str]):
+    last_layer = -1
+    for name in module_names:
+        parts = name.split(".")
+        if parts[0] == "blocks" and len(parts) > 1:
+            last_layer = max(last_layer, int(parts[1]))
+        elif parts[0] not in {"embed", "hook_embed", "pos_embed", "hook_pos_embed"}:
+            return None
+    if last_layer == model.cfg.n_layers - 1:
+        return None
+
+    def run(*args, **kwargs):
+        return model(*args, stop_at_layer=last_layer + 1, **kwargs)
+
+    return run
+
+
+def _truncate_huggingface(model: HuggingfaceLM, module_names: set[str]):
+    hf_model = model.hf_model
+    if hf_model is None:
+        return None
+    base_model = hf_model.base_model
+    # Decoder layers are called `layers` in Llama-style models, `h` in GPT-2 style
+    # ones (including CodeGen).
+    for attr in ["layers", "h"]:
+        layers = getattr(base_model, attr, None)
+        if isinstance(layers, nn.ModuleList):
+            break
+    else:
+        return None
+
+    prefix = f"hf_model.{hf_model.base_model_prefix}.{attr}."
+    last_layer = -1
+    for name in module_names:
+        if not name.startswith(prefix):
+            return None
+        last_layer = max(last_layer, int(name[len(prefix) :].split(".")[0]))
+    if last_layer == len(layers) - 1:
+        return None
+
+    # Shallow copy of the base model (without the LM head) that shares all modules,
+    # except that it only has the layers we need.
+    truncated = copy.copy(base_model)
+    truncated._modules = copy.copy(base_model._modules)
+    setattr(truncated, attr, layers[: last_layer + 1])
+
+    def run(inputs):
+        return truncated(**model.model_inputs(inputs), use_cache=False)
+
+    return run
+
+
+def truncate_model(model: nn.Module, names: list[str]) -> Callable[..., Any] | None:
+    """Build a function that runs `model` only as far as needed for some activations.
+
+    Supports `MLP`, `CNN`, `PreActResNet`, `HuggingfaceLM` (for models with a
+    standard decoder stack) and transformer_lens' `HookedTransformer`. The
+    truncated model shares all modules with `model`, so hooks registered on the
+    original modules still work. Its output is meaningless, activations need to be
+    captured with hooks (see `utils.ActivationCapture`).
+
+    Args:
+        model: The model to truncate.
+        names: Activation names in the format used by `utils.get_activations`.
+
+    Returns:
+        A function that takes the same inputs as `model`, or None if the model isn't
+        supported, or if the entire model is needed anyway.
+    """
+    module_names = {".".join(name.split(".")[:-1]) for name in names}
+    if not module_names:
+        return None
+
+    if isinstance(model, HuggingfaceLM):
+        return _truncate_huggingface(model, module_names)
+    if _is_hooked_transformer(model):
+        return _truncate_hooked_transformer(model, module_names)
+
+    if isinstance(model, MLP):
+        stages = _mlp_stages(model)
+    elif isinstance(model, CNN):
+        stages = _cnn_stages(model)
+    elif isinstance(model, PreActResNet):
+        stages = _resnet_stages(model)
+    else:
+        return None
+
+    indices = [_stage_index(stages, name) for name in module_names]
+    if any(i is None for i in indices):
+        # E.g. the model itself, or containers that are never called
+        return None
+    last_stage = max(indices)  # type: ignore
+    if last_stage == len(stages) - 1:
+        return None
+    return _run_stages(stages[: last_stage + 1])
@@ -1,3 +1,5 @@
+from typing import Callable
+
 import lightning as L
 import torch
 from torchmetrics.classification import Accuracy
@@ -17,10 +19,11 @@ class Classifier(L.LightningModule):
         test_loader_names: list[str] | None = None,
         save_hparams: bool = True,
         task: ClassificationTask = "multiclass",
+        batch_transforms: list[Callable] | None = None,
     ):
         super().__init__()
         if save_hparams:
-            self.save_hyperparameters(ignore=["model"])
+            self.save_hyperparameters(ignore=["model", "batch_transforms"])
         if val_loader_names is None:
             val_loader_names = []
         if test_loader_names is None:
@@ -31,6 +34,9 @@ class Classifier(L.LightningModule):
         self.val_loader_names = val_loader_names
         self.test_loader_names = test_loader_names
         self.task = task
+        # Applied to training batches after they've been moved to the device,
+        # e.g. `Backdoor.inject_batch`
+        self.batch_transforms = batch_transforms or []
         self.loss_func = self._get_loss_func(self.task)
         self.train_accuracy = Accuracy(
             task=self.task, num_classes=num_classes, num_labels=num_labels
@@ -60,6 +66,8 @@ class Classifier(L.LightningModule):
         return loss, logits, y
 
     def training_step(self, batch, batch_idx):
+        for transform in self.batch_transforms:
+            batch = transform(batch)
         loss, logits, y = self._shared_step(batch)
         self.log("train/loss", loss, prog_bar=True)
         self.train_accuracy(logits, y)
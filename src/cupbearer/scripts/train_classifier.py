@@ -1,6 +1,6 @@
 import warnings
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import lightning as L
 import torch
@@ -20,6 +20,9 @@ def main(
     num_labels: int | None = None,
     task: ClassificationTask = "multiclass",
     val_loaders: DataLoader | dict[str, DataLoader] | None = None,
+    # Applied to each training batch on the device, e.g. `Backdoor.inject_batch` to
+    # poison a clean `train_loader` on the GPU.
+    batch_transforms: list[Callable] | None = None,
     # If True, returns the Lighting Trainer object (which has the model and a bunch
     # of other information, this may be useful when using interactively).
     # Otherwise (default), return only a dictionary of latest metrics, to avoid e.g.
@@ -44,6 +47,7 @@ def main(
         lr=lr,
         val_loader_names=list(val_loaders.keys()),
         task=task,
+        batch_transforms=batch_transforms,
     )
 
     callbacks = trainer_kwargs.pop("callbacks", [])
@@ -14,11 +14,27 @@ TASKS = {
 }
 
 
-def measurement_tampering_dataset(dataset):
-    return HuggingfaceDataset(dataset, label_key="labels")
+def measurement_tampering_dataset(dataset, tokenizer=None, num_proc: int | None = None):
+    dataset = HuggingfaceDataset(dataset, label_key="labels")
+    if tokenizer is not None:
+        dataset = dataset.pretokenize(tokenizer, num_proc=num_proc)
+    return dataset
 
 
-def measurement_tampering(task_name: str = "diamonds", device="cuda", untrusted_labels: bool=False):
+def measurement_tampering(
+    task_name: str = "diamonds",
+    device="cuda",
+    untrusted_labels: bool = False,
+    pretokenize: bool = False,
+    num_proc: int | None = None,
+):
+    """Detecting tampering with measurements, e.g. on the diamonds dataset.
+
+    Args:
+        pretokenize: Whether to tokenize all inputs ahead of time (see
+            `HuggingfaceDataset.pretokenize`).
+        num_proc: Number of processes for pretokenization.
+    """
     # load model and tokenizer
     config = AutoConfig.from_pretrained(
         TASKS[task_name]["model"], trust_remote_code=True
@@ -64,19 +80,24 @@ def measurement_tampering(task_name: str = "diamonds", device="cuda", untrusted_
         lambda x: not x["is_clean"] and is_tampering(x)
     )
 
-    tokenize_kwargs = {"padding": "max_length", "max_length": 1024}
+    def make_dataset(dataset):
+        return measurement_tampering_dataset(
+            dataset, tokenizer=tokenizer if pretokenize else None, num_proc=num_proc
+        )
 
     return Task.from_separate_data(
         model=HuggingfaceLM(
-            model=model, tokenizer=tokenizer, device=device, 
-            tokenize_kwargs=tokenize_kwargs
-        ),
-        trusted_data=measurement_tampering_dataset(trusted_data),
-        clean_test_data=measurement_tampering_dataset(clean_test_data),
-        anomalous_test_data=measurement_tampering_dataset(anomolous_test_data),
-        clean_untrusted_data=measurement_tampering_dataset(clean_untrusted_data),
-        anomalous_untrusted_data=measurement_tampering_dataset(
-            anomalous_untrusted_data
+            model=model,
+            tokenizer=tokenizer,
+            device=device,
+            # Pad dynamically instead of always padding to 1024 tokens, but keep
+            # the positions of tokens the same as with `padding="max_length"`.
+            padded_length=1024,
         ),
+        trusted_data=make_dataset(trusted_data),
+        clean_test_data=make_dataset(clean_test_data),
+        anomalous_test_data=make_dataset(anomolous_test_data),
+        clean_untrusted_data=make_dataset(clean_untrusted_data),
+        anomalous_untrusted_data=make_dataset(anomalous_untrusted_data),
         untrusted_labels=untrusted_labels
     )
@@ -8,8 +8,13 @@ from cupbearer.models import HuggingfaceLM
 from .task import Task
 
 
-def quirky_dataset(dataset):
-    return HuggingfaceDataset(dataset, text_key="statement", label_key="label")
+def quirky_dataset(dataset, tokenizer=None, num_proc: int | None = None):
+    if dataset is None:
+        return None
+    dataset = HuggingfaceDataset(dataset, text_key="statement", label_key="label")
+    if tokenizer is not None:
+        dataset = dataset.pretokenize(tokenizer, num_proc=num_proc)
+    return dataset
 
 
 def quirky_lm(
@@ -18,7 +23,16 @@ def quirky_lm(
     device="cuda",
     include_untrusted: bool = False,
     fake_model: bool = False,
+    pretokenize: bool = False,
+    num_proc: int | None = None,
 ):
+    """Detecting quirky behavior of LMs finetuned to lie for a specific character.
+
+    Args:
+        pretokenize: Whether to tokenize all inputs ahead of time (see
+            `HuggingfaceDataset.pretokenize`). Requires a real model.
+        num_proc: Number of processes for pretokenization.
+    """
     from elk_generalization.datasets.loader_utils import templatize_quirky_dataset
     from peft import AutoPeftModelForCausalLM
 
@@ -30,6 +44,9 @@ def quirky_lm(
     name_str = "multiname" if random_names else "singlename"
     model_name = f"ejenner/quirky_sciq_mistral7b_{mixture_str}_{name_str}"
 
+    if pretokenize and fake_model:
+        raise ValueError("Pretokenizing requires a tokenizer, so fake_model=False.")
+
     model = None
     tokenizer = None
     # We might not want to actually load a model if we're getting all activations
@@ -111,11 +128,18 @@ def quirky_lm(
     else:
         logger.debug("No untrusted data")
 
+    def make_dataset(dataset):
+        return quirky_dataset(
+            dataset, tokenizer=tokenizer if pretokenize else None, num_proc=num_proc
+        )
+
     return Task.from_separate_data(
-        model=HuggingfaceLM(model=model, tokenizer=tokenizer, device=device),
-        trusted_data=quirky_dataset(alice_trusted),
-        clean_test_data=quirky_dataset(alice_test),
-        anomalous_test_data=quirky_dataset(bob_test),
-        clean_untrusted_data=quirky_dataset(alice_untrusted),
-        anomalous_untrusted_data=quirky_dataset(bob_train),
+        model=HuggingfaceLM(
+            model=model, tokenizer=tokenizer, device=device, fingerprint=model_name
+        ),
+        trusted_data=make_dataset(alice_trusted),
+        clean_test_data=make_dataset(alice_test),
+        anomalous_test_data=make_dataset(bob_test),
+        clean_untrusted_data=make_dataset(alice_untrusted),
+        anomalous_untrusted_data=make_dataset(bob_train),
     )
@@ -8,7 +8,11 @@ from typing import Union, overload
 
 import torch
 
-from .get_activations import get_activations, get_activations_and_grads  # noqa: F401
+from .get_activations import (  # noqa: F401
+    ActivationCapture,
+    get_activations,
+    get_activations_and_grads,
+)
 
 SUFFIX = ".pt"
 TYPE_PREFIX = "__TYPE__:"
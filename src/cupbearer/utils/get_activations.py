@@ -1,17 +1,183 @@
+import weakref
 from typing import Callable
 
 import torch
 
+from cupbearer.models.truncation import truncate_model
+
 
 class _Finished(Exception):
     pass
 
 
+def _check_names(model: torch.nn.Module, names: list[str]):
+    all_module_names = {name for name, _ in model.named_modules()}
+    for name in names:
+        assert name.endswith(".input") or name.endswith(
+            ".output"
+        ), f"Invalid name {name}, names should end with '.input' or '.output'"
+        base_name = ".".join(name.split(".")[:-1])
+        assert (
+            base_name in all_module_names
+        ), f"{base_name} is not a submodule of the model"
+
+
+def _input_tensor(input) -> torch.Tensor:
+    if isinstance(input, torch.Tensor):
+        return input
+    elif isinstance(input[0], torch.Tensor):
+        return input[0]
+    raise ValueError(
+        "Expected input to be a tensor or tuple with tensor as "
+        f"first element, got {type(input)}"
+    )
+
+
+class ActivationCapture:
+    """Reusable hooks for getting activations of a model, see `get_activations`.
+
+    Module names are resolved and hooks are registered only once, when the capture
+    is created. The hooks stay installed until `remove()` is called (or the capture
+    is garbage collected) and do nothing unless `get_activations` is running, so
+    models can be used normally in the meantime. This avoids walking all modules
+    and registering hooks for every batch, which is noticeable for large models.
+
+    Can be used as a context manager, which removes the hooks at the end.
+
+    For supported models (see `models.truncation.truncate_model`), only the part of
+    the model that's needed for the requested activations is run. For other models,
+    the forward pass is stopped by raising an exception from a hook once all
+    activations have been computed.
+
+    Args:
+        model: The model to get the activations from.
+        names: All names that activations might be requested for, in the same format
+            as for `get_activations`.
+        truncate: Whether to run truncated models where possible. If False, the
+            exception-based early exit is always used.
+    """
+
+    def __init__(self, model: torch.nn.Module, names: list[str], truncate: bool = True):
+        self._hooks = []
+        _check_names(model, names)
+        self.model = model
+        self.names = list(names)
+        self.truncate = truncate
+        # Truncated models for each set of requested names, built lazily
+        self._truncated: dict[frozenset[str], Callable | None] = {}
+        # Only set while get_activations is running
+        self._activations: dict[str, torch.Tensor] | None = None
+        self._needed: set[str] = set()
+        self._stop_early = False
+
+        name_set = set(names)
+        for module_name, module in model.named_modules():
+            input_name = module_name + ".input"
+            output_name = module_name + ".output"
+            if input_name in name_set or output_name in name_set:
+                self._hooks.append(
+                    module.register_forward_hook(
+                        _CaptureHook(self, input_name, output_name)
+                    )
+                )
+
+    def get_activations(
+        self, names: list[str], *args, **kwargs
+    ) -> dict[str, torch.Tensor]:
+        """Run the model and return the activations for `names`.
+
+        `names` must be a subset of the names passed to the constructor. The forward
+        pass is stopped as soon as all of them have been computed. Other arguments
+        are passed to the model.
+        """
+        unknown = set(names) - set(self.names)
+        if unknown:
+            raise ValueError(f"Activations {unknown} weren't registered for capture")
+        if self._activations is not None:
+            raise RuntimeError("Activation capture is already running")
+
+        run = self._truncated_model(names)
+        self._activations = {}
+        self._needed = set(names)
+        self._stop_early = run is None
+        try:
+            with torch.no_grad():
+                if run is not None:
+                    run(*args, **kwargs)
+                else:
+                    try:
+                        self.model(*args, **kwargs)
+                    except _Finished:
+                        pass
+            return self._activations
+        finally:
+            self._activations = None
+            self._needed = set()
+
+    def _truncated_model(self, names: list[str]) -> Callable | None:
+        if not self.truncate:
+            return None
+        key = frozenset(names)
+        if key not in self._truncated:
+            self._truncated[key] = truncate_model(self.model, names)
+        return self._truncated[key]
+
+    def remove(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.remove()
+
+    def __del__(self):
+        self.remove()
+
+
+class _CaptureHook:
+    """Forward hook that stores activations for an `ActivationCapture`."""
+
+    def __init__(self, capture: ActivationCapture, input_name: str, output_name: str):
+        # Only a weak reference, so that the model doesn't keep captures alive that
+        # aren't used anymore.
+        self._ref: weakref.ref[ActivationCapture] | None = weakref.ref(capture)
+        self.input_name = input_name
+        self.output_name = output_name
+
+    def __getstate__(self):
+        # Weak references can't be pickled. Copies of the model (e.g. in worker
+        # processes) don't belong to the capture, so their hooks do nothing.
+        state = self.__dict__.copy()
+        state["_ref"] = None
+        return state
+
+    def __call__(self, module, input, output):
+        capture = self._ref() if self._ref is not None else None
+        if capture is None or capture._activations is None:
+            return
+        activations = capture._activations
+        if self.input_name in capture._needed:
+            activations[self.input_name] = _input_tensor(input)
+        if self.output_name in capture._needed:
+            activations[self.output_name] = output
+
+        if capture._stop_early and len(activations) == len(capture._needed):
+            # HACK: stop the forward pass to save time
+            raise _Finished()
+
+
 def get_activations(
     model: torch.nn.Module, names: list[str], *args, **kwargs
 ) -> dict[str, torch.Tensor]:
     """Get the activations of the model for the given inputs.
 
+    This registers hooks on every call, use an `ActivationCapture` to get activations
+    for many batches. Only the part of the model that's needed is run, see
+    `ActivationCapture`.
+
     Args:
         model: The model to get the activations from.
         names: The names of the modules to get the activations from. Should be a list
@@ -25,62 +191,13 @@ def get_activations(
         A dictionary mapping the names of the modules to the activations of the model
         at that module. Keys contain ".input" or ".output" just like `names`.
     """
-    activations = {}
-    hooks = []
-
-    try:
-        all_module_names = [name for name, _ in model.named_modules()]
-
-        for name in names:
-            assert name.endswith(".input") or name.endswith(
-                ".output"
-            ), f"Invalid name {name}, names should end with '.input' or '.output'"
-            base_name = ".".join(name.split(".")[:-1])
-            assert (
-                base_name in all_module_names
-            ), f"{base_name} is not a submodule of the model"
-
-        def make_hook(name, is_input):
-            def hook(module, input, output):
-                if is_input:
-                    if isinstance(input, torch.Tensor):
-                        activations[name] = input
-                    elif isinstance(input[0], torch.Tensor):
-                        activations[name] = input[0]
-                    else:
-                        raise ValueError(
-                            "Expected input to be a tensor or tuple with tensor as "
-                            f"first element, got {type(input)}"
-                        )
-                else:
-                    activations[name] = output
-
-                if set(names).issubset(activations.keys()):
-                    # HACK: stop the forward pass to save time
-                    raise _Finished()
+    with ActivationCapture(model, names) as capture:
+        return capture.get_activations(names, *args, **kwargs)
 
-            return hook
-
-        for name, module in model.named_modules():
-            if name + ".input" in names:
-                hooks.append(
-                    module.register_forward_hook(make_hook(name + ".input", True))
-                )
-            if name + ".output" in names:
-                hooks.append(
-                    module.register_forward_hook(make_hook(name + ".output", False))
-                )
-        with torch.no_grad():
-            try:
-                model(*args, **kwargs)
-            except _Finished:
-                pass
-    finally:
-        # Make sure we always remove hooks even if an exception is raised
-        for hook in hooks:
-            hook.remove()
 
-    return activations
+def _first_tensor(x) -> torch.Tensor:
+    # Module outputs can be tuples (e.g. for transformer layers)
+    return x if isinstance(x, torch.Tensor) else x[0]
 
 
 def get_activations_and_grads(
@@ -92,84 +209,91 @@ def get_activations_and_grads(
 ) -> tuple[dict[str, torch.Tensor], dict[str, torch.Tensor]]:
     """Get the activations and gradients of the model for the given inputs.
 
+    Gradients are computed for all activations with a single backward pass. If
+    `output_func` returns several outputs per sample, the gradients for all of them
+    are computed at once using batched gradients, e.g. pass `lambda logits: logits`
+    to get the gradients of every logit.
+
     Args:
         See `get_activations`.
         output_func: A function that takes the output of the model and reduces
-            to a (batch_size, ) shaped tensor.
+            it to a (batch_size, ) or (batch_size, num_outputs) shaped tensor.
 
     Returns:
         `(activations, gradients)` where both are dictionaries as in `get_activations`.
+        Gradients have shape (batch_size, ...) for 1D outputs, or
+        (batch_size, num_outputs, ...) otherwise, where ... is the activation shape.
     """
     activations = {}
-    gradients = {}
     hooks = []
 
-    try:
-        all_module_names = [name for name, _ in model.named_modules()]
-
-        for name in names:
-            assert name.endswith(".input") or name.endswith(
-                ".output"
-            ), f"Invalid name {name}, names should end with '.input' or '.output'"
-            base_name = ".".join(name.split(".")[:-1])
-            assert (
-                base_name in all_module_names
-            ), f"{base_name} is not a submodule of the model"
-
-        def make_hooks(name, is_input):
-            def forward_hook(module, input, output):
-                if is_input:
-                    if isinstance(input, torch.Tensor):
-                        activations[name] = input
-                    elif isinstance(input[0], torch.Tensor):
-                        activations[name] = input[0]
-                    else:
-                        raise ValueError(
-                            "Expected input to be a tensor or tuple with tensor as "
-                            f"first element, got {type(input)}"
-                        )
-                else:
-                    activations[name] = output
+    def make_pre_hook(name):
+        def pre_hook(module, input):
+            input_tensor = _input_tensor(input)
+            if not input_tensor.requires_grad:
+                # E.g. the inputs to the model, we need to track gradients for these.
+                # This doesn't cut off any gradients since none were tracked before.
+                input_tensor = input_tensor.detach().requires_grad_()
+            activations[name] = input_tensor
+            if isinstance(input, torch.Tensor):
+                return input_tensor
+            return (input_tensor, *input[1:])
 
-            def backward_hook(module, grad_input, grad_output):
-                if isinstance(grad_input, tuple):
-                    grad_input, *_ = grad_input
-                if isinstance(grad_output, tuple):
-                    grad_output, *_ = grad_output
+        return pre_hook
 
-                if is_input:
-                    gradients[name] = grad_input
-                else:
-                    gradients[name] = grad_output
+    def make_hook(name):
+        def hook(module, input, output):
+            activations[name] = output
 
-                if set(names).issubset(gradients.keys()):
-                    # HACK: stop the backward pass to save time
-                    raise _Finished()
+        return hook
 
-            return forward_hook, backward_hook
+    try:
+        _check_names(model, names)
 
         for name, module in model.named_modules():
             if name + ".input" in names:
-                forward_hook, backward_hook = make_hooks(name + ".input", True)
-                hooks.append(module.register_forward_hook(forward_hook))
-                hooks.append(module.register_full_backward_hook(backward_hook))
+                hooks.append(
+                    module.register_forward_pre_hook(make_pre_hook(name + ".input"))
+                )
             if name + ".output" in names:
-                forward_hook, backward_hook = make_hooks(name + ".output", False)
-                hooks.append(module.register_forward_hook(forward_hook))
-                hooks.append(module.register_full_backward_hook(backward_hook))
+                hooks.append(module.register_forward_hook(make_hook(name + ".output")))
+
         with torch.enable_grad():
-            try:
-                out = model(*args, **kwargs)
-                out = output_func(out)
-                assert out.ndim == 1, "output_func should reduce to a 1D tensor"
-                out.backward(torch.ones_like(out))
-            except _Finished:
-                pass
+            out = output_func(model(*args, **kwargs))
+            assert out.ndim in {1, 2}, "output_func should reduce to a 1D or 2D tensor"
+            # Modules that weren't called don't have activations
+            captured = [name for name in names if name in activations]
+            tensors = [_first_tensor(activations[name]) for name in captured]
+            if out.ndim == 1:
+                grads = torch.autograd.grad(
+                    out, tensors, grad_outputs=torch.ones_like(out), allow_unused=True
+                )
+            else:
+                # One backward pass for each output, batched with vmap. The i-th
+                # grad_output selects the i-th output of every sample.
+                num_outputs = out.shape[1]
+                grad_outputs = torch.eye(
+                    num_outputs, dtype=out.dtype, device=out.device
+                )[:, None, :].expand(num_outputs, *out.shape)
+                grads = torch.autograd.grad(
+                    out,
+                    tensors,
+                    grad_outputs=grad_outputs,
+                    is_grads_batched=True,
+                    allow_unused=True,
+                )
+                # Move the output dimension after the batch dimension
+                grads = tuple(
+                    None if grad is None else grad.movedim(0, 1) for grad in grads
+                )
     finally:
         # Make sure we always remove hooks even if an exception is raised
         for hook in hooks:
             hook.remove()
 
-        model.zero_grad()
-
+    activations = {
+        name: act.detach() if isinstance(act, torch.Tensor) else act
+        for name, act in activations.items()
+    }
+    gradients = {name: grad for name, grad in zip(captured, grads) if grad is not None}
     return activations, gradients
@@ -0,0 +1,435 @@
+from functools import partial
+
+import pytest
+import torch
+from cupbearer import data, utils
+from cupbearer.detectors import (
+    ActivationCache,
+    CacheBuilder,
+    MahalanobisDetector,
+    MemmapActivationCache,
+)
+from cupbearer.detectors.activation_cache import (
+    function_fingerprint,
+    input_key,
+    input_keys,
+    model_fingerprint,
+)
+from cupbearer.models import MLP
+
+
+def activation_func(inputs, names=("a", "b")):
+    # Deterministic "activations" that depend on the input
+    acts = {
+        "a": torch.stack([torch.full((3,), float(len(x))) for x in inputs]),
+        "b": torch.stack([torch.arange(2.0) + len(x) for x in inputs]),
+    }
+    return {name: acts[name] for name in names}
+
+
+@pytest.fixture(params=["memory", "memmap"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return ActivationCache()
+    return MemmapActivationCache(tmp_path / "cache")
+
+
+def test_cache_hits_and_misses(cache):
+    inputs = ["a", "bb", "ccc"]
+    acts = cache.get_activations(inputs, ["a", "b"], activation_func)
+    assert cache.misses == 3 and cache.hits == 0
+
+    # Partially cached batch
+    new_inputs = ["bb", "dddd"]
+    new_acts = cache.get_activations(new_inputs, ["a", "b"], activation_func)
+    assert cache.misses == 4 and cache.hits == 1
+    for name in ["a", "b"]:
+        torch.testing.assert_close(new_acts[name][0], acts[name][1])
+        torch.testing.assert_close(new_acts[name], activation_func(new_inputs)[name])
+
+    assert ("dddd", "a") in cache
+    assert ("eeeee", "a") not in cache
+    assert cache.count_missing(["a", "eeeee"], ["a", "b"]) == 1
+
+
+def test_store_and_load(cache, tmp_path):
+    inputs = ["a", "bb", "ccc"]
+    expected = cache.get_activations(inputs, ["a", "b"], activation_func)
+    cache.store(tmp_path / "stored")
+    loaded = type(cache).load(tmp_path / "stored")
+    assert len(loaded) == len(cache) == 6
+
+    def fail(inputs, names):
+        raise AssertionError("Activations should have been cached")
+
+    acts = loaded.get_activations(inputs, ["a", "b"], fail)
+    for name in ["a", "b"]:
+        torch.testing.assert_close(acts[name], expected[name])
+
+
+def test_memmap_store_twice(tmp_path):
+    cache = MemmapActivationCache(tmp_path / "cache")
+    cache.get_activations(["a"], ["a"], activation_func)
+    cache.store(tmp_path / "stored")
+    # Storing again replaces the first copy
+    cache.get_activations(["bb"], ["a"], activation_func)
+    cache.store(tmp_path / "stored")
+    assert len(MemmapActivationCache.load(tmp_path / "stored")) == 2
+
+
+def test_memmap_discards_unflushed_rows(tmp_path):
+    cache = MemmapActivationCache(tmp_path)
+    cache.get_activations(["a", "bb"], ["a"], activation_func)
+    cache.flush()
+    # Never flushed, so these rows should be gone after reopening
+    cache.get_activations(["ccc"], ["a"], activation_func)
+
+    cache = MemmapActivationCache(tmp_path)
+    assert len(cache) == 2
+    assert ("ccc", "a") not in cache
+
+    # Appending still works correctly after truncating the stale rows
+    acts = cache.get_activations(["dddd", "a"], ["a"], activation_func)
+    torch.testing.assert_close(acts["a"], activation_func(["dddd", "a"])["a"])
+    cache.flush()
+    cache = MemmapActivationCache(tmp_path)
+    acts = cache.get_activations(["a", "bb", "dddd"], ["a"], activation_func)
+    assert cache.misses == 0
+    torch.testing.assert_close(acts["a"], activation_func(["a", "bb", "dddd"])["a"])
+
+
+def test_memmap_empty_activation(tmp_path):
+    # Adding an empty batch records the shape, but doesn't write any rows
+    cache = MemmapActivationCache(tmp_path, storage_dtype="int8")
+    cache._put_batch([], "a", torch.zeros(0, 3))
+    cache.flush()
+    assert not (tmp_path / "a.bin").exists()
+
+    cache = MemmapActivationCache(tmp_path)
+    assert len(cache) == 0
+    acts = cache.get_activations(["bb"], ["a"], activation_func)
+    torch.testing.assert_close(acts["a"], activation_func(["bb"])["a"])
+
+
+def test_memmap_rejects_inconsistent_shapes(tmp_path):
+    cache = MemmapActivationCache(tmp_path)
+    cache.get_activations(["a"], ["a"], activation_func)
+    with pytest.raises(ValueError):
+        cache.get_activations(
+            ["bb"], ["a"], lambda inputs, names: {"a": torch.zeros(len(inputs), 5)}
+        )
+
+
+def test_tensor_inputs_use_content_keys(cache):
+    def image_activations(inputs, names):
+        return {"a": inputs.flatten(start_dim=1).sum(dim=1, keepdim=True)}
+
+    images = torch.randn(4, 3, 2, 2)
+    cache.get_activations(images, ["a"], image_activations)
+    # A copy is a different object with the same content, so should hit the cache
+    cache.get_activations(images.clone(), ["a"], image_activations)
+    assert cache.hits == 4 and cache.misses == 4
+    assert (images[0].clone(), "a") in cache
+    # Same bytes but different dtype/shape must not collide
+    assert (images[0].double(), "a") not in cache
+    assert (images[0].view(3, 4), "a") not in cache
+
+
+def test_input_keys_match_batched_and_single():
+    images = torch.randn(3, 2, 2)
+    assert input_keys(images) == [input_key(image) for image in images]
+    assert input_keys(["a", "b"]) == [input_key("a"), input_key("b")]
+    assert input_key("a") != input_key("b")
+
+
+def test_tokenized_text_keys():
+    # Without tokenizer arguments, pretokenized text shares entries with the text
+    assert input_key(data.TokenizedText("ab", [1, 2])) == input_key("ab")
+    truncated = data.TokenizedText("ab", [1], {"max_length": 1, "truncation": True})
+    assert input_key(truncated) != input_key("ab")
+    assert input_key(truncated) != input_key(
+        data.TokenizedText("ab", [1], {"max_length": 2, "truncation": True})
+    )
+
+
+def test_load_legacy_cache(tmp_path):
+    activation = torch.randn(3)
+    utils.save({("some input", "a"): activation}, tmp_path / "legacy")
+    cache = ActivationCache.load(tmp_path / "legacy")
+    assert ("some input", "a") in cache
+
+
+def test_fingerprints_separate_entries(cache):
+    inputs = ["a", "bb"]
+    cache.get_activations(inputs, ["a"], activation_func, fingerprint="model1")
+    cache.get_activations(inputs, ["a"], activation_func, fingerprint="model1")
+    assert cache.hits == 2 and cache.misses == 2
+    cache.get_activations(inputs, ["a"], activation_func, fingerprint="model2")
+    cache.get_activations(inputs, ["a"], activation_func)
+    assert cache.hits == 2 and cache.misses == 6
+    assert cache.count_missing(inputs, ["a"], fingerprint="model1") == 0
+    assert cache.count_missing(inputs, ["a"], fingerprint="model3") == 2
+
+
+def test_detector_cache_fingerprint():
+    def make_detector(model, func=None):
+        detector = MahalanobisDetector(
+            activation_names=["layers.linear_0.output"],
+            activation_processing_func=func,
+            cache=cache,
+        )
+        detector.set_model(model)
+        return detector
+
+    cache = ActivationCache()
+    model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3])
+    other_model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3])
+    inputs = torch.randn(5, 4)
+
+    make_detector(model).get_activations(inputs)
+    make_detector(model).get_activations(inputs)
+    assert cache.hits == 5 and cache.misses == 5
+    # Different weights
+    make_detector(other_model).get_activations(inputs)
+    assert cache.misses == 10
+    # Different processing function
+    make_detector(model, lambda x, inputs, name: 2 * x).get_activations(inputs)
+    assert cache.misses == 15
+
+    assert model_fingerprint(model) == model_fingerprint(model)
+    assert model_fingerprint(model) != model_fingerprint(other_model)
+    assert function_fingerprint(partial(torch.mul, other=2)) != function_fingerprint(
+        partial(torch.mul, other=3)
+    )
+
+
+def test_function_fingerprint_closures():
+    def make_func(index):
+        return lambda x, inputs, name: x[:, index]
+
+    def func(x, inputs, name):
+        return x[:, 0]
+
+    assert function_fingerprint(func) == function_fingerprint(func)
+    assert function_fingerprint(make_func(0)) == function_fingerprint(make_func(0))
+    assert function_fingerprint(make_func(0)) != function_fingerprint(make_func(-1))
+    assert function_fingerprint(lambda x: x + 1) != function_fingerprint(
+        lambda x: x - 1
+    )
+    assert function_fingerprint(lambda x: 2 * x) != function_fingerprint(
+        lambda x: 3 * x
+    )
+    assert function_fingerprint(lambda x, k=1: x) != function_fingerprint(
+        lambda x, k=2: x
+    )
+    # Captured tensors are identified by their contents
+    a, b = torch.zeros(3), torch.zeros(3)
+    assert function_fingerprint(lambda x: x @ a) == function_fingerprint(
+        lambda x: x @ b
+    )
+    b[0] = 1
+    assert function_fingerprint(lambda x: x @ a) != function_fingerprint(
+        lambda x: x @ b
+    )
+
+
+def test_only_missing_activations_are_computed(cache):
+    calls = []
+
+    def recording_func(inputs, names):
+        calls.append((list(inputs), names))
+        return activation_func(inputs, names)
+
+    cache.get_activations(["a", "bb"], ["a"], recording_func)
+    acts = cache.get_activations(["a", "bb", "ccc"], ["a", "b"], recording_func)
+    assert calls == [
+        (["a", "bb"], ["a"]),
+        (["a", "bb"], ["b"]),
+        (["ccc"], ["a", "b"]),
+    ]
+    for name in ["a", "b"]:
+        torch.testing.assert_close(
+            acts[name], activation_func(["a", "bb", "ccc"])[name]
+        )
+
+
+def test_lru_eviction():
+    # Each activation for "a" takes 3 float32 values, so this fits two of them
+    cache = ActivationCache(max_bytes=24)
+    cache.get_activations(["a", "bb", "ccc"], ["a"], activation_func)
+    assert len(cache) == 2
+    assert cache.stats["evictions"] == 1 and cache.stats["bytes"] == 24
+    assert ("a", "a") not in cache
+
+    # Using "bb" makes "ccc" the least recently used entry
+    cache.get_activations(["bb"], ["a"], activation_func)
+    cache.get_activations(["dddd"], ["a"], activation_func)
+    assert ("bb", "a") in cache
+    assert ("ccc", "a") not in cache
+    assert cache.stats["evictions"] == 2
+
+
+def test_eviction_spills_to_disk(tmp_path):
+    spill = MemmapActivationCache(tmp_path)
+    cache = ActivationCache(max_bytes=24, spill=spill)
+    inputs = ["a", "bb", "ccc", "dddd"]
+    expected = cache.get_activations(inputs, ["a"], activation_func)
+    assert len(cache) == 2 and len(spill) == 2
+    assert all((input, "a") in cache for input in inputs)
+
+    def fail(inputs, names):
+        raise AssertionError("Activations should have been cached")
+
+    acts = cache.get_activations(inputs, ["a"], fail)
+    torch.testing.assert_close(acts["a"], expected["a"])
+    assert cache.stats["spill_hits"] == 2
+
+
+def test_missing_indices(cache):
+    cache.get_activations(["a", "ccc"], ["a", "b"], activation_func)
+    cache.get_activations(["bb"], ["a"], activation_func)
+
+    inputs = ["a", "bb", "ccc", "dddd"]
+    assert cache.missing_indices(inputs, ["a"]) == [3]
+    assert cache.missing_indices(inputs, ["a", "b"]) == [1, 3]
+    keys = input_keys(inputs)
+    assert cache.missing_key_indices(keys, ["a", "b"]) == [1, 3]
+
+    # Labels are ignored, for both normal and anomalous data
+    labeled = torch.utils.data.TensorDataset(torch.randn(3, 2), torch.arange(3))
+    mixed = data.MixedData([(x, 0) for x in inputs], labeled, normal_weight=None)
+    cache.get_activations(labeled.tensors[0][:1], ["a"], activation_func)
+    assert cache.missing_indices(mixed, ["a"]) == [3, 5, 6]
+
+
+def test_dataset_inputs():
+    tensors = torch.randn(5, 2)
+    dataset = torch.utils.data.TensorDataset(tensors, torch.arange(5))
+    subset = torch.utils.data.Subset(dataset, [4, 1])
+    assert torch.equal(data.dataset_inputs(subset), tensors[[4, 1]])
+
+    mixed = data.MixedData(dataset, subset, normal_weight=0.5)
+    assert len(mixed) == 4
+    assert torch.equal(data.dataset_inputs(mixed), tensors[[0, 1, 4, 1]])
+
+    # Generic datasets are iterated over, stripping labels
+    samples = [(x, 0) for x in tensors]
+    inputs = data.dataset_inputs(torch.utils.data.Subset(samples, [0, 3]))
+    assert len(inputs) == 2
+    assert all(torch.equal(x, y) for x, y in zip(inputs, tensors[[0, 3]]))
+
+
+def test_cache_builder_shards(tmp_path, monkeypatch):
+    model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3])
+    names = ["layers.linear_0.output"]
+    trusted = torch.utils.data.TensorDataset(torch.randn(10, 4), torch.zeros(10))
+    untrusted = torch.utils.data.TensorDataset(torch.randn(7, 4), torch.zeros(7))
+
+    def make_builder(**kwargs):
+        builder = CacheBuilder(tmp_path / "cache.pt", names, **kwargs)
+        builder.set_model(model)
+        return builder
+
+    # Build only a single shard, like one job of a job array would
+    builder = make_builder(num_shards=3, shard_index=1)
+    builder.train(trusted, untrusted, None, batch_size=4)
+    assert [p.name for p in builder.shard_dir.iterdir()] == ["train_00001-of-00003.pt"]
+    assert len(builder.cache) == 0
+
+    # Building all shards reuses the existing one and merges them
+    builder = make_builder(num_shards=3)
+    builder.train(trusted, untrusted, None, batch_size=4)
+    assert len(list(builder.shard_dir.iterdir())) == 3
+    assert len(builder.cache) == 17
+
+    # Merging another split doesn't pick up the train shards
+    other = make_builder(num_shards=3)
+    # The train cache has already been stored there
+    monkeypatch.setattr(other, "store_cache", lambda: None)
+    other.merge_shards("eval")
+    assert len(other.cache) == 0
+    other.merge_shards("train")
+    assert len(other.cache) == 17
+
+    reference = make_builder()
+    reference.cache_path = tmp_path / "reference.pt"
+    reference.train(trusted, untrusted, None, batch_size=4)
+    for name, keys, activations in reference.cache._batches():
+        for key, activation in zip(keys, activations):
+            assert torch.allclose(builder.cache._get(key, name), activation)
+
+
+def test_prefetch_activations(tmp_path):
+    model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3])
+    dataset = torch.utils.data.TensorDataset(torch.randn(10, 4), torch.zeros(10))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=3)
+
+    cache = MemmapActivationCache(tmp_path / "cache")
+    detector = MahalanobisDetector(
+        activation_names=["layers.linear_0.output"], cache=cache, prefetch=2
+    )
+    detector.set_model(model)
+    # Nothing cached yet, so the prefetched lookups are empty
+    expected = [
+        detector.get_activations(batch) for batch in detector._iter_batches(loader)
+    ]
+    assert cache.misses == 10
+
+    for batch, acts in zip(detector._iter_batches(loader), expected):
+        assert detector._prefetched is not None
+        new_acts = detector.get_activations(batch)
+        # The prefetched activations were used
+        assert detector._prefetched is None
+        for name in acts:
+            assert torch.allclose(acts[name], new_acts[name])
+    assert cache.hits == 10 and cache.misses == 10
+
+    # Stopping early shuts down the background thread
+    for batch in detector._iter_batches(loader):
+        break
+    assert detector._prefetched is None
+
+
+@pytest.mark.parametrize("storage_dtype", ["float16", "bfloat16", torch.int8])
+@pytest.mark.parametrize("kind", ["memory", "memmap"])
+def test_reduced_precision_storage(tmp_path, storage_dtype, kind):
+    def make_cache():
+        if kind == "memory":
+            return ActivationCache(storage_dtype=storage_dtype)
+        return MemmapActivationCache(tmp_path / "cache", storage_dtype=storage_dtype)
+
+    def random_func(inputs, names):
+        # Vectors and multi-dimensional activations use different int8 scales
+        return {
+            "vector": torch.randn(len(inputs), 8),
+            "tokens": torch.randn(len(inputs), 5, 8) * torch.arange(1.0, 9.0),
+        }
+
+    cache = make_cache()
+    inputs = ["a", "bb", "ccc"]
+    expected = cache.get_activations(inputs, ["vector", "tokens"], random_func)
+
+    if kind == "memory":
+        if isinstance(storage_dtype, str):
+            storage_dtype = getattr(torch, storage_dtype)
+        for entry in cache.cache.values():
+            assert entry.data.dtype == storage_dtype
+            # 2x smaller for 16 bit floats, roughly 4x for int8
+            assert entry.nbytes < entry.data.numel() * 4 / 1.9
+    cache.store(tmp_path / "stored")
+    loaded = type(cache).load(tmp_path / "stored")
+
+    def fail(inputs, names):
+        raise AssertionError("Activations should have been cached")
+
+    acts = loaded.get_activations(inputs, ["vector", "tokens"], fail)
+    for name in ["vector", "tokens"]:
+        assert acts[name].dtype == torch.float32
+        # Relative to the largest value, all formats have at least 7 bits precision
+        atol = expected[name].abs().max() / 2**7
+        torch.testing.assert_close(acts[name], expected[name], atol=atol, rtol=0)
+
+
+def test_invalid_storage_dtype():
+    with pytest.raises(ValueError):
+        ActivationCache(storage_dtype="int32")
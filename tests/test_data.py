@@ -1,5 +1,7 @@
+import copy
 import functools
 import itertools
+import pickle
 from dataclasses import dataclass
 
 import numpy as np
@@ -8,6 +10,7 @@ import torch
 from cupbearer import data
 from torch.utils.data import DataLoader, Dataset
 from torchvision.transforms import Normalize
+from torchvision.transforms import functional as F
 from torchvision.transforms.functional import InterpolationMode
 
 
@@ -147,6 +150,29 @@ class TestBackdoors(DatasetFixtures):
                 1.0 / np.sqrt(np.prod(clean_img.shape))
             )
 
+    @staticmethod
+    def test_inject_batch(clean_image_dataset, backdoor_type):
+        imgs, labels = next(iter(DataLoader(clean_image_dataset, batch_size=9)))
+        target_class = 10_000
+
+        backdoor = backdoor_type(p_backdoor=1.0, target_class=target_class)
+        new_imgs, new_labels = backdoor.inject_batch((imgs, labels))
+        assert new_imgs.shape == imgs.shape
+        assert torch.all(new_labels == target_class)
+        assert all(torch.any(new != old) for new, old in zip(new_imgs, imgs))
+        assert torch.min(new_imgs) >= 0 and torch.max(new_imgs) <= 1
+        # Inputs aren't modified
+        assert torch.all(labels != target_class)
+        if not isinstance(backdoor, data.NoiseBackdoor):
+            # Deterministic backdoors give the same results as per-sample ones
+            for img, label, new_img in zip(imgs, labels, new_imgs):
+                torch.testing.assert_close(backdoor((img, label))[0], new_img)
+
+        backdoor = backdoor_type(p_backdoor=0.0, target_class=target_class)
+        new_imgs, new_labels = backdoor.inject_batch((imgs, labels))
+        assert torch.equal(new_imgs, imgs)
+        assert torch.equal(new_labels, labels)
+
     @staticmethod
     def test_wanet_backdoor(clean_image_dataset):
         # Pick a target class outside the actual range so we can later tell whether it
@@ -208,6 +234,19 @@ class TestBackdoors(DatasetFixtures):
                 ds2.backdoor.warping_field,
             )
 
+    @staticmethod
+    def test_wanet_backdoor_mixed_sizes():
+        backdoor = data.backdoors.WanetBackdoor(path=None, p_backdoor=1.0)
+        for shape in [(8, 12), (16, 16), (8, 12)]:
+            img = DummyImageData(1, 10, shape).img
+            warped, _ = backdoor((img, 0))
+            assert warped.shape == img.shape
+            assert torch.any(warped != img)
+        # One field per size
+        assert len(backdoor._warping_fields) == 2
+        # The legacy attribute keeps the field of the first size
+        assert backdoor.warping_field.shape == (8, 12, 2)
+
     @staticmethod
     def test_wanet_backdoor_scale_invariance(clean_image_dataset):
         backdoor = data.backdoors.WanetBackdoor(
@@ -274,6 +313,20 @@ class DummyPytorchDataset(data.PytorchDataset):
         return DummyImageData(self.length, self.num_classes, self.shape)
 
 
+@dataclass
+class DummyUint8PytorchDataset(data.PytorchDataset):
+    """Like `DummyPytorchDataset`, but with 8-bit HWC arrays and `ToTensor`."""
+
+    name: str = "dummy_uint8"
+
+    def _build(self) -> Dataset:
+        images = DummyImageData(8, 10, (8, 12))
+        return [
+            ((img * 200).permute(1, 2, 0).to(torch.uint8).numpy(), label)
+            for img, label in images
+        ]
+
+
 class TestAugmentations(DatasetFixtures):
     @staticmethod
     @pytest.fixture(
@@ -284,7 +337,8 @@ class TestAugmentations(DatasetFixtures):
         ],
     )
     def augmentation(request):
-        return request.param
+        # Params are shared between tests, and tests may modify the augmentation
+        return copy.deepcopy(request.param)
 
     @staticmethod
     def test_augmentation(clean_image_dataset, augmentation):
@@ -348,8 +402,155 @@ class TestAugmentations(DatasetFixtures):
                 assert not augmentation_used, "Transform applied after augmentation"
         assert augmentation_used
 
+    @staticmethod
+    def test_batched_augmentation(clean_image_dataset, augmentation):
+        imgs, labels = next(iter(DataLoader(clean_image_dataset, batch_size=9)))
+        aug_imgs, aug_labels = augmentation.__batch_call__((imgs, labels))
+        assert aug_imgs.shape == imgs.shape
+        assert torch.equal(aug_labels, labels)
+        for img, aug_img in zip(imgs, aug_imgs):
+            assert not torch.allclose(aug_img, img)
+
+    @staticmethod
+    def test_rotate_batch():
+        imgs = torch.rand(3, 2, 6, 6)
+        rotated = data.transforms.rotate_batch(imgs, torch.tensor([0.0, 90.0, -90.0]))
+        torch.testing.assert_close(rotated[0], imgs[0])
+        # Counter-clockwise, like torchvision
+        torch.testing.assert_close(rotated[1], torch.rot90(imgs[1], 1, dims=(1, 2)))
+        torch.testing.assert_close(rotated[2], torch.rot90(imgs[2], -1, dims=(1, 2)))
+
+    @staticmethod
+    @pytest.mark.parametrize(
+        "interpolation",
+        [InterpolationMode.NEAREST, InterpolationMode.BILINEAR],
+    )
+    @pytest.mark.parametrize("fill", [0, (0.2, 0.5, 1.0)])
+    def test_rotate_batch_matches_torchvision(interpolation, fill):
+        imgs = torch.rand(4, 3, 7, 9)
+        angles = torch.tensor([0.0, 10.0, -33.0, 135.0])
+        rotated = data.transforms.rotate_batch(imgs, angles, interpolation, fill)
+        for img, angle, rotated_img in zip(imgs, angles, rotated):
+            expected = F.rotate(
+                img,
+                angle=angle.item(),
+                interpolation=interpolation,
+                fill=list(fill) if isinstance(fill, tuple) else fill,
+            )
+            torch.testing.assert_close(rotated_img, expected)
+
+    @staticmethod
+    def test_batch_augmentations():
+        dataset = DummyPytorchDataset(batch_augmentations=True)
+        img, _ = dataset[0]
+        # Augmentations are skipped for individual samples
+        assert torch.equal(img, dataset._dataset[0][0])
+        batch = next(iter(DataLoader(dataset, batch_size=4)))
+        imgs, _ = dataset.augment_batch(batch)
+        assert imgs.shape == batch[0].shape
+
+    @staticmethod
+    def test_preprocessed_dataset(tmp_path):
+        dataset = DummyUint8PytorchDataset(default_augmentations=False)
+        preprocessed = DummyUint8PytorchDataset(
+            default_augmentations=False, preprocessed_dir=tmp_path
+        )
+        assert len(list(tmp_path.glob("*.images.npy"))) == 1
+        assert len(preprocessed) == len(dataset)
+        for (img, _), (pre_img, pre_label) in zip(dataset, preprocessed):
+            assert torch.equal(img, pre_img)
+            assert isinstance(pre_label, int)
+
+        # The second time, the raw dataset isn't needed
+        class NoBuild(DummyUint8PytorchDataset):
+            def _build(self):
+                raise AssertionError("Dataset shouldn't be built")
+
+        reloaded = NoBuild(default_augmentations=False, preprocessed_dir=tmp_path)
+        assert torch.equal(reloaded[0][0], preprocessed[0][0])
+
+        # Resizing after ToTensor gives float images, so it isn't preprocessed
+        transforms = [data.transforms.ToTensor(), data.transforms.Resize(size=[5, 7])]
+        dataset = DummyUint8PytorchDataset(
+            transforms=transforms, default_augmentations=False
+        )
+        preprocessed = DummyUint8PytorchDataset(
+            transforms=transforms,
+            default_augmentations=False,
+            preprocessed_dir=tmp_path / "resize",
+        )
+        assert preprocessed._num_preprocessed == 1
+        for (img, _), (pre_img, _) in zip(dataset, preprocessed):
+            assert pre_img.shape == (3, 5, 7)
+            assert torch.equal(img, pre_img)
+
+        # Float images can't be stored as uint8 without losing information
+        with pytest.raises(ValueError):
+            DummyPytorchDataset(
+                default_augmentations=False, preprocessed_dir=tmp_path / "float"
+            )
+
     @staticmethod
     def test_no_augmentations():
         dataset = DummyPytorchDataset(default_augmentations=False)
         for trafo in dataset.transforms:
             assert not isinstance(trafo, data.transforms.ProbabilisticTransform)
+
+
+class DummyTextData(Dataset):
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        return self.texts[index], 0
+
+    def inputs(self):
+        return self.texts
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_length_grouped_batches(shuffle):
+    texts = ["a" * n for n in torch.randint(1, 100, (250,)).tolist()]
+    dataset = data.MixedData(
+        DummyTextData(texts[:150]), DummyTextData(texts[150:]), normal_weight=None
+    )
+    dataloader = data.make_dataloader(dataset, batch_size=16, shuffle=shuffle)
+    assert isinstance(dataloader.batch_sampler, data.LengthGroupedBatchSampler)
+
+    batches = list(dataloader.batch_sampler)
+    assert len(batches) == len(dataloader) == 16
+    # Every sample is used exactly once
+    assert sorted(i for batch in batches for i in batch) == list(range(250))
+    if not shuffle:
+        # Batches are sorted by length within chunks of consecutive samples
+        lengths = [len(dataset[i][0][0]) for i in batches[0]]
+        assert lengths == sorted(lengths, reverse=True)
+
+    # Non-text data isn't grouped
+    dataloader = data.make_dataloader(DummyDataset(10, "3"), batch_size=4)
+    assert not isinstance(dataloader.batch_sampler, data.LengthGroupedBatchSampler)
+    with pytest.raises(ValueError):
+        data.make_dataloader(DummyDataset(10, "3"), batch_size=4, group_by_length=True)
+
+
+def test_tokenized_text():
+    texts = [data.TokenizedText("ab", [1, 2]), data.TokenizedText("c", [3])]
+    assert texts[0] == "ab"
+    # Default collation keeps the token ids
+    batch = next(iter(DataLoader(DummyTextData(texts), batch_size=2)))
+    assert [x.input_ids for x in batch[0]] == [[1, 2], [3]]
+    # Length grouping uses the number of tokens
+    assert data.sampling.text_lengths(DummyTextData(texts)) == [2, 1]
+
+
+def test_tokenized_text_pickle():
+    text = data.TokenizedText("ab", [1, 2], {"max_length": 2, "truncation": True})
+    for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+        restored = pickle.loads(pickle.dumps(text, protocol=protocol))
+        assert isinstance(restored, data.TokenizedText)
+        assert restored == "ab"
+        assert restored.input_ids == [1, 2]
+        assert restored.tokenize_kwargs == text.tokenize_kwargs
@@ -2,6 +2,8 @@ from functools import partial
 
 import pytest
 import torch
+from cupbearer.data import MixedData
+from cupbearer.detectors import ActivationCache, AnomalyDetector, MultiDetector
 from cupbearer.detectors.statistical import (
     MahalanobisDetector,
     QuantumEntropyDetector,
@@ -11,6 +13,7 @@ from cupbearer.detectors.statistical.statistical import (
     ActivationCovarianceBasedDetector,
 )
 from cupbearer.models import CNN, MLP
+from cupbearer.utils import inputs_from_batch
 
 names = {
     MLP: ["layers.linear_0.input", "layers.linear_1.output"],
@@ -127,3 +130,277 @@ class TestTrainedStatisticalDetectors:
                 rtol=(4 * cov.size(0) ** 2 * torch.finfo(cov.dtype).resolution),
                 atol=(cov.size(0) * torch.finfo(cov.dtype).resolution),
             )
+
+
+def test_multi_detector():
+    model = MLP(input_shape=(1, 8, 8), hidden_dims=[32, 32], output_dim=7)
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn([64, 1, 8, 8]), torch.randint(7, (64,))
+    )
+
+    def make_detectors():
+        return {
+            "mahalanobis": MahalanobisDetector(
+                activation_names=["layers.linear_0.input", "layers.linear_1.output"]
+            ),
+            "spectral": SpectralSignatureDetector(
+                activation_names=["layers.linear_1.output"]
+            ),
+            "que": QuantumEntropyDetector(
+                activation_names=["layers.linear_0.input"],
+                activation_processing_func=lambda x, inputs, name: 2 * x,
+            ),
+        }
+
+    forward_passes = 0
+
+    def count_forward_passes(module, input):
+        nonlocal forward_passes
+        forward_passes += 1
+
+    # The model might be truncated, so we count calls to the first layer
+    model.layers.linear_0.register_forward_pre_hook(count_forward_passes)
+
+    multi_detector = MultiDetector(make_detectors())
+    multi_detector.set_model(model)
+    multi_detector.train(dataset, dataset, batch_size=16, pbar=False)
+    # Three detectors, but only one pass for each of the 4 batches (+ example batch)
+    assert forward_passes == 5
+
+    for name, detector in make_detectors().items():
+        detector.set_model(model)
+        detector.train(dataset, dataset, batch_size=16, pbar=False)
+        for layer, mean in detector.means.items():
+            assert torch.allclose(mean, multi_detector.detectors[name].means[layer])
+
+    mixed = MixedData(dataset, dataset, return_anomaly_labels=True)
+    forward_passes = 0
+    results = multi_detector.eval(mixed, batch_size=32)
+    assert forward_passes == 4
+    assert results.keys() == {"mahalanobis", "spectral", "que"}
+
+
+class CharModel(torch.nn.Module):
+    """Embeds each character, left-padding to the longest input in the batch."""
+
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(128, 4)
+        self.linear = torch.nn.Linear(4, 4)
+
+    def forward(self, inputs: list[str]):
+        length = max(len(x) for x in inputs)
+        ids = torch.tensor(
+            [[0] * (length - len(x)) + [ord(c) for c in x] for x in inputs]
+        )
+        return self.linear(self.embed(ids))
+
+
+def test_multi_detector_cache_variable_length():
+    model = CharModel()
+    cache = ActivationCache()
+
+    def make_detectors():
+        return {
+            "last": MahalanobisDetector(
+                activation_names=["linear.output"],
+                activation_processing_func=lambda x, inputs, name: x[:, -1],
+            ),
+            "double": MahalanobisDetector(
+                activation_names=["linear.output"],
+                activation_processing_func=lambda x, inputs, name: 2 * x[:, -1],
+            ),
+        }
+
+    multi_detector = MultiDetector(make_detectors(), cache=cache)
+    multi_detector.set_model(model)
+    # Activations have a different sequence length in each batch
+    batches = [["a", "bb"], ["bb", "cccc"], ["a", "dddddd"]]
+    for batch in batches:
+        results = multi_detector.get_activations((batch, torch.zeros(2)))
+        for name, acts in zip(multi_detector.detectors, results):
+            detector = multi_detector.detectors[name]
+            expected = detector._get_activations_no_cache(batch)
+            assert torch.allclose(acts["linear.output"], expected["linear.output"])
+    # Two detectors with four unique inputs, "a" and "bb" are repeated
+    assert cache.misses == 2 * 4 and cache.hits == 2 * 2
+
+    # Entries are shared with detectors using the cache on their own
+    detector = make_detectors()["last"]
+    detector.cache = cache
+    detector.set_model(model)
+    detector.get_activations((["cccc", "a"], torch.zeros(2)))
+    assert cache.hits == 6 and cache.misses == 8
+
+
+def test_float64_accumulation():
+    # Unlucky data makes the float32 inverse covariance too inaccurate to compare
+    torch.manual_seed(0)
+    model = MLP(input_shape=(1, 8, 8), hidden_dims=[32, 32], output_dim=7)
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn([64, 1, 8, 8]), torch.randint(7, (64,))
+    )
+    detectors = {}
+    for dtype in [torch.float32, torch.float64]:
+        detector = MahalanobisDetector(
+            activation_names=["layers.linear_1.output"], accumulation_dtype=dtype
+        )
+        detector.set_model(model)
+        detector.train(dataset, None, batch_size=16, pbar=False)
+        detectors[dtype] = detector
+
+    name = "layers.linear_1.output"
+    assert detectors[torch.float64].covariances[name].dtype == torch.float64
+    # Trained variables are used in the default precision
+    assert detectors[torch.float64].inv_covariances[name].dtype == torch.float32
+    assert detectors[torch.float64].means[name].dtype == torch.float32
+    torch.testing.assert_close(
+        detectors[torch.float64].means[name], detectors[torch.float32].means[name]
+    )
+    torch.testing.assert_close(
+        detectors[torch.float64].covariances[name].float(),
+        detectors[torch.float32].covariances[name],
+    )
+    inputs = torch.randn([8, 1, 8, 8])
+    torch.testing.assert_close(
+        detectors[torch.float64].scores(inputs),
+        detectors[torch.float32].scores(inputs),
+        rtol=1e-3,
+        atol=1e-3,
+    )
+
+
+def test_mahalanobis_methods():
+    model = MLP(input_shape=(1, 8, 8), hidden_dims=[5], output_dim=7)
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn([128, 1, 8, 8]), torch.randint(7, (128,))
+    )
+    inputs = torch.randn([16, 1, 8, 8])
+
+    scores = {}
+    for method in ["pinv", "eigh", "cholesky"]:
+        detector = MahalanobisDetector(activation_names=["layers.linear_0.output"])
+        detector.set_model(model)
+        detector.train(
+            dataset, None, batch_size=32, pbar=False, method=method, rcond=1e-7
+        )
+        scores[method] = detector.scores(inputs)
+
+    torch.testing.assert_close(scores["eigh"], scores["pinv"], rtol=1e-3, atol=1e-3)
+    torch.testing.assert_close(scores["cholesky"], scores["pinv"], rtol=1e-3, atol=1e-3)
+
+    # Only the top directions
+    detector.train(dataset, None, batch_size=32, pbar=False, method="eigh", rank=2)
+    assert detector.whitening_matrices["layers.linear_0.output"].shape == (5, 2)
+    assert detector.scores(inputs).shape == (16,)
+
+    with pytest.raises(ValueError):
+        detector.train(dataset, None, batch_size=32, pbar=False, rank=2)
+
+
+@pytest.mark.parametrize(
+    "Detector",
+    [MahalanobisDetector, QuantumEntropyDetector, SpectralSignatureDetector],
+)
+def test_low_rank_covariance_detectors(Detector):
+    model = MLP(input_shape=(1, 8, 8), hidden_dims=[5], output_dim=7)
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn([128, 1, 8, 8]), torch.randint(7, (128,))
+    )
+    inputs = torch.randn([16, 1, 8, 8])
+    name = "layers.linear_0.input"
+
+    detector = Detector(activation_names=[name], covariance_rank=4)
+    detector.set_model(model)
+    detector.train(dataset, dataset, batch_size=32, pbar=False)
+    assert detector.covariances[name].eigenvectors.shape == (64, 4)
+    assert detector.scores(inputs).shape == (16,)
+
+
+def test_low_rank_mahalanobis_matches_dense():
+    model = MLP(input_shape=(1, 8, 8), hidden_dims=[5], output_dim=7)
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn([128, 1, 8, 8]), torch.randint(7, (128,))
+    )
+    inputs = torch.randn([16, 1, 8, 8])
+
+    scores = []
+    # With a rank equal to the dimension, the sketch is exact
+    for covariance_rank in [None, 5]:
+        detector = MahalanobisDetector(
+            activation_names=["layers.linear_0.output"],
+            covariance_rank=covariance_rank,
+        )
+        detector.set_model(model)
+        detector.train(dataset, None, batch_size=32, pbar=False)
+        scores.append(detector.scores(inputs))
+
+    torch.testing.assert_close(scores[0], scores[1], rtol=1e-3, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        detector.train(dataset, None, batch_size=32, pbar=False, method="pinv")
+
+
+def test_parallel_training():
+    torch.manual_seed(0)
+    model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3])
+    dataset = torch.utils.data.TensorDataset(torch.randn(40, 4), torch.zeros(40))
+    name = "layers.linear_0.output"
+
+    detectors = []
+    for num_processes in [1, 2]:
+        detector = MahalanobisDetector(activation_names=[name])
+        detector.set_model(model)
+        # The model already has capture hooks from the serial run the second time
+        detector.train(
+            dataset, None, batch_size=8, pbar=False, num_processes=num_processes
+        )
+        detectors.append(detector)
+
+    torch.testing.assert_close(detectors[1].means[name], detectors[0].means[name])
+    torch.testing.assert_close(
+        detectors[1].covariances[name], detectors[0].covariances[name]
+    )
+
+
+class TextData(torch.utils.data.Dataset):
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        return self.texts[index], 0
+
+    def inputs(self):
+        return self.texts
+
+
+class RecordingDetector(AnomalyDetector):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def train(self, trusted_data, untrusted_data, save_path, **kwargs):
+        pass
+
+    def layerwise_scores(self, batch):
+        inputs = inputs_from_batch(batch)
+        self.batches.append(inputs)
+        return {"length": torch.tensor([len(x) for x in inputs], dtype=torch.float)}
+
+
+def test_eval_mixes_text_batches():
+    torch.manual_seed(0)
+    # Normal and anomalous texts have different lengths, so grouping batches by
+    # length would separate them.
+    mixed = MixedData(
+        TextData(["a" * n for n in range(1, 65)]),
+        TextData(["b" * n for n in range(100, 164)]),
+        return_anomaly_labels=True,
+    )
+    detector = RecordingDetector()
+    detector.eval(mixed, batch_size=32)
+    assert len(detector.batches) == 4
+    assert all({x[0] for x in batch} == {"a", "b"} for batch in detector.batches)
@@ -1,8 +1,24 @@
 import math
+import pickle
 
 import pytest
 import torch
-from cupbearer.detectors.statistical.helpers import batch_covariance
+import transformers
+from cupbearer import utils
+from cupbearer.detectors.statistical.helpers import (
+    LowRankCovariance,
+    RunningCovariance,
+    RunningLowRankCovariance,
+    batch_covariance,
+    mahalanobis,
+    mahalanobis_low_rank,
+    quantum_entropy,
+    woodbury_factors,
+)
+from cupbearer.models import CNN, MLP, HuggingfaceLM, PreActResNet
+from cupbearer.models.models import PreActBlock
+from cupbearer.models.truncation import truncate_model
+from transformer_lens import HookedTransformer, HookedTransformerConfig
 
 
 @pytest.mark.parametrize("N", [10, 15, 100])
@@ -36,6 +52,111 @@ def test_batch_covariance(N: int):
     ), "Covariance estimates do not match"
 
 
+def test_merge_running_covariance():
+    torch.manual_seed(0)
+    data = torch.randn(100, 3) @ torch.randn(3, 3) + torch.tensor([1.0, -2.0, 3.0])
+
+    # Statistics of shards with different sizes
+    merged = RunningCovariance(3)
+    for shard in [data[:10], data[10:55], data[55:]]:
+        stats = RunningCovariance(3)
+        for batch in shard.split(7):
+            stats.update(batch)
+        merged.merge(stats)
+    # Empty statistics don't change anything
+    merged.merge(RunningCovariance(3))
+
+    assert merged.n == 100
+    torch.testing.assert_close(merged.mean, data.mean(0))
+    torch.testing.assert_close(merged.covariance, torch.cov(data.T))
+
+
+def test_low_rank_covariance():
+    torch.manual_seed(0)
+    # Rank 3 data in 10 dimensions, so a rank 3 sketch is exact
+    data = torch.randn(100, 3) @ torch.randn(3, 10) + torch.randn(10)
+
+    merged = RunningLowRankCovariance(10, rank=3)
+    for shard in [data[:30], data[30:]]:
+        stats = RunningLowRankCovariance(10, rank=3)
+        for batch in shard.split(8):
+            stats.update(batch)
+        merged.merge(stats)
+
+    assert merged.sketch.shape == (6, 10)
+    torch.testing.assert_close(merged.mean, data.mean(0))
+    eigenvectors, eigenvalues, diagonal = merged.covariance
+    assert eigenvectors.shape == (10, 3)
+    # Ascending, like torch.linalg.eigh
+    assert (eigenvalues[1:] >= eigenvalues[:-1]).all()
+    torch.testing.assert_close(
+        eigenvectors @ torch.diag(eigenvalues) @ eigenvectors.T,
+        torch.cov(data.T),
+        rtol=1e-4,
+        atol=1e-4,
+    )
+    torch.testing.assert_close(diagonal, torch.zeros(10), rtol=0, atol=1e-4)
+
+    # Variance outside the top directions ends up in the diagonal
+    noisy = data + 0.1 * torch.randn(100, 10)
+    stats = RunningLowRankCovariance(10, rank=3)
+    for batch in noisy.split(8):
+        stats.update(batch)
+    torch.testing.assert_close(
+        stats.covariance.variances(), torch.var(noisy, dim=0), rtol=1e-4, atol=1e-4
+    )
+
+    # With at most 2 * rank dimensions, the sketch is exact
+    stats = RunningLowRankCovariance(4, rank=2)
+    for batch in noisy[:, :4].split(8):
+        stats.update(batch)
+    assert stats.sketch.shape == (4, 4)
+    torch.testing.assert_close(
+        stats.sketch.T @ stats.sketch / (stats.n - 1),
+        torch.cov(noisy[:, :4].T),
+        rtol=1e-4,
+        atol=1e-4,
+    )
+
+
+def test_mahalanobis_low_rank():
+    torch.manual_seed(0)
+    eigenvectors = torch.linalg.qr(torch.randn(8, 3)).Q
+    covariance = LowRankCovariance(
+        eigenvectors, torch.tensor([1.0, 4.0, 9.0]), torch.rand(8) + 0.1
+    )
+    dense = eigenvectors @ torch.diag(
+        covariance.eigenvalues
+    ) @ eigenvectors.T + torch.diag(covariance.diagonal)
+    mean = torch.randn(8)
+    activations = torch.randn(16, 8)
+
+    torch.testing.assert_close(
+        mahalanobis_low_rank(activations, mean, woodbury_factors(covariance)),
+        mahalanobis(activations, mean, torch.linalg.inv(dense)),
+        rtol=1e-4,
+        atol=1e-4,
+    )
+
+
+@pytest.mark.parametrize("batch,dim", [(8, 50), (32, 20), (16, 16)])
+def test_quantum_entropy_gram(batch: int, dim: int):
+    torch.manual_seed(0)
+    # Double precision, so differences are due to the method and not rounding
+    activations = torch.randn(batch, dim, dtype=torch.float64)
+    activations[0] += 3  # an outlier, so the exponential isn't close to linear
+
+    dense = quantum_entropy(activations, method="dense")
+    torch.testing.assert_close(quantum_entropy(activations, method="gram"), dense)
+    torch.testing.assert_close(quantum_entropy(activations), dense)
+    torch.testing.assert_close(
+        quantum_entropy(activations.float(), method="gram"),
+        dense.float(),
+        rtol=1e-4,
+        atol=1e-4,
+    )
+
+
 @pytest.mark.parametrize("N", [15, 100])
 def test_spectral_computation(N: int):
     # Create synthetic data with non-trivial covariance and 0 mean
@@ -72,3 +193,236 @@ def test_spectral_computation(N: int):
     except AssertionError:
         # Sign ambiguity
         assert torch.allclose(-v_direct, v_indirect)
+
+
+def test_activation_capture():
+    model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3, 3])
+    names = ["layers.linear_0.input", "layers.linear_1.output"]
+    inputs = torch.randn(5, 4)
+    expected = utils.get_activations(model, names, inputs)
+    # Hooks are removed after each call
+    assert not model.layers.linear_0._forward_hooks
+
+    capture = utils.ActivationCapture(model, names)
+    assert len(model.layers.linear_0._forward_hooks) == 1
+    for _ in range(2):
+        acts = capture.get_activations(names, inputs)
+        assert acts.keys() == expected.keys()
+        for name in names:
+            assert torch.equal(acts[name], expected[name])
+
+    # Only some of the names
+    acts = capture.get_activations(names[:1], inputs)
+    assert acts.keys() == {names[0]}
+    with pytest.raises(ValueError):
+        capture.get_activations(["layers.linear_2.output"], inputs)
+
+    # Hooks don't do anything when the capture isn't active
+    assert model(inputs).shape == (5, 2)
+
+    capture.remove()
+    assert not model.layers.linear_0._forward_hooks
+
+
+def test_pickle_model_with_capture():
+    model = MLP(input_shape=(4,), output_dim=2, hidden_dims=[3])
+    names = ["layers.linear_0.output"]
+    inputs = torch.randn(5, 4)
+    capture = utils.ActivationCapture(model, names)
+    expected = capture.get_activations(names, inputs)
+
+    # E.g. for sending the model to worker processes
+    copied = pickle.loads(pickle.dumps(model))
+    torch.testing.assert_close(copied(inputs), model(inputs))
+    # The copy's hooks are inert, but it can be captured from like any model
+    assert utils.get_activations(copied, names, inputs).keys() == expected.keys()
+    # The original capture keeps working
+    torch.testing.assert_close(capture.get_activations(names, inputs), expected)
+
+
+@pytest.mark.parametrize(
+    "model,input_shape,names",
+    [
+        (
+            MLP(input_shape=(1, 8, 8), hidden_dims=[5, 5], output_dim=3),
+            (1, 8, 8),
+            ["layers.linear_0.input", "layers.relu_1.output"],
+        ),
+        (
+            CNN(input_shape=(1, 8, 8), output_dim=3, channels=[2, 2], dense_dims=[4]),
+            (1, 8, 8),
+            ["conv_layers.conv_1.output", "mlp.layers.linear_0.output"],
+        ),
+        (
+            PreActResNet(PreActBlock, [1, 1, 1, 1]),
+            (3, 32, 32),
+            ["conv1.output", "layer2.0.conv1.output", "layer3.output"],
+        ),
+    ],
+)
+def test_truncated_activations(model, input_shape, names):
+    inputs = torch.randn(2, *input_shape)
+    assert truncate_model(model, names) is not None
+    # The entire model is needed for the output
+    assert truncate_model(model, [""]) is None
+
+    expected = utils.ActivationCapture(model, names, truncate=False).get_activations(
+        names, inputs
+    )
+
+    calls = 0
+
+    def count_calls(module, input):
+        nonlocal calls
+        calls += 1
+
+    model.register_forward_pre_hook(count_calls)
+    capture = utils.ActivationCapture(model, names)
+    acts = capture.get_activations(names, inputs)
+    # The model itself isn't called, only the stages we need
+    assert calls == 0
+    for name in names:
+        assert torch.equal(acts[name], expected[name])
+
+
+def test_batched_activation_grads():
+    model = MLP(input_shape=(4,), output_dim=3, hidden_dims=[5])
+    names = ["layers.linear_0.input", "layers.relu_0.output"]
+    inputs = torch.randn(6, 4)
+
+    acts, grads = utils.get_activations_and_grads(
+        model, names, lambda logits: logits, inputs
+    )
+    assert grads["layers.linear_0.input"].shape == (6, 3, 4)
+    assert grads["layers.relu_0.output"].shape == (6, 3, 5)
+    assert not acts["layers.relu_0.output"].requires_grad
+
+    for i in range(3):
+        single_acts, single_grads = utils.get_activations_and_grads(
+            model, names, lambda logits: logits[:, i], inputs
+        )
+        for name in names:
+            assert torch.allclose(acts[name], single_acts[name])
+            assert torch.allclose(grads[name][:, i], single_grads[name])
+
+
+class CharTokenizer:
+    """Minimal tokenizer with one token per character that counts its calls."""
+
+    def __init__(self, padding_side: str = "left"):
+        self.padding_side = padding_side
+        self.calls = 0
+
+    def __call__(self, inputs, return_tensors="pt", padding=True):
+        self.calls += 1
+        length = max(len(x) for x in inputs)
+        input_ids = torch.zeros(len(inputs), length, dtype=torch.long)
+        attention_mask = torch.zeros(len(inputs), length, dtype=torch.long)
+        for i, text in enumerate(inputs):
+            if not text:
+                continue
+            positions = (
+                slice(length - len(text), None)
+                if self.padding_side == "left"
+                else slice(None, len(text))
+            )
+            input_ids[i, positions] = torch.tensor([ord(c) for c in text])
+            attention_mask[i, positions] = 1
+        return CharTokens(input_ids=input_ids, attention_mask=attention_mask)
+
+
+class CharTokens(dict):
+    def to(self, device):
+        return CharTokens({k: v.to(device) for k, v in self.items()})
+
+
+def test_padded_length_position_ids():
+    model = HuggingfaceLM(tokenizer=CharTokenizer(), device="cpu", padded_length=5)
+
+    # Positions as if padded to 5 tokens on the left
+    tokens = model.model_inputs(["ab", "abc"])
+    assert tokens["position_ids"].tolist() == [[2, 3, 4]] * 2
+
+    # Longer batches aren't truncated and positions start at zero
+    tokens = model.model_inputs(["abcdefg", "ab"])
+    assert tokens["input_ids"].shape == (2, 7)
+    assert tokens["position_ids"].tolist() == [list(range(7))] * 2
+
+
+@pytest.mark.parametrize("padding_side", ["left", "right"])
+def test_attention_mask_reuse(padding_side):
+    tokenizer = CharTokenizer(padding_side)
+    model = HuggingfaceLM(
+        tokenizer=tokenizer,
+        model=lambda input_ids, attention_mask: input_ids,
+        device="cpu",
+    )
+    inputs = ["ab", "abcd", "c"]
+    input_ids = model(inputs)
+    assert tokenizer.calls == 1
+
+    # The mask of the forward pass is reused for the same inputs
+    mask = model.attention_mask(inputs)
+    assert torch.equal(mask, (input_ids != 0).long())
+    indices = model.last_token_indices(inputs)
+    assert tokenizer.calls == 1
+    if padding_side == "left":
+        assert indices.tolist() == [3, 3, 3]
+    else:
+        assert indices.tolist() == [1, 3, 0]
+    # Indices point at the last non-padding token
+    last_tokens = input_ids[range(len(inputs)), indices]
+    assert last_tokens.tolist() == [ord("b"), ord("d"), ord("c")]
+
+    # Equal but different inputs are tokenized again, with the same results
+    assert torch.equal(model.last_token_indices(list(inputs)), indices)
+    assert tokenizer.calls == 2
+
+
+def assert_truncated(model, names, inputs, skipped_module):
+    """Check that truncated activations match those of a full forward pass."""
+    expected = utils.ActivationCapture(model, names, truncate=False).get_activations(
+        names, inputs
+    )
+
+    calls = 0
+
+    def count_calls(module, input):
+        nonlocal calls
+        calls += 1
+
+    skipped_module.register_forward_pre_hook(count_calls)
+    capture = utils.ActivationCapture(model, names)
+    acts = capture.get_activations(names, inputs)
+    assert calls == 0
+    for name in names:
+        assert torch.equal(acts[name], expected[name])
+
+
+def test_truncated_huggingface_activations():
+    config = transformers.GPT2Config(
+        vocab_size=128, n_positions=16, n_embd=8, n_layer=3, n_head=2
+    )
+    hf_model = transformers.GPT2LMHeadModel(config).eval()
+    model = HuggingfaceLM(tokenizer=CharTokenizer(), model=hf_model, device="cpu")
+    names = [
+        "hf_model.transformer.h.0.mlp.output",
+        "hf_model.transformer.h.1.ln_2.output",
+    ]
+    assert truncate_model(model, names) is not None
+    # The last layer and the LM head aren't run
+    assert_truncated(model, names, ["ab", "abcd"], hf_model.transformer.h[2])
+    assert_truncated(model, names, ["ab", "abcd"], hf_model.lm_head)
+
+
+def test_truncated_hooked_transformer_activations():
+    config = HookedTransformerConfig(
+        n_layers=3, d_model=8, n_ctx=16, d_head=4, n_heads=2, d_vocab=20, act_fn="relu"
+    )
+    model = HookedTransformer(config)
+    names = ["blocks.0.hook_resid_post.output", "blocks.1.mlp.hook_post.output"]
+    assert truncate_model(model, names) is not None
+    assert truncate_model(model, ["blocks.2.hook_resid_post.output"]) is None
+    inputs = torch.randint(20, (2, 5))
+    assert_truncated(model, names, inputs, model.blocks[2])
+    assert_truncated(model, names, inputs, model.unembed)